@@ -0,0 +1,132 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT license.
+
+Batched augmentation stage. With device_augment=True the mesh datasets only
+crop a larger, unrotated uint8 canvas around the person and return it with
+the sampled augmentation parameters. BatchAugmentation then rotates, flips,
+adds pixel noise and normalizes the whole batch on the training device, and
+applies the same transforms to joints_2d and joints_3d.
+"""
+
+import math
+import torch
+import torch.nn.functional as F
+from src.utils.image_ops import FLIPPED_KP_PARTS
+
+
+def canvas_size(img_res):
+    """Side of the canvas that still covers the crop after any rotation."""
+    return int(math.ceil(img_res * math.sqrt(2)))
+
+
+def get_transform_batch(center, scale, res, rot):
+    """Batched version of image_ops.get_transform for a square resolution.
+    center: (B,2), scale: (B,), rot: (B,) in degrees. Returns (B,3,3) float64.
+    """
+    center = center.double()
+    h = 200 * scale.double()
+    t = torch.zeros((center.shape[0], 3, 3), dtype=torch.float64, device=center.device)
+    t[:, 0, 0] = res / h
+    t[:, 1, 1] = res / h
+    t[:, 0, 2] = res * (-center[:, 0] / h + .5)
+    t[:, 1, 2] = res * (-center[:, 1] / h + .5)
+    t[:, 2, 2] = 1
+    # rotate around the center of the crop, in the same direction as cropping
+    rot_rad = -rot.double() * math.pi / 180
+    sn, cs = torch.sin(rot_rad), torch.cos(rot_rad)
+    r = torch.zeros_like(t)
+    r[:, 0, 0] = cs
+    r[:, 0, 1] = -sn
+    r[:, 1, 0] = sn
+    r[:, 1, 1] = cs
+    r[:, 0, 2] = res / 2 - (cs - sn) * res / 2
+    r[:, 1, 2] = res / 2 - (sn + cs) * res / 2
+    r[:, 2, 2] = 1
+    return torch.bmm(r, t)
+
+
+class BatchAugmentation(object):
+    """Augment a batch of canvases returned by a dataset with device_augment=True.
+
+    Call it on the batch after moving the images to the training device:
+        images = batch_augment(images, annotations)
+    It returns the normalized images, and updates annotations in place with
+    'ori_img' and the transformed 'joints_2d' and 'joints_3d'.
+    The SMPL/MANO pose is still rotated and flipped by the dataset workers.
+    """
+    def __init__(self, img_res=224, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225),
+                 flipped_parts=FLIPPED_KP_PARTS):
+        self.img_res = img_res
+        self.mean = torch.tensor(mean).view(1, 3, 1, 1)
+        self.std = torch.tensor(std).view(1, 3, 1, 1)
+        self.flipped_parts = list(flipped_parts)
+
+    def image_theta(self, rot, flip, canvas_res):
+        """Affine matrices (B,2,3) for F.affine_grid, mapping the normalized
+        output crop to the normalized canvas (align_corners=False)."""
+        rot_rad = -rot * math.pi / 180
+        sn, cs = torch.sin(rot_rad), torch.cos(rot_rad)
+        # inverse of the rotation used by get_transform
+        r_inv = torch.stack([torch.stack([cs, sn], dim=1),
+                             torch.stack([-sn, cs], dim=1)], dim=1)
+        theta = torch.zeros((rot.shape[0], 2, 3), dtype=rot.dtype, device=rot.device)
+        theta[:, :, :2] = r_inv * (float(self.img_res) / canvas_res)
+        # flipping the output negates its normalized x coordinate
+        theta[:, :, 0] = torch.where(flip[:, None] > 0, -theta[:, :, 0], theta[:, :, 0])
+        # half pixel offset between pixel indices and normalized coordinates
+        theta[:, :, 2] = (1 - r_inv.sum(dim=2)) / canvas_res
+        return theta
+
+    def flip_kp(self, kp, flip):
+        if not bool((flip > 0).any()):
+            return kp
+        assert kp.shape[1] == len(self.flipped_parts), \
+            'no flip order for {} keypoints'.format(kp.shape[1])
+        flipped = kp[:, self.flipped_parts].clone()
+        flipped[:, :, 0] = -flipped[:, :, 0]
+        return torch.where(flip[:, None, None] > 0, flipped, kp)
+
+    def j2d_processing(self, kp, center, scale, rot, flip):
+        """Same as the dataset j2d_processing, for a batch of keypoints (B,K,3)."""
+        t = get_transform_batch(center, scale, self.img_res, rot)
+        pts = kp[:, :, :2].double() + 1
+        pts = torch.bmm(pts - 1, t[:, :2, :2].transpose(1, 2)) + t[:, None, :2, 2]
+        pts = torch.trunc(pts) + 1
+        kp = kp.clone()
+        kp[:, :, :2] = (2. * pts / self.img_res - 1.).to(kp.dtype)
+        return self.flip_kp(kp, flip).float()
+
+    def j3d_processing(self, S, rot, flip):
+        """Same as the dataset j3d_processing, for a batch of keypoints (B,K,4)."""
+        rot_rad = -rot.double() * math.pi / 180
+        sn, cs = torch.sin(rot_rad).to(S.dtype), torch.cos(rot_rad).to(S.dtype)
+        S = S.clone()
+        x, y = S[:, :, 0].clone(), S[:, :, 1].clone()
+        S[:, :, 0] = cs[:, None] * x - sn[:, None] * y
+        S[:, :, 1] = sn[:, None] * x + cs[:, None] * y
+        return self.flip_kp(S, flip).float()
+
+    def __call__(self, images, meta_data):
+        device = images.device
+        batch_size, _, canvas_res, _ = images.shape
+        augm_params = meta_data['augm_params']
+        rot = augm_params['rot'].to(device, torch.float32)
+        flip = augm_params['flip'].to(device)
+        pn = augm_params['pn'].to(device, torch.float32)
+
+        theta = self.image_theta(rot, flip, canvas_res)
+        grid = F.affine_grid(theta, (batch_size, 3, self.img_res, self.img_res), align_corners=False)
+        img = F.grid_sample(images.float(), grid, mode='bilinear', padding_mode='zeros',
+                            align_corners=False)
+        # in the rgb image we add pixel noise in a channel-wise manner
+        img = torch.clamp(img * pn[:, :, None, None], 0.0, 255.0) / 255.0
+        meta_data['ori_img'] = img
+        transfromed_img = (img - self.mean.to(device)) / self.std.to(device)
+
+        center = meta_data['center'].to(device)
+        scale = meta_data['scale'].to(device)
+        meta_data['joints_2d'] = self.j2d_processing(meta_data['joints_2d'].to(device),
+                                                     center, scale, rot, flip)
+        meta_data['joints_3d'] = self.j3d_processing(meta_data['joints_3d'].to(device), rot, flip)
+        return transfromed_img
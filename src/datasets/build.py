@@ -6,21 +6,43 @@ Licensed under the MIT license.
 
 
 import os.path as op
+import math
+import itertools
 import torch
 import logging
 import code
-from src.utils.comm import get_world_size
+import numpy as np
+from src.utils.comm import get_world_size, get_rank
+from src.utils.tsv_file import CompositeTSVFile
 from src.datasets.human_mesh_tsv import (MeshTSVDataset, MeshTSVYamlDataset)
 from src.datasets.hand_mesh_tsv import (HandMeshTSVDataset, HandMeshTSVYamlDataset)
 
 
+def get_dataset_options(args, is_train=True):
+    """Optional dataset settings, taken from the command line arguments if given."""
+    return dict(
+        fast_crop=getattr(args, 'fast_crop', False),
+        fused_normalize=getattr(args, 'fused_normalize', False),
+        # the training loop runs BatchAugmentation, evaluation keeps the worker path
+        device_augment=getattr(args, 'device_augment', False) and is_train,
+        reduced_decode=getattr(args, 'reduced_decode', False),
+        # only used by evaluation datasets
+        crop_cache=getattr(args, 'eval_crop_cache', None),
+        # the feature cache of a frozen backbone holds one crop per training sample
+        augment=not (getattr(args, 'cache_train_features', False) and
+                     getattr(args, 'freeze_backbone', False) and
+                     getattr(args, 'backbone_feature_cache', None)),
+    )
+
+
 def build_dataset(yaml_file, args, is_train=True, scale_factor=1):
     print(yaml_file)
     if not op.isfile(yaml_file):
         yaml_file = op.join(args.data_dir, yaml_file)
         # code.interact(local=locals())
         assert op.isfile(yaml_file)
-    return MeshTSVYamlDataset(yaml_file, is_train, False, scale_factor)
+    return MeshTSVYamlDataset(yaml_file, is_train, False, scale_factor,
+                              **get_dataset_options(args, is_train))
 
 
 class IterationBasedBatchSampler(torch.utils.data.sampler.BatchSampler):
@@ -36,13 +58,24 @@ class IterationBasedBatchSampler(torch.utils.data.sampler.BatchSampler):
 
     def __iter__(self):
         iteration = self.start_iter
+        sampler = self.batch_sampler.sampler
+        batches_per_epoch = len(self.batch_sampler)
+        # when resuming, continue the pass over the data at the exact batch
+        skip_batches = iteration % batches_per_epoch
         while iteration <= self.num_iterations:
             # if the underlying sampler has a set_epoch method, like
             # DistributedSampler, used for making each process see
             # a different split of the dataset, then set it
-            if hasattr(self.batch_sampler.sampler, "set_epoch"):
-                self.batch_sampler.sampler.set_epoch(iteration)
-            for batch in self.batch_sampler:
+            if hasattr(sampler, "set_epoch"):
+                sampler.set_epoch(iteration - skip_batches)
+            batches = self.batch_sampler
+            if hasattr(sampler, "set_start_index"):
+                sampler.set_start_index(skip_batches * self.batch_sampler.batch_size)
+            elif skip_batches > 0:
+                # only indices are drawn for the skipped batches, no data is read
+                batches = itertools.islice(self.batch_sampler, skip_batches, None)
+            skip_batches = 0
+            for batch in batches:
                 iteration += 1
                 if iteration > self.num_iterations:
                     break
@@ -51,6 +84,26 @@ class IterationBasedBatchSampler(torch.utils.data.sampler.BatchSampler):
     def __len__(self):
         return self.num_iterations
 
+    def state_dict(self, iteration):
+        """Sampler state after the given number of consumed iterations.
+        The dataloader prefetches batches, so the caller passes the iteration
+        of the training loop instead of the position of this sampler."""
+        sampler = self.batch_sampler.sampler
+        return {'iteration': iteration,
+                'num_iterations': self.num_iterations,
+                'batch_size': self.batch_sampler.batch_size,
+                'seed': getattr(sampler, 'seed', None),
+                'num_replicas': getattr(sampler, 'num_replicas', 1)}
+
+    def load_state_dict(self, state):
+        """Start the next iteration over this sampler right after state['iteration']."""
+        current = self.state_dict(state['iteration'])
+        for key in ['num_iterations', 'batch_size', 'seed', 'num_replicas']:
+            if state[key] != current[key]:
+                logging.getLogger(__name__).warning(
+                    "Resumed sampler has {}={}, the saved state has {}".format(key, current[key], state[key]))
+        self.start_iter = state['iteration']
+
 
 def make_batch_data_sampler(sampler, images_per_gpu, num_iters=None, start_iter=0):
     batch_sampler = torch.utils.data.sampler.BatchSampler(
@@ -63,16 +116,214 @@ def make_batch_data_sampler(sampler, images_per_gpu, num_iters=None, start_iter=
     return batch_sampler
 
 
-def make_data_sampler(dataset, shuffle, distributed):
+class EpochRandomSampler(torch.utils.data.sampler.Sampler):
+    """
+    RandomSampler whose permutation only depends on the seed and the epoch,
+    so that any position of the training run can be reproduced.
+    """
+
+    def __init__(self, data_source, seed=0):
+        self.data_source = data_source
+        self.seed = seed
+        self.epoch = 0
+        self.start_index = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def set_start_index(self, start_index):
+        """Skip the first start_index samples of the next pass."""
+        self.start_index = start_index
+
+    def __iter__(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        indices = torch.randperm(len(self.data_source), generator=g)[self.start_index:]
+        self.start_index = 0
+        return iter(indices.tolist())
+
+    def __len__(self):
+        return len(self.data_source)
+
+
+class ResumableDistributedSampler(torch.utils.data.distributed.DistributedSampler):
+    """DistributedSampler that can start a pass in the middle of an epoch.
+    The shuffling depends on seed + epoch, also on torch versions whose
+    DistributedSampler has no seed argument."""
+
+    def __init__(self, dataset, num_replicas=None, rank=None, shuffle=True, seed=0):
+        super(ResumableDistributedSampler, self).__init__(
+            dataset, num_replicas=num_replicas, rank=rank, shuffle=shuffle)
+        self.seed = seed
+        self.start_index = 0
+
+    def set_start_index(self, start_index):
+        """Skip the first start_index samples of the next pass."""
+        self.start_index = start_index
+
+    def __iter__(self):
+        if self.shuffle:
+            g = torch.Generator()
+            g.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(len(self.dataset), generator=g).tolist()
+        else:
+            indices = list(range(len(self.dataset)))
+        # pad with the first samples, so that every rank gets the same number
+        indices += indices[:(self.total_size - len(indices))]
+        indices = indices[self.rank:self.total_size:self.num_replicas]
+        start_index, self.start_index = self.start_index, 0
+        return iter(indices[start_index:])
+
+    def num_unpadded_samples(self):
+        """Number of samples of this rank before its padding. The padding comes
+        last on every rank and repeats samples of the other ranks."""
+        return len(range(self.rank, len(self.dataset), self.num_replicas))
+
+
+def make_data_sampler(dataset, shuffle, distributed, seed=0):
     if distributed:
-        return torch.utils.data.distributed.DistributedSampler(dataset, shuffle=shuffle)
+        return ResumableDistributedSampler(dataset, shuffle=shuffle, seed=seed)
     if shuffle:
-        sampler = torch.utils.data.sampler.RandomSampler(dataset)
+        sampler = EpochRandomSampler(dataset, seed=seed)
     else:
         sampler = torch.utils.data.sampler.SequentialSampler(dataset)
     return sampler
 
 
+def num_unpadded_samples(data_loader):
+    """Number of samples of this process that are not the padding of a
+    distributed sampler; they are the first samples of a pass."""
+    batch_sampler = getattr(data_loader.batch_sampler, 'batch_sampler', data_loader.batch_sampler)
+    sampler = batch_sampler.sampler
+    if hasattr(sampler, 'num_unpadded_samples'):
+        return sampler.num_unpadded_samples()
+    return len(sampler)
+
+
+def get_sample_shards(dataset):
+    """Shard and row in the image TSV of every dataset index.
+    A plain TSV file is a single shard."""
+    line_nos = np.array([dataset.get_line_no(i) for i in range(len(dataset))], dtype=np.int64)
+    if isinstance(dataset.img_tsv, CompositeTSVFile):
+        seq = np.asarray(dataset.img_tsv.seq)[line_nos]
+        return seq[:, 0].astype(np.int64), seq[:, 1].astype(np.int64)
+    return np.zeros_like(line_nos), line_nos
+
+
+def shuffle_buffer(indices, buffer_size, rng):
+    """Streaming shuffle: every output is drawn at random from a buffer
+    holding the next buffer_size inputs."""
+    out = np.empty_like(indices)
+    buf = indices[:buffer_size].copy()
+    for i, idx in enumerate(indices[buffer_size:]):
+        j = rng.randint(len(buf))
+        out[i] = buf[j]
+        buf[j] = idx
+    out[len(indices)-len(buf):] = rng.permutation(buf)
+    return out
+
+
+def read_locality(shards, rows, indices, batch_size=32):
+    """Locality of reading the samples in the order of indices."""
+    s, r = shards[indices], rows[indices]
+    same_shard = s[1:] == s[:-1]
+    row_gaps = np.abs(r[1:] - r[:-1])[same_shard]
+    num_batches = max(1, len(indices) // batch_size)
+    shards_per_batch = np.mean([len(np.unique(b)) for b in
+                                np.array_split(s[:num_batches*batch_size], num_batches)])
+    return {'same_shard': float(same_shard.mean()) if len(same_shard) else 1.0,
+            'median_row_gap': float(np.median(row_gaps)) if len(row_gaps) else 0.0,
+            'shards_per_batch': float(shards_per_batch)}
+
+
+class ShardLocalitySampler(torch.utils.data.sampler.Sampler):
+    """
+    Shuffles blocks of consecutive rows of each TSV shard instead of single
+    rows, then mixes the samples of neighbouring blocks in a shuffle buffer.
+    Reads stay mostly sequential within a shard while batches are shuffled.
+    Like DistributedSampler, every rank gets a disjoint part of each epoch,
+    padded to the same length, and set_epoch changes the shuffling.
+    """
+
+    def __init__(self, shards, rows, block_size=256, buffer_size=1024, shuffle=True,
+                 seed=0, num_replicas=None, rank=None):
+        if num_replicas is None:
+            num_replicas = get_world_size()
+        if rank is None:
+            rank = get_rank()
+        self.shards = np.asarray(shards, dtype=np.int64)
+        self.rows = np.asarray(rows, dtype=np.int64)
+        self.block_size = block_size
+        self.buffer_size = buffer_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self.start_index = 0
+        self.num_samples = int(math.ceil(len(self.shards) * 1.0 / self.num_replicas))
+        self.total_size = self.num_samples * self.num_replicas
+
+        # blocks of consecutive rows within a shard, in file order
+        order = np.lexsort((self.rows, self.shards))
+        shard_bounds = np.flatnonzero(np.diff(self.shards[order])) + 1
+        self.blocks = []
+        for shard_order in np.split(order, shard_bounds):
+            self.blocks.extend(np.split(shard_order,
+                                        np.arange(block_size, len(shard_order), block_size)))
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def set_start_index(self, start_index):
+        """Skip the first start_index samples of the next pass."""
+        self.start_index = start_index
+
+    def get_indices(self):
+        rng = np.random.RandomState((self.seed + self.epoch) % 2**32)
+        if self.shuffle:
+            block_order = rng.permutation(len(self.blocks))
+        else:
+            block_order = np.arange(len(self.blocks))
+        indices = np.concatenate([self.blocks[i] for i in block_order])
+        # pad to a multiple of the number of replicas
+        indices = np.resize(indices, self.total_size)
+        # contiguous part for each rank, which keeps its blocks whole
+        indices = indices[self.rank*self.num_samples:(self.rank+1)*self.num_samples]
+        if self.shuffle and self.buffer_size > 1:
+            indices = shuffle_buffer(indices, self.buffer_size, rng)
+        return indices
+
+    def __iter__(self):
+        start_index, self.start_index = self.start_index, 0
+        return iter(self.get_indices()[start_index:].tolist())
+
+    def __len__(self):
+        return self.num_samples
+
+    def locality(self, batch_size=32):
+        """Read locality of the current epoch, and of uniform shuffling for reference."""
+        indices = self.get_indices()
+        rng = np.random.RandomState(self.seed)
+        uniform = rng.permutation(len(self.shards))[:self.num_samples]
+        return (read_locality(self.shards, self.rows, indices, batch_size),
+                read_locality(self.shards, self.rows, uniform, batch_size))
+
+
+def make_locality_sampler(dataset, args, distributed, images_per_gpu):
+    shards, rows = get_sample_shards(dataset)
+    sampler = ShardLocalitySampler(shards, rows,
+            block_size=args.sampler_block_size, buffer_size=args.sampler_buffer_size,
+            seed=args.seed, num_replicas=get_world_size() if distributed else 1,
+            rank=get_rank() if distributed else 0)
+    locality, uniform = sampler.locality(images_per_gpu)
+    logger = logging.getLogger(__name__)
+    logger.info("Shard locality sampler: {} blocks of {} rows in {} shards".format(
+                len(sampler.blocks), args.sampler_block_size, len(np.unique(shards))))
+    logger.info("Read locality {} (uniform shuffling: {})".format(locality, uniform))
+    return sampler
+
+
 def make_data_loader(args, yaml_file, is_distributed=True, 
         is_train=True, start_iter=0, scale_factor=1):
 
@@ -93,7 +344,10 @@ def make_data_loader(args, yaml_file, is_distributed=True,
         num_iters = None
         start_iter = 0
 
-    sampler = make_data_sampler(dataset, shuffle, is_distributed)
+    if is_train and getattr(args, 'locality_sampler', False):
+        sampler = make_locality_sampler(dataset, args, is_distributed, images_per_gpu)
+    else:
+        sampler = make_data_sampler(dataset, shuffle, is_distributed, seed=getattr(args, 'seed', 0))
     batch_sampler = make_batch_data_sampler(
         sampler, images_per_gpu, num_iters, start_iter
     )
@@ -112,7 +366,8 @@ def build_hand_dataset(yaml_file, args, is_train=True, scale_factor=1):
         yaml_file = op.join(args.data_dir, yaml_file)
         # code.interact(local=locals())
         assert op.isfile(yaml_file)
-    return HandMeshTSVYamlDataset(args, yaml_file, is_train, False, scale_factor)
+    return HandMeshTSVYamlDataset(args, yaml_file, is_train, False, scale_factor,
+                                  **get_dataset_options(args, is_train))
 
 
 def make_hand_data_loader(args, yaml_file, is_distributed=True, 
@@ -135,7 +390,10 @@ def make_hand_data_loader(args, yaml_file, is_distributed=True,
         num_iters = None
         start_iter = 0
 
-    sampler = make_data_sampler(dataset, shuffle, is_distributed)
+    if is_train and getattr(args, 'locality_sampler', False):
+        sampler = make_locality_sampler(dataset, args, is_distributed, images_per_gpu)
+    else:
+        sampler = make_data_sampler(dataset, shuffle, is_distributed, seed=getattr(args, 'seed', 0))
     batch_sampler = make_batch_data_sampler(
         sampler, images_per_gpu, num_iters, start_iter
     )
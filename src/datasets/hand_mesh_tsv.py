@@ -15,14 +15,19 @@ import code
 
 from src.utils.tsv_file import TSVFile, CompositeTSVFile
 from src.utils.tsv_file_ops import load_linelist_file, load_from_yaml_file, find_file_path_in_yaml
-from src.utils.image_ops import img_from_base64, crop, flip_img, flip_pose, flip_kp, transform, rot_aa
+from src.utils.label_store import LabelStore
+from src.utils.crop_cache import CropCache, cache_key, source_signature, tsv_source_files
+from src.datasets.batch_augment import canvas_size
+from src.utils.image_ops import img_from_base64, reduced_box, crop, crop_warp, rgb_normalize, flip_img, flip_pose, flip_kp, transform_pts, rot_aa
 import torch
 import torchvision.transforms as transforms
 
 
 class HandMeshTSVDataset(object):
     def __init__(self, args, img_file, label_file=None, hw_file=None,
-                 linelist_file=None, is_train=True, cv2_output=False, scale_factor=1):
+                 linelist_file=None, is_train=True, cv2_output=False, scale_factor=1,
+                 label_store=None, fast_crop=False, fused_normalize=False,
+                 device_augment=False, reduced_decode=False, crop_cache=None, augment=True):
 
         self.args = args
         self.img_file = img_file
@@ -32,6 +37,10 @@ class HandMeshTSVDataset(object):
         self.img_tsv = self.get_tsv_file(img_file)
         self.label_tsv = None if label_file is None else self.get_tsv_file(label_file)
         self.hw_tsv = None if hw_file is None else self.get_tsv_file(hw_file)
+        self.label_store = None if label_store is None else LabelStore(label_store)
+        if self.label_store is not None:
+            assert self.label_store.is_up_to_date(self.label_tsv), \
+                'label store {} is out of date, compile it again'.format(label_store)
 
         if self.is_composite:
             assert op.isfile(self.linelist_file)
@@ -40,9 +49,15 @@ class HandMeshTSVDataset(object):
             self.line_list = load_linelist_file(linelist_file)
 
         self.cv2_output = cv2_output
+        self.fast_crop = fast_crop
+        self.fused_normalize = fused_normalize
+        self.device_augment = device_augment
+        self.reduced_decode = reduced_decode
         self.normalize_img = transforms.Normalize(mean=[0.485, 0.456, 0.406],
                                          std=[0.229, 0.224, 0.225])
         self.is_train = is_train
+        # random augmentation of the training samples
+        self.augment = augment
         self.scale_factor = 0.25 # rescale bounding boxes by a factor of [1-options.scale_factor,1+options.scale_factor]
         self.noise_factor = 0.4
         self.rot_factor = 90 # Random rotation in the range [-rot_factor, rot_factor]
@@ -52,6 +67,11 @@ class HandMeshTSVDataset(object):
                                 'Middle_2', 'Middle_3', 'Middle_4', 'Ring_1', 'Ring_2', 'Ring_3', 'Ring_4', 'Pinky_1', 'Pinky_2', 'Pinky_3', 'Pinky_4')
         self.root_index = self.joints_definition.index('Wrist')
 
+        # processed samples are fixed in evaluation, cache them on disk
+        self.crop_cache = None
+        if crop_cache is not None and not self.is_train:
+            self.crop_cache = self.open_crop_cache(crop_cache)
+
     def get_tsv_file(self, tsv_file):
         if tsv_file:
             if self.is_composite:
@@ -69,7 +89,7 @@ class HandMeshTSVDataset(object):
 
     def prepare_image_keys(self):
         tsv = self.get_valid_tsv()
-        return [tsv.get_key(i) for i in range(tsv.num_rows())]
+        return tsv.get_keys_bulk()
 
     def prepare_image_key_to_index(self):
         tsv = self.get_valid_tsv()
@@ -88,7 +108,7 @@ class HandMeshTSVDataset(object):
             rot = self.args.rot
             sc = self.args.sc
 
-        if self.is_train:
+        if self.is_train and self.augment:
             sc = 1.0 
             # Each channel is multiplied with a number 
             # in the area [1-opt.noiseFactor,1+opt.noiseFactor]
@@ -110,8 +130,12 @@ class HandMeshTSVDataset(object):
 
     def rgb_processing(self, rgb_img, center, scale, rot, flip, pn):
         """Process rgb image and do augmentation."""
-        rgb_img = crop(rgb_img, center, scale, 
-                      [self.img_res, self.img_res], rot=rot)
+        if self.fast_crop:
+            rgb_img = crop_warp(rgb_img, center, scale,
+                          [self.img_res, self.img_res], rot=rot).astype(np.float32)
+        else:
+            rgb_img = crop(rgb_img, center, scale, 
+                          [self.img_res, self.img_res], rot=rot)
         # flip the image 
         if flip:
             rgb_img = flip_img(rgb_img)
@@ -123,11 +147,30 @@ class HandMeshTSVDataset(object):
         rgb_img = np.transpose(rgb_img.astype('float32'),(2,0,1))/255.0
         return rgb_img
 
+    def rgb_processing_fused(self, rgb_img, center, scale, rot, flip, pn):
+        """Process rgb image and do augmentation, fusing pixel noise and normalization.
+        Returns the image in [0,1] and the normalized image, both (3,224,224) float.
+        """
+        rgb_img = crop_warp(rgb_img, center, scale,
+                      [self.img_res, self.img_res], rot=rot)
+        # flip the image 
+        if flip:
+            rgb_img = flip_img(rgb_img)
+        return rgb_normalize(rgb_img, pn, self.normalize_img.mean, self.normalize_img.std)
+
+    def rgb_canvas(self, rgb_img, center, scale):
+        """Crop an unrotated uint8 canvas around the bounding box for BatchAugmentation.
+        It keeps enough context for any rotation of the final crop.
+        Returns a (3,S,S) uint8 tensor.
+        """
+        canvas_res = canvas_size(self.img_res)
+        rgb_img = crop_warp(rgb_img, center, scale*canvas_res/self.img_res,
+                      [canvas_res, canvas_res])
+        return torch.from_numpy(np.ascontiguousarray(rgb_img.transpose(2,0,1)))
+
     def j2d_processing(self, kp, center, scale, r, f):
         """Process gt 2D keypoints and apply all augmentation transforms."""
-        nparts = kp.shape[0]
-        for i in range(nparts):
-            kp[i,0:2] = transform(kp[i,0:2]+1, center, scale, 
+        kp[:,0:2] = transform_pts(kp[:,0:2]+1, center, scale,
                                   [self.img_res, self.img_res], rot=r)
         # convert to normalized coordinates
         kp[:,:-1] = 2.*kp[:,:-1]/self.img_res - 1.
@@ -169,11 +212,27 @@ class HandMeshTSVDataset(object):
     def get_line_no(self, idx):
         return idx if self.line_list is None else self.line_list[idx]
 
-    def get_image(self, idx): 
+    def get_decode_factor(self, idx, scale):
+        """Largest JPEG reduction (1, 2, 4 or 8) that still gives at least
+        img_res pixels across the bounding box, for large frames only."""
+        if not self.reduced_decode:
+            return 1
+        img_info = self.get_img_info(idx)
+        if img_info is None:
+            return 1
+        box_size = 200.0 * scale
+        frame_size = min(img_info['height'], img_info['width'])
+        factor = 1
+        while factor < 8 and box_size/(2*factor) >= self.img_res \
+                and frame_size/(2*factor) >= self.img_res:
+            factor *= 2
+        return factor
+
+    def get_image(self, idx, reduce=1): 
         line_no = self.get_line_no(idx)
         row = self.img_tsv[line_no]
         # use -1 to support old format with multiple columns.
-        cv2_im = img_from_base64(row[-1])
+        cv2_im = img_from_base64(row[-1], reduce)
         if self.cv2_output:
             return cv2_im.astype(np.float32, copy=True)
         cv2_im = cv2.cvtColor(cv2_im, cv2.COLOR_BGR2RGB)
@@ -181,7 +240,9 @@ class HandMeshTSVDataset(object):
 
     def get_annotations(self, idx):
         line_no = self.get_line_no(idx)
-        if self.label_tsv is not None:
+        if self.label_store is not None:
+            return self.label_store.get_annotations(line_no)
+        elif self.label_tsv is not None:
             row = self.label_tsv[line_no]
             annotations = json.loads(row[1])
             return annotations
@@ -222,9 +283,59 @@ class HandMeshTSVDataset(object):
         else:
             return len(self.line_list)
 
+    def cache_params(self):
+        """Settings that determine the processed samples, to key the caches of
+        this dataset. The augmentation has to be fixed, as in evaluation."""
+        flip,pn,rot,sc = self.augm_params()
+        return {'dataset': type(self).__name__, 'root': op.abspath(self.root),
+                  'img_file': self.img_file, 'label_file': self.label_file,
+                  'linelist_file': self.linelist_file, 'img_res': self.img_res,
+                  'sc': float(sc), 'rot': float(rot), 'fast_crop': self.fast_crop,
+                  'fused_normalize': self.fused_normalize, 'reduced_decode': self.reduced_decode}
+
+    def cache_source_files(self):
+        files = tsv_source_files(self.img_tsv) + tsv_source_files(self.label_tsv) + \
+                tsv_source_files(self.hw_tsv)
+        if self.linelist_file is not None:
+            files.append(self.linelist_file)
+        if self.label_store is not None:
+            # the labels are read from the store instead of the label tsv
+            files += self.label_store.source_files()
+        return files
+
+    def open_crop_cache(self, cache_root):
+        """Open the crop cache of this dataset and of its evaluation augmentation,
+        building it if it does not exist or if the source files changed."""
+        cache = CropCache(op.join(cache_root, cache_key(self.cache_params())), len(self),
+                          source_signature(self.cache_source_files()))
+        _, img, meta_data = self.process_item(0)
+        meta_data.pop('ori_img')
+        return cache.open((img, meta_data))
+
     def __getitem__(self, idx):
+        img_key, transfromed_img, meta_data = self.load_item(idx)
+        # dataset row, the key of the backbone feature cache
+        meta_data['row'] = idx
+        return img_key, transfromed_img, meta_data
+
+    def load_item(self, idx):
+        if self.crop_cache is None:
+            return self.process_item(idx)
+        cached = self.crop_cache.get(idx)
+        if cached is None:
+            img_key, transfromed_img, meta_data = self.process_item(idx)
+            self.crop_cache.put(idx, transfromed_img,
+                                {k: v for k, v in meta_data.items() if k != 'ori_img'})
+            return img_key, transfromed_img, meta_data
+        transfromed_img, meta_data = cached
+        # image before normalization, to use it in visualization
+        mean = torch.tensor(self.normalize_img.mean)[:,None,None]
+        std = torch.tensor(self.normalize_img.std)[:,None,None]
+        meta_data['ori_img'] = transfromed_img * std + mean
+        return self.get_img_key(idx), transfromed_img, meta_data
+
+    def process_item(self, idx):
 
-        img = self.get_image(idx)
         img_key = self.get_img_key(idx)
         annotations = self.get_annotations(idx)
 
@@ -249,19 +360,37 @@ class HandMeshTSVDataset(object):
         # Get augmentation parameters
         flip,pn,rot,sc = self.augm_params()
 
+        # Decode the image, at a reduced resolution if the bounding box allows it
+        factor = self.get_decode_factor(idx, sc*scale)
+        img = self.get_image(idx, factor)
+        img_center, img_scale = reduced_box(center, sc*scale, factor)
+
         # Process image
-        img = self.rgb_processing(img, center, sc*scale, rot, flip, pn)
-        img = torch.from_numpy(img).float()
-        # Store image before normalization to use it in visualization
-        transfromed_img = self.normalize_img(img)
+        if self.device_augment:
+            # rotation, flip, noise and normalization run batched on the training device
+            transfromed_img = self.rgb_canvas(img, img_center, img_scale)
+        elif self.fused_normalize:
+            img, transfromed_img = self.rgb_processing_fused(img, img_center, img_scale, rot, flip, pn)
+            img = torch.from_numpy(img)
+            transfromed_img = torch.from_numpy(transfromed_img)
+        else:
+            img = self.rgb_processing(img, img_center, img_scale, rot, flip, pn)
+            img = torch.from_numpy(img).float()
+            # Store image before normalization to use it in visualization
+            transfromed_img = self.normalize_img(img)
 
         # normalize 3d pose by aligning the wrist as the root (at origin)
         root_coord = joints_3d[self.root_index,:-1]
         joints_3d[:,:-1] = joints_3d[:,:-1] - root_coord[None,:]
         # 3d pose augmentation (random flip + rotation, consistent to image and SMPL)
-        joints_3d_transformed = self.j3d_processing(joints_3d.copy(), rot, flip)
-        # 2d pose augmentation
-        joints_2d_transformed = self.j2d_processing(joints_2d.copy(), center, sc*scale, rot, flip)
+        if self.device_augment:
+            # transformed by BatchAugmentation, together with the image
+            joints_3d_transformed = joints_3d.astype('float32')
+            joints_2d_transformed = joints_2d.astype('float32')
+        else:
+            joints_3d_transformed = self.j3d_processing(joints_3d.copy(), rot, flip)
+            # 2d pose augmentation
+            joints_2d_transformed = self.j2d_processing(joints_2d.copy(), center, sc*scale, rot, flip)
         
         ###################################
         # Masking percantage
@@ -289,7 +418,11 @@ class HandMeshTSVDataset(object):
         mvm_mask = torch.from_numpy(mvm_mask).float()
 
         meta_data = {}
-        meta_data['ori_img'] = img
+        if self.device_augment:
+            meta_data['augm_params'] = {'flip': int(flip), 'rot': float(rot),
+                                        'pn': torch.from_numpy(np.asarray(pn)).float()}
+        else:
+            meta_data['ori_img'] = img
         meta_data['pose'] = torch.from_numpy(self.pose_processing(pose, rot, flip)).float()
         meta_data['betas'] = torch.from_numpy(betas).float()
         meta_data['joints_3d'] = torch.from_numpy(joints_3d_transformed).float()
@@ -311,7 +444,7 @@ class HandMeshTSVDataset(object):
 class HandMeshTSVYamlDataset(HandMeshTSVDataset):
     """ TSVDataset taking a Yaml file for easy function call
     """
-    def __init__(self, args, yaml_file, is_train=True, cv2_output=False, scale_factor=1):
+    def __init__(self, args, yaml_file, is_train=True, cv2_output=False, scale_factor=1, **kwargs):
         self.cfg = load_from_yaml_file(yaml_file)
         self.is_composite = self.cfg.get('composite', False)
         self.root = op.dirname(yaml_file)
@@ -329,6 +462,11 @@ class HandMeshTSVYamlDataset(HandMeshTSVDataset):
             label_file = self.cfg.get('label', None)
             linelist_file = find_file_path_in_yaml(self.cfg.get('linelist', None),
                                                 self.root)
+        # optional pre-parsed labels, see src/tools/run_compile_label_store.py
+        label_store = self.cfg.get('label_store', None)
+        if label_store is not None:
+            label_store = op.join(self.root, label_store)
 
         super(HandMeshTSVYamlDataset, self).__init__(
-            args, img_file, label_file, hw_file, linelist_file, is_train, cv2_output=cv2_output, scale_factor=scale_factor)
+            args, img_file, label_file, hw_file, linelist_file, is_train, cv2_output=cv2_output, scale_factor=scale_factor,
+            label_store=label_store, **kwargs)
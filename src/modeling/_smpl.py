@@ -15,6 +15,7 @@ except ImportError:
     import pickle
 
 from src.utils.geometric_layers import rodrigues
+from src.utils.miscellaneous import autocast_disabled
 import src.modeling.data.config as cfg
 
 class SMPL(nn.Module):
@@ -140,19 +141,23 @@ class SMPL(nn.Module):
 class SparseMM(torch.autograd.Function):
     """Redefine sparse @ dense matrix multiplication to enable backpropagation.
     The builtin matrix multiplication operation does not support backpropagation in some cases.
+    The product always runs in float32, also under autocast.
     """
     @staticmethod
     def forward(ctx, sparse, dense):
         ctx.req_grad = dense.requires_grad
+        ctx.dense_dtype = dense.dtype
         ctx.save_for_backward(sparse)
-        return torch.matmul(sparse, dense)
+        with autocast_disabled(dense):
+            return torch.matmul(sparse, dense.float())
 
     @staticmethod
     def backward(ctx, grad_output):
         grad_input = None
         sparse, = ctx.saved_tensors
         if ctx.req_grad:
-            grad_input = torch.matmul(sparse.t(), grad_output)
+            with autocast_disabled(grad_output):
+                grad_input = torch.matmul(sparse.t(), grad_output.float()).to(ctx.dense_dtype)
         return None, grad_input
 
 def spmm(sparse, dense):
@@ -6,11 +6,15 @@ Licensed under the MIT license.
 
 import torch
 import src.modeling.data.config as cfg
+from src.utils.miscellaneous import autocast_disabled
 
 class Graphormer_Body_Network(torch.nn.Module):
     '''
     End-to-end Graphormer network for human pose and mesh reconstruction from a single image.
     '''
+    # also for networks pickled before the option existed
+    freeze_backbone = False
+
     def __init__(self, args, config, backbone, trans_encoder, mesh_sampler):
         super(Graphormer_Body_Network, self).__init__()
         self.config = config
@@ -23,23 +27,37 @@ class Graphormer_Body_Network(torch.nn.Module):
         self.cam_param_fc2 = torch.nn.Linear(431, 250)
         self.cam_param_fc3 = torch.nn.Linear(250, 3)
         self.grid_feat_dim = torch.nn.Linear(1024, 2051)
+        # a frozen backbone is not trained, its features may come from a cache
+        self.freeze_backbone = getattr(args, 'freeze_backbone', False)
+        if self.freeze_backbone:
+            self.backbone.requires_grad_(False)
+
+    def train(self, mode=True):
+        super(Graphormer_Body_Network, self).train(mode)
+        if self.freeze_backbone:
+            # keep the batch norm statistics of the frozen backbone
+            self.backbone.eval()
+        return self
 
 
-    def forward(self, images, smpl, mesh_sampler, meta_masks=None, is_train=False):
+    def forward(self, images, smpl, mesh_sampler, meta_masks=None, is_train=False, backbone_feats=None):
         batch_size = images.size(0)
         # Generate T-pose template mesh
         template_pose = torch.zeros((1,72))
         template_pose[:,0] = 3.1416 # Rectify "upside down" reference mesh in global coord
-        template_pose = template_pose.cuda(self.config.device)
-        template_betas = torch.zeros((1,10)).cuda(self.config.device)
-        template_vertices = smpl(template_pose, template_betas)
+        template_pose = template_pose.to(images.device)
+        template_betas = torch.zeros((1,10)).to(images.device)
+        # the template mesh stays in float32 under autocast
+        with autocast_disabled(images):
+            template_vertices = smpl(template_pose, template_betas)
 
         # template mesh simplification
         template_vertices_sub = mesh_sampler.downsample(template_vertices)
         template_vertices_sub2 = mesh_sampler.downsample(template_vertices_sub, n1=1, n2=2)
 
         # template mesh-to-joint regression 
-        template_3d_joints = smpl.get_h36m_joints(template_vertices)
+        with autocast_disabled(images):
+            template_3d_joints = smpl.get_h36m_joints(template_vertices)
         template_pelvis = template_3d_joints[:,cfg.H36M_J17_NAME.index('Pelvis'),:]
         template_3d_joints = template_3d_joints[:,cfg.H36M_J17_TO_J14,:]
         num_joints = template_3d_joints.shape[1]
@@ -52,8 +70,15 @@ class Graphormer_Body_Network(torch.nn.Module):
         ref_vertices = torch.cat([template_3d_joints, template_vertices_sub2],dim=1)
         ref_vertices = ref_vertices.expand(batch_size, -1, -1)
 
-        # extract grid features and global image features using a CNN backbone
-        image_feat, grid_feat = self.backbone(images)
+        # extract grid features and global image features using a CNN backbone,
+        # unless given, e.g. from the feature cache of a frozen backbone
+        if backbone_feats is not None:
+            image_feat, grid_feat = backbone_feats
+        elif self.freeze_backbone:
+            with torch.no_grad():
+                image_feat, grid_feat = self.backbone(images)
+        else:
+            image_feat, grid_feat = self.backbone(images)
         # concatinate image feat and 3d mesh template
         image_feat = image_feat.view(batch_size, 1, 2048).expand(-1, ref_vertices.shape[-2], -1)
         # process grid features
@@ -69,7 +94,7 @@ class Graphormer_Body_Network(torch.nn.Module):
             # apply mask vertex/joint modeling
             # meta_masks is a tensor of all the masks, randomly generated in dataloader
             # we pre-define a [MASK] token, which is a floating-value vector with 0.01s
-            special_token = torch.ones_like(features[:,:-49,:]).cuda()*0.01
+            special_token = torch.ones_like(features[:,:-49,:])*0.01
             features[:,:-49,:] = features[:,:-49,:]*meta_masks + special_token*(1-meta_masks)          
 
         # forward pass
@@ -14,6 +14,7 @@ import torch
 from torch import nn
 from .modeling_bert import BertPreTrainedModel, BertEmbeddings, BertPooler, BertIntermediate, BertOutput, BertSelfOutput
 import src.modeling.data.config as cfg
+from src.utils.miscellaneous import reentrant_checkpoint
 from src.modeling._gcnn import GraphConvolution, GraphResBlock
 from .modeling_utils import prune_linear_layer
 LayerNormClass = torch.nn.LayerNorm
@@ -169,6 +170,8 @@ class GraphormerEncoder(nn.Module):
         self.output_attentions = config.output_attentions
         self.output_hidden_states = config.output_hidden_states
         self.layer = nn.ModuleList([GraphormerLayer(config) for _ in range(config.num_hidden_layers)])
+        # recompute the activations of each layer in the backward pass
+        self.checkpoint_layers = getattr(config, 'checkpoint_layers', False)
 
     def forward(self, hidden_states, attention_mask, head_mask=None,
                 encoder_history_states=None):
@@ -179,9 +182,14 @@ class GraphormerEncoder(nn.Module):
                 all_hidden_states = all_hidden_states + (hidden_states,)
 
             history_state = None if encoder_history_states is None else encoder_history_states[i]
-            layer_outputs = layer_module(
-                    hidden_states, attention_mask, head_mask[i],
-                    history_state)
+            if self.training and self.checkpoint_layers and torch.is_grad_enabled():
+                layer_outputs = reentrant_checkpoint(layer_module,
+                        hidden_states, attention_mask, head_mask[i],
+                        history_state)
+            else:
+                layer_outputs = layer_module(
+                        hidden_states, attention_mask, head_mask[i],
+                        history_state)
             hidden_states = layer_outputs[0]
 
             if self.output_attentions:
@@ -203,9 +211,12 @@ class EncoderBlock(BertPreTrainedModel):
     def __init__(self, config):
         super(EncoderBlock, self).__init__(config)
         self.config = config
-        self.embeddings = BertEmbeddings(config)
+        # the token embeddings and the pooler of BERT are never used in forward
+        if not getattr(config, 'skip_unused_modules', False):
+            self.embeddings = BertEmbeddings(config)
         self.encoder = GraphormerEncoder(config)
-        self.pooler = BertPooler(config)
+        if not getattr(config, 'skip_unused_modules', False):
+            self.pooler = BertPooler(config)
         self.position_embeddings = nn.Embedding(config.max_position_embeddings, config.hidden_size)
         self.img_dim = config.img_feature_dim 
 
@@ -234,7 +245,7 @@ class EncoderBlock(BertPreTrainedModel):
 
         batch_size = len(img_feats)
         seq_length = len(img_feats[0])
-        input_ids = torch.zeros([batch_size, seq_length],dtype=torch.long).cuda()
+        input_ids = torch.zeros([batch_size, seq_length],dtype=torch.long, device=img_feats.device)
 
         if position_ids is None:
             position_ids = torch.arange(seq_length, dtype=torch.long, device=input_ids.device)
@@ -256,7 +267,8 @@ class EncoderBlock(BertPreTrainedModel):
             raise NotImplementedError
 
         extended_attention_mask = extended_attention_mask.to(dtype=next(self.parameters()).dtype) # fp16 compatibility
-        extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
+        # the most negative value of the dtype, so that masked scores stay finite in fp16
+        extended_attention_mask = (1.0 - extended_attention_mask) * torch.finfo(extended_attention_mask.dtype).min
 
         if head_mask is not None:
             if head_mask.dim() == 1:
@@ -22,10 +22,57 @@ import torch
 import torch.nn as nn
 import torch._utils
 import torch.nn.functional as F
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 import code
+from src.utils.checkpoint import load_weights
+from src.utils.miscellaneous import reentrant_checkpoint
 BN_MOMENTUM = 0.1
 logger = logging.getLogger(__name__)
 
+# conv and batch norm attributes of the blocks and of the stem
+CONV_BN_PAIRS = [('conv1', 'bn1'), ('conv2', 'bn2'), ('conv3', 'bn3')]
+
+
+def fold_batchnorm(model):
+    """Fold every BatchNorm2d that follows a Conv2d into the conv, for
+    inference. The batch norm is replaced by an identity; model must be
+    in eval mode, as the running statistics are used."""
+    assert not model.training, 'batch norm can only be folded in eval mode'
+    for module in list(model.modules()):
+        if isinstance(module, nn.Sequential):
+            # transition, fuse, downsample and head layers
+            for i in range(len(module) - 1):
+                if isinstance(module[i], nn.Conv2d) and isinstance(module[i+1], nn.BatchNorm2d):
+                    module[i] = fuse_conv_bn_eval(module[i], module[i+1])
+                    module[i+1] = nn.Identity()
+        for conv_name, bn_name in CONV_BN_PAIRS:
+            conv, bn = getattr(module, conv_name, None), getattr(module, bn_name, None)
+            if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+                setattr(module, conv_name, fuse_conv_bn_eval(conv, bn))
+                setattr(module, bn_name, nn.Identity())
+    return model
+
+
+def keep_bn_stats_on_recompute(module):
+    """Function running module on a list of tensors, for reentrant_checkpoint(). The
+    backward pass runs it a second time; that run leaves the BatchNorm running
+    statistics as the first run left them."""
+    buffers = [buf for m in module.modules() if isinstance(m, nn.BatchNorm2d)
+               for buf in (m.running_mean, m.running_var, m.num_batches_tracked) if buf is not None]
+    state = {'recompute': False}
+
+    def run(*xs):
+        if not state['recompute']:
+            state['recompute'] = True
+            return tuple(module(list(xs)))
+        saved = [buf.clone() for buf in buffers]
+        outputs = tuple(module(list(xs)))
+        with torch.no_grad():
+            for buf, value in zip(buffers, saved):
+                buf.copy_(value)
+        return outputs
+    return run
+
 
 def conv3x3(in_planes, out_planes, stride=1):
     """3x3 convolution with padding"""
@@ -256,8 +303,14 @@ blocks_dict = {
 
 class HighResolutionNet(nn.Module):
 
-    def __init__(self, cfg, **kwargs):
+    def __init__(self, cfg, checkpoint_stages=(), with_classifier=True, grid_only=False, **kwargs):
         super(HighResolutionNet, self).__init__()
+        # only return the grid features, without the global image feature
+        self.grid_only = grid_only
+        # stages whose activations are recomputed in the backward pass
+        self.checkpoint_stages = set(checkpoint_stages)
+        # set by optimize_for_inference
+        self.channels_last = False
 
         self.conv1 = nn.Conv2d(3, 64, kernel_size=3, stride=2, padding=1,
                                bias=False)
@@ -306,11 +359,13 @@ class HighResolutionNet(nn.Module):
 
         # Classification Head
         self.incre_modules, self.downsamp_modules, \
-            self.final_layer = self._make_head(pre_stage_channels)
+            self.final_layer = self._make_head(pre_stage_channels, with_final_layer=not grid_only)
 
-        self.classifier = nn.Linear(2048, 1000)
+        # the ImageNet classifier is not used by forward, only kept for its weights
+        if with_classifier and not grid_only:
+            self.classifier = nn.Linear(2048, 1000)
 
-    def _make_head(self, pre_stage_channels):
+    def _make_head(self, pre_stage_channels, with_final_layer=True):
         head_block = Bottleneck
         head_channels = [32, 64, 128, 256]
 
@@ -345,6 +400,9 @@ class HighResolutionNet(nn.Module):
             downsamp_modules.append(downsamp_module)
         downsamp_modules = nn.ModuleList(downsamp_modules)
 
+        if not with_final_layer:
+            return incre_modules, downsamp_modules, None
+
         final_layer = nn.Sequential(
             nn.Conv2d(
                 in_channels=head_channels[3] * head_block.expansion,
@@ -442,7 +500,27 @@ class HighResolutionNet(nn.Module):
 
         return nn.Sequential(*modules), num_inchannels
 
-    def forward(self, x):
+    def run_stage(self, name, x_list):
+        stage = getattr(self, name)
+        if self.training and name in self.checkpoint_stages and torch.is_grad_enabled():
+            # keep_bn_stats_on_recompute needs the complete recomputation of the reentrant form
+            return list(reentrant_checkpoint(keep_bn_stats_on_recompute(stage), *x_list))
+        return stage(x_list)
+
+    def optimize_for_inference(self, channels_last=True):
+        """Fold the batch norms into the convs and, with channels_last, run the
+        convs in NHWC memory format. The network can not be trained afterwards."""
+        self.eval()
+        fold_batchnorm(self)
+        if channels_last:
+            self.to(memory_format=torch.channels_last)
+            self.channels_last = True
+        return self
+
+    def forward_grid(self, x):
+        """Grid features (B,1024,H/32,W/32) at the end of the downsampling head."""
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
         x = self.conv1(x)
         x = self.bn1(x)
         x = self.relu(x)
@@ -457,7 +535,7 @@ class HighResolutionNet(nn.Module):
                 x_list.append(self.transition1[i](x))
             else:
                 x_list.append(x)
-        y_list = self.stage2(x_list)
+        y_list = self.run_stage('stage2', x_list)
 
         x_list = []
         for i in range(self.stage3_cfg['NUM_BRANCHES']):
@@ -465,7 +543,7 @@ class HighResolutionNet(nn.Module):
                 x_list.append(self.transition2[i](y_list[-1]))
             else:
                 x_list.append(y_list[i])
-        y_list = self.stage3(x_list)
+        y_list = self.run_stage('stage3', x_list)
 
         x_list = []
         for i in range(self.stage4_cfg['NUM_BRANCHES']):
@@ -473,13 +551,19 @@ class HighResolutionNet(nn.Module):
                 x_list.append(self.transition3[i](y_list[-1]))
             else:
                 x_list.append(y_list[i])
-        y_list = self.stage4(x_list)
+        y_list = self.run_stage('stage4', x_list)
 
         # Classification Head
         y = self.incre_modules[0](y_list[0])
         for i in range(len(self.downsamp_modules)):
             y = self.incre_modules[i+1](y_list[i+1]) + \
                         self.downsamp_modules[i](y)
+        return y
+
+    def forward(self, x):
+        y = self.forward_grid(x)
+        if self.grid_only:
+            return y
 
         yy = self.final_layer(y)
 
@@ -504,18 +588,10 @@ class HighResolutionNet(nn.Module):
                 nn.init.constant_(m.weight, 1)
                 nn.init.constant_(m.bias, 0)
         if os.path.isfile(pretrained):
-            pretrained_dict = torch.load(pretrained)
             logger.info('=> loading pretrained model {}'.format(pretrained))
             print('=> loading pretrained model {}'.format(pretrained))
-            model_dict = self.state_dict()
-            pretrained_dict = {k: v for k, v in pretrained_dict.items()
-                               if k in model_dict.keys()}
-            # for k, _ in pretrained_dict.items():
-            #     logger.info(
-            #         '=> loading {} pretrained model {}'.format(k, pretrained))
-            #     print('=> loading {} pretrained model {}'.format(k, pretrained))
-            model_dict.update(pretrained_dict)
-            self.load_state_dict(model_dict)
+            # only the weights of this network, e.g. without the classifier
+            load_weights(self, pretrained)
         # code.interact(local=locals())
 
 def get_cls_net_gridfeat(config, pretrained, **kwargs):
@@ -0,0 +1,108 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT license.
+
+Check of the distributed metric reduction on CPU. Several processes with the
+gloo backend each evaluate their part of a synthetic dataset, as given by the
+distributed sampler of the evaluation data loaders including its padding, and
+the synchronized mPVE/mPJPE/PA-MPJPE must equal the averages over all samples
+computed in a single process.
+"""
+
+from __future__ import absolute_import, division, print_function
+import argparse
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from src.datasets.build import ResumableDistributedSampler, make_batch_data_sampler, num_unpadded_samples
+from src.utils.metric_logger import AverageMeter, DistributedMetrics
+
+
+NAMES = ['mPVE', 'mPJPE', 'PAmPJPE']
+
+
+class SyntheticErrors(torch.utils.data.Dataset):
+    """Per-sample errors of a synthetic dataset; samples without smpl or 3d
+    joints have no mPVE or mPJPE."""
+    def __init__(self, num_samples, seed):
+        rng = np.random.RandomState(seed)
+        self.errors = {name: rng.gamma(2.0, 30.0, size=num_samples) for name in NAMES}
+        self.has_smpl = rng.uniform(size=num_samples) < 0.8
+        self.has_3d_joints = rng.uniform(size=num_samples) < 0.7
+
+    def __len__(self):
+        return len(self.has_smpl)
+
+    def __getitem__(self, row):
+        return row
+
+    def expected(self):
+        return {'mPVE': self.errors['mPVE'][self.has_smpl],
+                'mPJPE': self.errors['mPJPE'][self.has_3d_joints],
+                'PAmPJPE': self.errors['PAmPJPE']}
+
+
+def run_rank(rank, args, results):
+    dist.init_process_group('gloo', init_method='tcp://127.0.0.1:{}'.format(args.port),
+                            world_size=args.world_size, rank=rank)
+    dataset = SyntheticErrors(args.num_samples, args.seed)
+    sampler = ResumableDistributedSampler(dataset, num_replicas=args.world_size, rank=rank, shuffle=False)
+    data_loader = torch.utils.data.DataLoader(
+        dataset, batch_sampler=make_batch_data_sampler(sampler, args.batch_size))
+    # the same masking as run_validate
+    num_samples = num_unpadded_samples(data_loader)
+    num_seen = 0
+    metrics = DistributedMetrics(NAMES)
+    single = AverageMeter()
+    for rows in data_loader:
+        rows = rows.numpy()
+        is_sample = np.arange(num_seen, num_seen + len(rows)) < num_samples
+        num_seen += len(rows)
+        has_smpl = dataset.has_smpl[rows] & is_sample
+        has_3d_joints = dataset.has_3d_joints[rows] & is_sample
+        metrics.update('mPVE', dataset.errors['mPVE'][rows][has_smpl])
+        metrics.update('mPJPE', dataset.errors['mPJPE'][rows][has_3d_joints])
+        metrics.update('PAmPJPE', dataset.errors['PAmPJPE'][rows][is_sample])
+        errors = dataset.errors['mPVE'][rows][has_smpl]
+        if len(errors) > 0:
+            single.update(float(np.mean(errors)), len(errors))
+    single.sync()
+    metrics.sync()
+    results[rank] = {name: (metrics[name].avg, metrics[name].count) for name in NAMES}
+    results[rank]['meter_sync'] = (single.avg, single.count)
+    results[rank]['padded'] = len(sampler) > num_samples
+    dist.destroy_process_group()
+
+
+def main(args):
+    errors = SyntheticErrors(args.num_samples, args.seed).expected()
+    expected = {name: (float(np.mean(errors[name])), len(errors[name])) for name in NAMES}
+    expected['meter_sync'] = expected['mPVE']
+    results = mp.Manager().dict()
+    mp.spawn(run_rank, args=(args, results), nprocs=args.world_size, join=True)
+    for rank in range(args.world_size):
+        for name, (avg, count) in expected.items():
+            got_avg, got_count = results[rank][name]
+            assert got_count == count, (rank, name, got_count, count)
+            assert abs(got_avg - avg) < 1e-6 * max(1.0, abs(avg)), (rank, name, got_avg, avg)
+    for name in NAMES:
+        print('{}: {:.6f} over {} samples on all {} ranks'.format(
+            name, expected[name][0], expected[name][1], args.world_size))
+    print('padded ranks: {}'.format([rank for rank in range(args.world_size) if results[rank]['padded']]))
+    print('ok')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--world_size", default=3, type=int)
+    # not a multiple of world_size, so that the sampler pads
+    parser.add_argument("--num_samples", default=1001, type=int)
+    parser.add_argument("--batch_size", default=32, type=int)
+    parser.add_argument("--seed", default=88, type=int)
+    parser.add_argument("--port", default=29533, type=int)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,39 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT license.
+
+Compile the json labels of a dataset yaml into a memory-mapped label store.
+Add "label_store: <output>" to the yaml afterwards to let the datasets use it.
+"""
+
+from __future__ import absolute_import, division, print_function
+import argparse
+import os.path as op
+from src.utils.tsv_file import TSVFile, CompositeTSVFile
+from src.utils.tsv_file_ops import load_from_yaml_file, find_file_path_in_yaml
+from src.utils.label_store import compile_label_store
+
+
+def main(args):
+    cfg = load_from_yaml_file(args.yaml_file)
+    root = op.dirname(args.yaml_file)
+    if cfg.get('composite', False):
+        linelist_file = find_file_path_in_yaml(cfg.get('linelist', None), root)
+        label_tsv = CompositeTSVFile(cfg['label'], linelist_file, root=root)
+    else:
+        label_tsv = TSVFile(find_file_path_in_yaml(cfg['label'], root))
+
+    output = args.output if args.output else op.join(root, 'label_store')
+    compile_label_store(label_tsv, output)
+    print('compiled labels to {}'.format(output))
+    print('add "label_store: {}" to {}'.format(op.relpath(output, root), args.yaml_file))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compile json labels into a label store")
+    parser.add_argument("--yaml_file", type=str, required=True,
+                        help="Yaml file of the dataset, e.g. datasets/freihand/train.yaml")
+    parser.add_argument("--output", default=None, type=str, required=False,
+                        help="Output directory. Default: label_store next to the yaml file.")
+    args = parser.parse_args()
+    main(args)
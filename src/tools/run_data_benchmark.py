@@ -0,0 +1,274 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT license.
+
+Benchmark of the data pipeline on a synthetic TSV dataset.
+It compares the per-sample cost of MeshTSVDataset.__getitem__ with the
+optional fast paths, and checks that they agree with the default path.
+"""
+
+from __future__ import absolute_import, division, print_function
+import argparse
+import os
+import os.path as op
+import json
+import time
+import base64
+import tempfile
+import tracemalloc
+import numpy as np
+import cv2
+import torch
+from src.utils.tsv_file import TSVFile, CompositeTSVFile
+from src.utils.tsv_file_ops import tsv_writer
+from src.utils.image_ops import crop, crop_warp, transform, transform_pts
+from src.datasets.human_mesh_tsv import MeshTSVYamlDataset
+from src.datasets.batch_augment import BatchAugmentation
+
+
+def synthetic_image(height, width, rng):
+    # smooth content plus noise, so that jpeg sizes are realistic
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    img = np.stack([127 + 100*np.sin(x/37.0 + c) * np.cos(y/53.0 - c) for c in range(3)], axis=-1)
+    img += rng.normal(0, 10, img.shape)
+    return np.clip(img, 0, 255).astype(np.uint8)
+
+
+def synthetic_label(height, width, rng):
+    center = [width/2.0 + rng.uniform(-0.1, 0.1)*width, height/2.0 + rng.uniform(-0.1, 0.1)*height]
+    scale = rng.uniform(0.3, 0.6) * min(height, width) / 200.0
+    box = 200.0 * scale
+    joints_2d = np.concatenate([np.asarray(center) + rng.uniform(-box/2, box/2, (24, 2)),
+                                np.ones((24, 1))], axis=1)
+    joints_3d = np.concatenate([rng.uniform(-1, 1, (24, 3)), np.ones((24, 1))], axis=1)
+    return [{'center': center, 'scale': scale,
+             '2d_joints': joints_2d.tolist(), '3d_joints': joints_3d.tolist(),
+             'pose': rng.uniform(-0.3, 0.3, 72).tolist(), 'betas': rng.uniform(-1, 1, 10).tolist(),
+             'has_2d_joints': 1, 'has_3d_joints': 1, 'has_smpl': 1, 'gender': 'm'}]
+
+
+def make_synthetic_dataset(out_dir, num_samples, height, width, seed=0):
+    rng = np.random.RandomState(seed)
+    imgs, labels, hws = [], [], []
+    for i in range(num_samples):
+        key = 'img_{:06d}'.format(i)
+        img = synthetic_image(height, width, rng)
+        _, buf = cv2.imencode('.jpg', img)
+        imgs.append([key, base64.b64encode(buf.tobytes())])
+        labels.append([key, json.dumps(synthetic_label(height, width, rng))])
+        hws.append([key, json.dumps([{'height': height, 'width': width}])])
+    tsv_writer(imgs, op.join(out_dir, 'img.tsv'))
+    tsv_writer(labels, op.join(out_dir, 'label.tsv'))
+    tsv_writer(hws, op.join(out_dir, 'hw.tsv'))
+    yaml_file = op.join(out_dir, 'test.yaml')
+    with open(yaml_file, 'w') as fp:
+        fp.write('img: img.tsv\nlabel: label.tsv\nhw: hw.tsv\n')
+    return yaml_file
+
+
+def bench_crop(args):
+    rng = np.random.RandomState(args.seed)
+    img = synthetic_image(args.height, args.width, rng)
+    res = [224, 224]
+    params = [(synthetic_label(args.height, args.width, rng)[0], rot)
+              for rot in rng.choice([0, 0, 0, 30, -60], args.num_samples)]
+    for name, func, src in [('crop', crop, img), ('crop_warp', crop_warp, img)]:
+        start = time.time()
+        for label, rot in params:
+            func(src, label['center'], label['scale'], res, rot=rot)
+        print('{:>12s}: {:8.3f} ms/sample'.format(name, 1000*(time.time()-start)/len(params)))
+    diffs = []
+    for label, rot in params:
+        ref = crop(img, label['center'], label['scale'], res, rot=rot)
+        new = crop_warp(img, label['center'], label['scale'], res, rot=rot).astype(np.float64)
+        # ignore the border, where the padded canvas and the warp differ by design
+        diffs.append(np.abs(ref - new)[8:-8, 8:-8].mean())
+    print('crop_warp vs crop: mean abs pixel difference {:.3f} (max over samples {:.3f})'.format(
+          np.mean(diffs), np.max(diffs)))
+
+
+def bench_keypoints(args):
+    rng = np.random.RandomState(args.seed)
+    params = [(synthetic_label(args.height, args.width, rng)[0], rot)
+              for rot in rng.choice([0, 0, 0, 30, -60], args.num_samples)]
+    res = [224, 224]
+    start = time.time()
+    ref = []
+    for label, rot in params:
+        kp = np.asarray(label['2d_joints'])
+        ref.append(np.stack([transform(kp[i,0:2]+1, label['center'], label['scale'], res, rot=rot)
+                             for i in range(kp.shape[0])]))
+    print('{:>12s}: {:8.3f} ms/sample'.format('transform', 1000*(time.time()-start)/len(params)))
+    start = time.time()
+    new = []
+    for label, rot in params:
+        kp = np.asarray(label['2d_joints'])
+        new.append(transform_pts(kp[:,0:2]+1, label['center'], label['scale'], res, rot=rot))
+    print('{:>12s}: {:8.3f} ms/sample'.format('transform_pts', 1000*(time.time()-start)/len(params)))
+    mismatch = sum(int(np.any(a != b)) for a, b in zip(ref, new))
+    print('transform_pts vs transform: {} of {} samples differ'.format(mismatch, len(params)))
+
+
+def dataset_variants():
+    # name, dataset options, variant to compare the outputs with
+    return [('default', {}, 'default'),
+            ('fast_crop', {'fast_crop': True}, 'default'),
+            ('fused', {'fused_normalize': True}, 'fast_crop'),
+            ('reduced', {'fast_crop': True, 'reduced_decode': True}, 'fast_crop')]
+
+
+def bench_dataset(args):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        yaml_file = make_synthetic_dataset(tmp_dir, args.num_samples, args.height, args.width, args.seed)
+        outputs = {}
+        for name, options, _ in dataset_variants():
+            dataset = MeshTSVYamlDataset(yaml_file, is_train=args.is_train, **options)
+            np.random.seed(args.seed)
+            dataset[0]  # warm up
+            np.random.seed(args.seed)
+            start = time.time()
+            outputs[name] = [dataset[i] for i in range(len(dataset))]
+            print('{:>12s}: {:8.3f} ms/sample'.format(name, 1000*(time.time()-start)/len(dataset)))
+        for name, _, ref_name in dataset_variants():
+            ref, out = outputs[ref_name], outputs[name]
+            img_diff = np.mean([(a[1] - b[1]).abs().mean().item() for a, b in zip(ref, out)])
+            j2d_diff = np.mean([(a[2]['joints_2d'] - b[2]['joints_2d']).abs().max().item() for a, b in zip(ref, out)])
+            print('{:>12s}: vs {}, mean abs image difference {:.4f}, max 2d joint difference {:.4f}'.format(
+                  name, ref_name, img_diff, j2d_diff))
+
+
+def bench_augment(args):
+    """Throughput of the worker-based augmentation against BatchAugmentation."""
+    device = torch.device(args.device)
+    batch_augment = BatchAugmentation()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        yaml_file = make_synthetic_dataset(tmp_dir, args.num_samples, args.height, args.width, args.seed)
+        for name, options in [('workers', {'fast_crop': True}),
+                              ('fused', {'fused_normalize': True}),
+                              ('device', {'device_augment': True})]:
+            dataset = MeshTSVYamlDataset(yaml_file, is_train=True, **options)
+            loader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size,
+                                                 num_workers=args.num_workers, shuffle=False)
+            start = time.time()
+            for _, images, annotations in loader:
+                images = images.to(device)
+                if options.get('device_augment', False):
+                    images = batch_augment(images, annotations)
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            print('{:>12s}: {:8.1f} images/s'.format(name, len(dataset)/(time.time()-start)))
+
+        # same augmentation parameters on both paths, one sample at a time
+        ref_dataset = MeshTSVYamlDataset(yaml_file, is_train=True, fast_crop=True)
+        dataset = MeshTSVYamlDataset(yaml_file, is_train=True, device_augment=True)
+        img_diff, j2d_diff, j3d_diff = [], [], []
+        for i in range(len(dataset)):
+            np.random.seed(args.seed + i)
+            _, ref_img, ref_meta = ref_dataset[i]
+            np.random.seed(args.seed + i)
+            _, canvas, meta = dataset[i]
+            batch = torch.utils.data.dataloader.default_collate([meta])
+            img = batch_augment(canvas[None].to(device), batch)[0].cpu()
+            img_diff.append((img - ref_img).abs()[:, 8:-8, 8:-8].mean().item())
+            j2d_diff.append((batch['joints_2d'][0].cpu() - ref_meta['joints_2d']).abs().max().item())
+            j3d_diff.append((batch['joints_3d'][0].cpu() - ref_meta['joints_3d']).abs().max().item())
+        print('device vs workers: mean abs image difference {:.4f}, max 2d joint difference {:.4f}, '
+              'max 3d joint difference {:.6f}'.format(np.mean(img_diff), np.max(j2d_diff), np.max(j3d_diff)))
+
+
+def make_synthetic_composite(out_dir, num_shards, rows_per_shard, seed=0):
+    rng = np.random.RandomState(seed)
+    file_list, seq = [], []
+    for i in range(num_shards):
+        name = 'shard_{:04d}.hw.tsv'.format(i)
+        tsv_writer([['img_{:06d}'.format(j), json.dumps([{'height': 1080, 'width': 1920}])]
+                    for j in range(rows_per_shard)], op.join(out_dir, name))
+        file_list.append(name)
+        seq.extend([(i, j) for j in range(rows_per_shard)])
+    seq = [seq[k] for k in rng.permutation(len(seq))]
+    with open(op.join(out_dir, 'hw.tsvs.txt'), 'w') as fp:
+        fp.write('\n'.join(file_list) + '\n')
+    with open(op.join(out_dir, 'linelist.tsv'), 'w') as fp:
+        fp.write(''.join('{}\t{}\n'.format(i, j) for i, j in seq))
+    return op.join(out_dir, 'hw.tsvs.txt'), op.join(out_dir, 'linelist.tsv')
+
+
+class LegacyCompositeTSVFile(object):
+    """The previous CompositeTSVFile: python list seq, every shard opened up front."""
+    def __init__(self, file_list, seq_file, root='.'):
+        with open(file_list, 'r') as fp:
+            self.file_list = [line.strip() for line in fp if line.strip()]
+        self.seq = []
+        with open(seq_file, 'r') as fp:
+            for line in fp:
+                parts = line.strip().split('\t')
+                self.seq.append([int(parts[0]), int(parts[1])])
+        self.tsvs = [TSVFile(op.join(root, f)) for f in self.file_list]
+
+    def get_key(self, index):
+        idx_source, idx_row = self.seq[index]
+        k = self.tsvs[idx_source].get_key(idx_row)
+        return '_'.join([self.file_list[idx_source], k])
+
+
+def num_open_files():
+    return len(os.listdir('/proc/self/fd')) if op.isdir('/proc/self/fd') else -1
+
+
+def bench_composite(args):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_list, seq_file = make_synthetic_composite(tmp_dir, args.num_shards, args.rows_per_shard,
+                                                       args.seed)
+        # the seq .npy is written on first use, do it before measuring
+        CompositeTSVFile(file_list, seq_file, root=tmp_dir)
+        for name, cls in [('legacy', LegacyCompositeTSVFile), ('composite', CompositeTSVFile)]:
+            open_files = num_open_files()
+            tracemalloc.start()
+            start = time.time()
+            tsv = cls(file_list, seq_file, root=tmp_dir)
+            startup = time.time() - start
+            init_memory = tracemalloc.get_traced_memory()[0]
+            start = time.time()
+            if hasattr(tsv, 'get_keys_bulk'):
+                keys = tsv.get_keys_bulk()
+            else:
+                keys = [tsv.get_key(i) for i in range(len(tsv.seq))]
+            keys_time = time.time() - start
+            memory, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print('{:>12s}: startup {:7.3f} s ({:6.1f} MB), all {} keys {:7.3f} s, '
+                  'memory {:6.1f} MB (peak {:6.1f} MB), {} files left open'.format(
+                  name, startup, init_memory/2**20, len(keys), keys_time,
+                  memory/2**20, peak/2**20, num_open_files() - open_files))
+            del tsv, keys
+
+
+def main(args):
+    benches = {'crop': bench_crop, 'keypoints': bench_keypoints, 'dataset': bench_dataset,
+               'augment': bench_augment, 'composite': bench_composite}
+    for name in args.bench.split(','):
+        print('==> {}'.format(name))
+        benches[name](args)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the data pipeline")
+    parser.add_argument("--bench", default='crop,keypoints,dataset', type=str,
+                        help="Comma separated list of benchmarks: crop, keypoints, dataset, augment, composite")
+    parser.add_argument("--num_samples", default=100, type=int)
+    parser.add_argument("--height", default=1080, type=int)
+    parser.add_argument("--width", default=1920, type=int)
+    parser.add_argument("--is_train", default=False, action='store_true',
+                        help="Use training augmentation in the dataset benchmark.")
+    parser.add_argument("--seed", default=88, type=int)
+    parser.add_argument("--batch_size", default=32, type=int,
+                        help="Batch size of the augment benchmark.")
+    parser.add_argument("--num_workers", default=4, type=int,
+                        help="Dataloader workers of the augment benchmark.")
+    parser.add_argument("--device", default='cpu', type=str,
+                        help="Device of the batched augmentation, e.g. cpu or cuda.")
+    parser.add_argument("--num_shards", default=500, type=int,
+                        help="Shards of the synthetic composite TSV.")
+    parser.add_argument("--rows_per_shard", default=200, type=int)
+    args = parser.parse_args()
+    main(args)
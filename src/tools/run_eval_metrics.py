@@ -0,0 +1,128 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT license.
+
+Offline metrics from an evaluation store written by run_gphmer_bodymesh.py
+with --eval_store. mPVE, mPJPE, PA-MPJPE, PA-MPVE and their per-joint
+breakdowns are recomputed from the stored joints and vertices, in vectorized
+chunks, optionally for the subset of samples whose img_key matches a pattern.
+"""
+
+from __future__ import absolute_import, division, print_function
+import argparse
+import re
+import json
+import numpy as np
+import src.modeling.data.config as cfg
+from src.utils.eval_store import EvalStore
+from src.utils.metric_pampjpe import reconstruction_error_per_joint
+
+
+J14_NAME = [cfg.J24_NAME[i] for i in cfg.J24_TO_J14]
+
+
+def joint_errors(pred, gt):
+    """Per-joint error after aligning the pelvis, the middle of both hips,
+    as mean_per_joint_position_error in run_gphmer_bodymesh.py."""
+    gt_pelvis = (gt[:, 2, :] + gt[:, 3, :]) / 2
+    pred_pelvis = (pred[:, 2, :] + pred[:, 3, :]) / 2
+    return np.sqrt((((pred - pred_pelvis[:, None]) - (gt - gt_pelvis[:, None])) ** 2).sum(axis=-1))
+
+
+def vertex_errors(pred, gt):
+    return np.sqrt(((pred - gt) ** 2).sum(axis=-1))
+
+
+def select_rows(store, key_pattern=None):
+    rows = np.nonzero(store.filled())[0]
+    if key_pattern is not None:
+        pattern = re.compile(key_pattern)
+        rows = np.asarray([r for r in rows if pattern.search(store.keys[r])], dtype=np.int64)
+    return rows
+
+
+def compute_metrics(store, rows, chunk_size=4096, pa_mpve=False):
+    """Per-sample errors of the given rows: {metric: (N,) array} and the
+    per-joint errors {metric: (N, 14) array}, for the samples with labels."""
+    per_sample = {'mPVE': [], 'mPJPE': [], 'PAmPJPE': []}
+    per_joint = {'mPJPE': [], 'PAmPJPE': []}
+    if pa_mpve:
+        per_sample['PAmPVE'] = []
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start+chunk_size]
+        has_smpl = store['has_smpl'][chunk] == 1
+        has_3d = store['has_3d_joints'][chunk] == 1
+
+        smpl_rows = chunk[has_smpl]
+        pred_vertices = np.asarray(store['pred_vertices'][smpl_rows], dtype=np.float64)
+        gt_vertices = np.asarray(store['gt_vertices'][smpl_rows], dtype=np.float64)
+        per_sample['mPVE'].append(vertex_errors(pred_vertices, gt_vertices).mean(axis=-1))
+        if pa_mpve:
+            per_sample['PAmPVE'].append(
+                reconstruction_error_per_joint(pred_vertices, gt_vertices).mean(axis=-1))
+
+        joint_rows = chunk[has_3d]
+        pred_joints = np.asarray(store['pred_3d_joints'][joint_rows], dtype=np.float64)
+        gt_joints = np.asarray(store['gt_3d_joints'][joint_rows], dtype=np.float64)[:, :, :3]
+        errors = joint_errors(pred_joints, gt_joints)
+        pa_errors = reconstruction_error_per_joint(pred_joints, gt_joints)
+        per_joint['mPJPE'].append(errors)
+        per_joint['PAmPJPE'].append(pa_errors)
+        per_sample['mPJPE'].append(errors.mean(axis=-1))
+        per_sample['PAmPJPE'].append(pa_errors.mean(axis=-1))
+
+    num_joints = len(J14_NAME)
+    per_sample = {name: np.concatenate(values) if values else np.zeros((0,))
+                  for name, values in per_sample.items()}
+    per_joint = {name: np.concatenate(values) if values else np.zeros((0, num_joints))
+                 for name, values in per_joint.items()}
+    return per_sample, per_joint
+
+
+def summarize(per_sample, per_joint):
+    """Averages in millimeters."""
+    summary = {name: {'value': float(1000 * values.mean()) if len(values) else float('nan'),
+                      'count': len(values)}
+               for name, values in per_sample.items()}
+    breakdown = {name: dict(zip(J14_NAME, (1000 * values.mean(axis=0)).tolist()))
+                 for name, values in per_joint.items() if len(values)}
+    return summary, breakdown
+
+
+def main(args):
+    store = EvalStore(args.eval_store).open()
+    rows = select_rows(store, args.key_pattern)
+    print('{} of {} samples selected'.format(len(rows), len(store.keys)))
+    per_sample, per_joint = compute_metrics(store, rows, args.chunk_size, args.pa_mpve)
+    summary, breakdown = summarize(per_sample, per_joint)
+
+    for name, result in summary.items():
+        print('{:>8}: {:7.2f}  ({} samples)'.format(name, result['value'], result['count']))
+    if args.per_joint:
+        names = list(breakdown)
+        print('{:>12} '.format('joint') + ' '.join('{:>8}'.format(n) for n in names))
+        for joint in J14_NAME:
+            print('{:>12} '.format(joint) + ' '.join('{:8.2f}'.format(breakdown[n][joint]) for n in names))
+    if args.output_json:
+        with open(args.output_json, 'w') as fp:
+            json.dump({'summary': summary, 'per_joint': breakdown,
+                       'key_pattern': args.key_pattern}, fp, indent=2)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--eval_store", required=True, type=str,
+                        help="Directory of an evaluation store, e.g. <eval_store>/epoch000.")
+    parser.add_argument("--key_pattern", default=None, type=str,
+                        help="Only evaluate samples whose img_key matches this regular expression.")
+    parser.add_argument("--per_joint", default=False, action='store_true',
+                        help="Print the per-joint mPJPE and PA-MPJPE.")
+    parser.add_argument("--pa_mpve", default=False, action='store_true',
+                        help="Also compute the vertex error after Procrustes alignment.")
+    parser.add_argument("--chunk_size", default=4096, type=int)
+    parser.add_argument("--output_json", default=None, type=str)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main(parse_args())
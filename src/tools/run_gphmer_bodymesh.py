@@ -27,12 +27,18 @@ from src.modeling.hrnet.hrnet_cls_net_gridfeat import get_cls_net_gridfeat
 from src.modeling.hrnet.config import config as hrnet_config
 from src.modeling.hrnet.config import update_config as hrnet_update_config
 import src.modeling.data.config as cfg
-from src.datasets.build import make_data_loader
+from src.datasets.batch_augment import BatchAugmentation
+from src.datasets.build import make_data_loader, num_unpadded_samples
 
 from src.utils.logger import setup_logger
-from src.utils.comm import synchronize, is_main_process, get_rank, get_world_size, all_gather
-from src.utils.miscellaneous import mkdir, set_seed
-from src.utils.metric_logger import AverageMeter, EvalMetricsLogger
+from src.utils.comm import synchronize, is_main_process, get_rank, get_world_size
+from src.utils.miscellaneous import mkdir, set_seed, autocast, make_grad_scaler, grad_sync_context, \
+    make_distributed_model
+from src.utils.checkpoint import CheckpointWriter, snapshot_state_dict, write_checkpoint, \
+    make_training_state, load_training_state, restore_rng_state, find_last_checkpoint, load_file, load_weights
+from src.utils.metric_logger import AverageMeter, EvalMetricsLogger, DistributedMetrics
+from src.utils.eval_store import EvalStore
+from src.utils.feature_cache import open_feature_cache, backbone_features
 from src.utils.renderer import Renderer, visualize_reconstruction, visualize_reconstruction_test
 from src.utils.metric_pampjpe import reconstruction_error
 from src.utils.geometric_layers import orthographic_projection
@@ -40,24 +46,22 @@ from src.utils.geometric_layers import orthographic_projection
 from azureml.core.run import Run
 aml_run = Run.get_context()
 
-def save_checkpoint(model, args, epoch, iteration, num_trial=10):
+def save_checkpoint(model, args, epoch, iteration, sampler_state=None, checkpoint_writer=None, metric=None,
+                    training_state=None):
     checkpoint_dir = op.join(args.output_dir, 'checkpoint-{}-{}'.format(
         epoch, iteration))
     if not is_main_process():
         return checkpoint_dir
-    mkdir(checkpoint_dir)
-    model_to_save = model.module if hasattr(model, 'module') else model
-    for i in range(num_trial):
-        try:
-            torch.save(model_to_save, op.join(checkpoint_dir, 'model.bin'))
-            torch.save(model_to_save.state_dict(), op.join(checkpoint_dir, 'state_dict.bin'))
-            torch.save(args, op.join(checkpoint_dir, 'training_args.bin'))
-            logger.info("Save checkpoint to {}".format(checkpoint_dir))
-            break
-        except:
-            pass
-    else:
-        logger.info("Failed to save checkpoint after {} trails.".format(num_trial))
+    # training only waits for the copy to host memory
+    files = {'state_dict.bin': snapshot_state_dict(model), 'training_args.bin': args}
+    if sampler_state is not None:
+        files['sampler_state.bin'] = sampler_state
+    if training_state is not None:
+        files['training_state.bin'] = training_state
+    if checkpoint_writer is not None:
+        return checkpoint_writer.save(checkpoint_dir, files, metric=metric)
+    write_checkpoint(checkpoint_dir, files)
+    logger.info("Save checkpoint to {}".format(checkpoint_dir))
     return checkpoint_dir
 
 def save_scores(args, split, mpjpe, pampjpe, mpve):
@@ -153,11 +157,35 @@ def rectify_pose(pose):
     pose[:3] = cv2.Rodrigues(new_root)[0].reshape(3)
     return pose
 
-def run(args, train_dataloader, val_dataloader, Graphormer_model, smpl, mesh_sampler, renderer):
+def make_feature_cache(args, data_loader, Graphormer_model, is_train=False):
+    """Backbone feature cache of the data of data_loader, with --backbone_feature_cache.
+    It is only used while the backbone is fixed: frozen, or in evaluation only.
+    Training data only uses it with --cache_train_features."""
+    if not args.backbone_feature_cache or not (args.freeze_backbone or args.run_eval_only):
+        return None
+    if is_train:
+        if not args.cache_train_features:
+            return None
+        logger.warning("--cache_train_features: the training data is not augmented, "
+                       "the feature cache holds a single crop of every sample")
+    model = Graphormer_model.module if hasattr(Graphormer_model, 'module') else Graphormer_model
+    return open_feature_cache(args.backbone_feature_cache, data_loader.dataset, model.backbone,
+                              dtype=args.backbone_feature_cache_dtype)
+
+def get_backbone_feats(Graphormer_model, images, annotations, feature_cache):
+    if feature_cache is None:
+        return None
+    model = Graphormer_model.module if hasattr(Graphormer_model, 'module') else Graphormer_model
+    return backbone_features(model.backbone, images, annotations['row'], feature_cache)
+
+def run(args, train_dataloader, val_dataloader, Graphormer_model, smpl, mesh_sampler, renderer, training_state=None):
     smpl.eval()
+    # iterations count micro-batches, steps count optimizer steps
+    accum_steps = args.gradient_accumulation_steps
     max_iter = len(train_dataloader)
-    iters_per_epoch = max_iter // args.num_train_epochs
-    if iters_per_epoch<1000:
+    max_steps = (max_iter + accum_steps - 1) // accum_steps
+    steps_per_epoch = max_steps // args.num_train_epochs
+    if steps_per_epoch<1000:
         args.logging_steps = 500
 
     optimizer = torch.optim.Adam(params=list(Graphormer_model.parameters()),
@@ -165,22 +193,23 @@ def run(args, train_dataloader, val_dataloader, Graphormer_model, smpl, mesh_sam
                                            betas=(0.9, 0.999),
                                            weight_decay=0)
 
+    # features of the frozen backbone, computed once per training sample
+    train_feature_cache = make_feature_cache(args, train_dataloader, Graphormer_model, is_train=True)
+    # opened once, the backbone does not change while the cache is used
+    val_feature_cache = make_feature_cache(args, val_dataloader, Graphormer_model)
+
     # define loss function (criterion) and optimizer
-    criterion_2d_keypoints = torch.nn.MSELoss(reduction='none').cuda(args.device)
-    criterion_keypoints = torch.nn.MSELoss(reduction='none').cuda(args.device)
-    criterion_vertices = torch.nn.L1Loss().cuda(args.device)
+    criterion_2d_keypoints = torch.nn.MSELoss(reduction='none').to(args.device)
+    criterion_keypoints = torch.nn.MSELoss(reduction='none').to(args.device)
+    criterion_vertices = torch.nn.L1Loss().to(args.device)
 
     if args.distributed:
-        Graphormer_model = torch.nn.parallel.DistributedDataParallel(
-            Graphormer_model, device_ids=[args.local_rank], 
-            output_device=args.local_rank,
-            find_unused_parameters=True,
-        )
+        Graphormer_model = make_distributed_model(Graphormer_model, args)
 
         logger.info(
                 ' '.join(
-                ['Local rank: {o}', 'Max iteration: {a}', 'iters_per_epoch: {b}','num_train_epochs: {c}',]
-                ).format(o=args.local_rank, a=max_iter, b=iters_per_epoch, c=args.num_train_epochs)
+                ['Local rank: {o}', 'Max iteration: {a}', 'steps_per_epoch: {b}','num_train_epochs: {c}',]
+                ).format(o=args.local_rank, a=max_iter, b=steps_per_epoch, c=args.num_train_epochs)
             )
 
     start_training_time = time.time()
@@ -194,32 +223,56 @@ def run(args, train_dataloader, val_dataloader, Graphormer_model, smpl, mesh_sam
     log_loss_vertices = AverageMeter()
     log_eval_metrics = EvalMetricsLogger()
 
-    for iteration, (img_keys, images, annotations) in enumerate(train_dataloader):
+    # rotation, flip, pixel noise and normalization of the training batches
+    batch_augment = BatchAugmentation() if args.device_augment else None
+    scaler = make_grad_scaler(args)
+    # checkpoints are written by a background thread of the main process
+    checkpoint_writer = CheckpointWriter(args.keep_last_checkpoints, args.keep_best_checkpoints) \
+        if is_main_process() else None
+
+    if training_state is not None:
+        optimizer.load_state_dict(training_state['optimizer'])
+        # empty if the run was resumed from has no loss scaling
+        if training_state['scaler']:
+            scaler.load_state_dict(training_state['scaler'])
+        log_eval_metrics.load_state_dict(training_state['eval_metrics'])
+        restore_rng_state(training_state)
+
+    # continue counting from the resumed iteration, if any
+    start_iter = train_dataloader.batch_sampler.start_iter
+    for iteration, (img_keys, images, annotations) in enumerate(train_dataloader, start_iter):
         # gc.collect()
         # torch.cuda.empty_cache()
         Graphormer_model.train()
         iteration += 1
-        epoch = iteration // iters_per_epoch
+        # the optimizer steps after every accum_steps micro-batches
+        is_update = iteration % accum_steps == 0 or iteration == max_iter
+        step = (iteration + accum_steps - 1) // accum_steps
+        # the last window is shorter if max_iter is not a multiple of accum_steps
+        window_size = min(accum_steps, max_iter - (step - 1) * accum_steps)
+        epoch = step // steps_per_epoch
         batch_size = images.size(0)
         adjust_learning_rate(optimizer, epoch, args)
         data_time.update(time.time() - end)
 
-        images = images.cuda(args.device)
-        gt_2d_joints = annotations['joints_2d'].cuda(args.device)
+        images = images.to(args.device)
+        if batch_augment is not None:
+            images = batch_augment(images, annotations)
+        gt_2d_joints = annotations['joints_2d'].to(args.device)
         gt_2d_joints = gt_2d_joints[:,cfg.J24_TO_J14,:]
-        has_2d_joints = annotations['has_2d_joints'].cuda(args.device)
+        has_2d_joints = annotations['has_2d_joints'].to(args.device)
 
-        gt_3d_joints = annotations['joints_3d'].cuda(args.device)
+        gt_3d_joints = annotations['joints_3d'].to(args.device)
         gt_3d_pelvis = gt_3d_joints[:,cfg.J24_NAME.index('Pelvis'),:3]
         gt_3d_joints = gt_3d_joints[:,cfg.J24_TO_J14,:] 
         gt_3d_joints[:,:,:3] = gt_3d_joints[:,:,:3] - gt_3d_pelvis[:, None, :]
-        has_3d_joints = annotations['has_3d_joints'].cuda(args.device)
+        has_3d_joints = annotations['has_3d_joints'].to(args.device)
 
-        gt_pose = annotations['pose'].cuda(args.device)
-        gt_betas = annotations['betas'].cuda(args.device)
-        has_smpl = annotations['has_smpl'].cuda(args.device)
-        mjm_mask = annotations['mjm_mask'].cuda(args.device)
-        mvm_mask = annotations['mvm_mask'].cuda(args.device)
+        gt_pose = annotations['pose'].to(args.device)
+        gt_betas = annotations['betas'].to(args.device)
+        has_smpl = annotations['has_smpl'].to(args.device)
+        mjm_mask = annotations['mjm_mask'].to(args.device)
+        mvm_mask = annotations['mvm_mask'].to(args.device)
 
         # generate simplified mesh
         gt_vertices = smpl(gt_pose, gt_betas)
@@ -236,60 +289,69 @@ def run(args, train_dataloader, val_dataloader, Graphormer_model, smpl, mesh_sam
         mvm_mask_ = mvm_mask.expand(-1,-1,2051)
         meta_masks = torch.cat([mjm_mask_, mvm_mask_], dim=1)
 
-        # forward-pass
-        pred_camera, pred_3d_joints, pred_vertices_sub2, pred_vertices_sub, pred_vertices = Graphormer_model(images, smpl, mesh_sampler, meta_masks=meta_masks, is_train=True)
+        # all-reduce the gradients only in the last micro-batch of a step
+        with grad_sync_context(Graphormer_model, is_update):
+            # forward-pass, in mixed precision with --amp
+            with autocast(args):
+                backbone_feats = get_backbone_feats(Graphormer_model, images, annotations, train_feature_cache)
+                outputs = Graphormer_model(images, smpl, mesh_sampler, meta_masks=meta_masks, is_train=True,
+                                           backbone_feats=backbone_feats)
+            # mesh regression and losses in float32
+            pred_camera, pred_3d_joints, pred_vertices_sub2, pred_vertices_sub, pred_vertices = [o.float() for o in outputs]
+
+            # normalize gt based on smpl's pelvis 
+            gt_vertices_sub = gt_vertices_sub - gt_smpl_3d_pelvis[:, None, :] 
+            gt_vertices = gt_vertices - gt_smpl_3d_pelvis[:, None, :]
+
+            # obtain 3d joints, which are regressed from the full mesh
+            pred_3d_joints_from_smpl = smpl.get_h36m_joints(pred_vertices)
+            pred_3d_joints_from_smpl = pred_3d_joints_from_smpl[:,cfg.H36M_J17_TO_J14,:]
 
-        # normalize gt based on smpl's pelvis 
-        gt_vertices_sub = gt_vertices_sub - gt_smpl_3d_pelvis[:, None, :] 
-        gt_vertices = gt_vertices - gt_smpl_3d_pelvis[:, None, :]
-
-        # obtain 3d joints, which are regressed from the full mesh
-        pred_3d_joints_from_smpl = smpl.get_h36m_joints(pred_vertices)
-        pred_3d_joints_from_smpl = pred_3d_joints_from_smpl[:,cfg.H36M_J17_TO_J14,:]
-
-        # obtain 2d joints, which are projected from 3d joints of smpl mesh
-        pred_2d_joints_from_smpl = orthographic_projection(pred_3d_joints_from_smpl, pred_camera)
-        pred_2d_joints = orthographic_projection(pred_3d_joints, pred_camera)
-
-        # compute 3d joint loss  (where the joints are directly output from transformer)
-        loss_3d_joints = keypoint_3d_loss(criterion_keypoints, pred_3d_joints, gt_3d_joints, has_3d_joints, args.device)
-        # compute 3d vertex loss
-        loss_vertices = ( args.vloss_w_sub2 * vertices_loss(criterion_vertices, pred_vertices_sub2, gt_vertices_sub2, has_smpl, args.device) + \
-                            args.vloss_w_sub * vertices_loss(criterion_vertices, pred_vertices_sub, gt_vertices_sub, has_smpl, args.device) + \
-                            args.vloss_w_full * vertices_loss(criterion_vertices, pred_vertices, gt_vertices, has_smpl, args.device) )
-        # compute 3d joint loss (where the joints are regressed from full mesh)
-        loss_reg_3d_joints = keypoint_3d_loss(criterion_keypoints, pred_3d_joints_from_smpl, gt_3d_joints, has_3d_joints, args.device)
-        # compute 2d joint loss
-        loss_2d_joints = keypoint_2d_loss(criterion_2d_keypoints, pred_2d_joints, gt_2d_joints, has_2d_joints)  + \
-                         keypoint_2d_loss(criterion_2d_keypoints, pred_2d_joints_from_smpl, gt_2d_joints, has_2d_joints)
+            # obtain 2d joints, which are projected from 3d joints of smpl mesh
+            pred_2d_joints_from_smpl = orthographic_projection(pred_3d_joints_from_smpl, pred_camera)
+            pred_2d_joints = orthographic_projection(pred_3d_joints, pred_camera)
+
+            # compute 3d joint loss  (where the joints are directly output from transformer)
+            loss_3d_joints = keypoint_3d_loss(criterion_keypoints, pred_3d_joints, gt_3d_joints, has_3d_joints, args.device)
+            # compute 3d vertex loss
+            loss_vertices = ( args.vloss_w_sub2 * vertices_loss(criterion_vertices, pred_vertices_sub2, gt_vertices_sub2, has_smpl, args.device) + \
+                                args.vloss_w_sub * vertices_loss(criterion_vertices, pred_vertices_sub, gt_vertices_sub, has_smpl, args.device) + \
+                                args.vloss_w_full * vertices_loss(criterion_vertices, pred_vertices, gt_vertices, has_smpl, args.device) )
+            # compute 3d joint loss (where the joints are regressed from full mesh)
+            loss_reg_3d_joints = keypoint_3d_loss(criterion_keypoints, pred_3d_joints_from_smpl, gt_3d_joints, has_3d_joints, args.device)
+            # compute 2d joint loss
+            loss_2d_joints = keypoint_2d_loss(criterion_2d_keypoints, pred_2d_joints, gt_2d_joints, has_2d_joints)  + \
+                             keypoint_2d_loss(criterion_2d_keypoints, pred_2d_joints_from_smpl, gt_2d_joints, has_2d_joints)
         
-        loss_3d_joints = loss_3d_joints + loss_reg_3d_joints
+            loss_3d_joints = loss_3d_joints + loss_reg_3d_joints
     
-        # we empirically use hyperparameters to balance difference losses
-        loss = args.joints_loss_weight*loss_3d_joints + \
-                args.vertices_loss_weight*loss_vertices  + args.vertices_loss_weight*loss_2d_joints
-
-        # update logs
-        log_loss_2djoints.update(loss_2d_joints.item(), batch_size)
-        log_loss_3djoints.update(loss_3d_joints.item(), batch_size)
-        log_loss_vertices.update(loss_vertices.item(), batch_size)
-        log_losses.update(loss.item(), batch_size)
-
-        # back prop
-        optimizer.zero_grad()
-        loss.backward() 
-        optimizer.step()
+            # we empirically use hyperparameters to balance difference losses
+            loss = args.joints_loss_weight*loss_3d_joints + \
+                    args.vertices_loss_weight*loss_vertices  + args.vertices_loss_weight*loss_2d_joints
+
+            # update logs
+            log_loss_2djoints.update(loss_2d_joints.item(), batch_size)
+            log_loss_3djoints.update(loss_3d_joints.item(), batch_size)
+            log_loss_vertices.update(loss_vertices.item(), batch_size)
+            log_losses.update(loss.item(), batch_size)
+
+            # back prop, gradients of the micro-batches are summed up
+            scaler.scale(loss / window_size).backward()
+        if is_update:
+            scaler.step(optimizer)
+            scaler.update()
+            optimizer.zero_grad()
 
         batch_time.update(time.time() - end)
         end = time.time()
 
-        if iteration % args.logging_steps == 0 or iteration == max_iter:
+        if is_update and (step % args.logging_steps == 0 or step == max_steps):
             eta_seconds = batch_time.avg * (max_iter - iteration)
             eta_string = str(datetime.timedelta(seconds=int(eta_seconds)))
             logger.info(
                 ' '.join(
                 ['eta: {eta}', 'epoch: {ep}', 'iter: {iter}', 'max mem : {memory:.0f}',]
-                ).format(eta=eta_string, ep=epoch, iter=iteration, 
+                ).format(eta=eta_string, ep=epoch, iter=step, 
                     memory=torch.cuda.max_memory_allocated() / 1024.0 / 1024.0) 
                 + '  loss: {:.4f}, 2d joint loss: {:.4f}, 3d joint loss: {:.4f}, vertex loss: {:.4f}, compute: {:.4f}, data: {:.4f}, lr: {:.6f}'.format(
                     log_losses.avg, log_loss_2djoints.avg, log_loss_3djoints.avg, log_loss_vertices.avg, batch_time.avg, data_time.avg, 
@@ -317,14 +379,15 @@ def run(args, train_dataloader, val_dataloader, Graphormer_model, smpl, mesh_sam
                 cv2.imwrite(temp_fname, np.asarray(visual_imgs[:,:,::-1]*255))
                 aml_run.log_image(name='visual results', path=temp_fname)
 
-        if iteration % iters_per_epoch == 0:
+        if is_update and step % steps_per_epoch == 0:
             val_mPVE, val_mPJPE, val_PAmPJPE, val_count = run_validate(args, val_dataloader, 
                                                 Graphormer_model, 
                                                 criterion_keypoints, 
                                                 criterion_vertices, 
                                                 epoch, 
                                                 smpl,
-                                                mesh_sampler)
+                                                mesh_sampler,
+                                                val_feature_cache)
             aml_run.log(name='mPVE', value=float(1000*val_mPVE))
             aml_run.log(name='mPJPE', value=float(1000*val_mPJPE))
             aml_run.log(name='PAmPJPE', value=float(1000*val_PAmPJPE))
@@ -334,8 +397,13 @@ def run(args, train_dataloader, val_dataloader, Graphormer_model, smpl, mesh_sam
             )
 
             if val_PAmPJPE<log_eval_metrics.PAmPJPE:
-                checkpoint_dir = save_checkpoint(Graphormer_model, args, epoch, iteration)
                 log_eval_metrics.update(val_mPVE, val_mPJPE, val_PAmPJPE, epoch)
+                sampler_state = train_dataloader.batch_sampler.state_dict(iteration)
+                checkpoint_dir = save_checkpoint(Graphormer_model, args, epoch, iteration,
+                        sampler_state=sampler_state,
+                        checkpoint_writer=checkpoint_writer, metric=val_PAmPJPE,
+                        training_state=make_training_state(optimizer, scaler, sampler_state,
+                                eval_metrics=log_eval_metrics.state_dict()))
                 
         
     total_training_time = time.time() - start_training_time
@@ -343,7 +411,14 @@ def run(args, train_dataloader, val_dataloader, Graphormer_model, smpl, mesh_sam
     logger.info('Total training time: {} ({:.4f} s / iter)'.format(
         total_time_str, total_training_time / max_iter)
     )
-    checkpoint_dir = save_checkpoint(Graphormer_model, args, epoch, iteration)
+    sampler_state = train_dataloader.batch_sampler.state_dict(iteration)
+    checkpoint_dir = save_checkpoint(Graphormer_model, args, epoch, iteration,
+                        sampler_state=sampler_state,
+                        checkpoint_writer=checkpoint_writer,
+                        training_state=make_training_state(optimizer, scaler, sampler_state,
+                                eval_metrics=log_eval_metrics.state_dict()))
+    if checkpoint_writer is not None:
+        checkpoint_writer.close()
 
     logger.info(
         ' Best Results:'
@@ -353,16 +428,12 @@ def run(args, train_dataloader, val_dataloader, Graphormer_model, smpl, mesh_sam
 
 def run_eval_general(args, val_dataloader, Graphormer_model, smpl, mesh_sampler):
     smpl.eval()
-    criterion_keypoints = torch.nn.MSELoss(reduction='none').cuda(args.device)
-    criterion_vertices = torch.nn.L1Loss().cuda(args.device)
+    criterion_keypoints = torch.nn.MSELoss(reduction='none').to(args.device)
+    criterion_vertices = torch.nn.L1Loss().to(args.device)
 
     epoch = 0
     if args.distributed:
-        Graphormer_model = torch.nn.parallel.DistributedDataParallel(
-            Graphormer_model, device_ids=[args.local_rank], 
-            output_device=args.local_rank,
-            find_unused_parameters=True,
-        )
+        Graphormer_model = make_distributed_model(Graphormer_model, args)
     Graphormer_model.eval()
 
     val_mPVE, val_mPJPE, val_PAmPJPE, val_count = run_validate(args, val_dataloader, 
@@ -371,7 +442,8 @@ def run_eval_general(args, val_dataloader, Graphormer_model, smpl, mesh_sampler)
                                     criterion_vertices, 
                                     epoch, 
                                     smpl,
-                                    mesh_sampler)
+                                    mesh_sampler,
+                                    make_feature_cache(args, val_dataloader, Graphormer_model))
 
     aml_run.log(name='mPVE', value=float(1000*val_mPVE))
     aml_run.log(name='mPJPE', value=float(1000*val_mPJPE))
@@ -384,11 +456,32 @@ def run_eval_general(args, val_dataloader, Graphormer_model, smpl, mesh_sampler)
     # checkpoint_dir = save_checkpoint(Graphormer_model, args, 0, 0)
     return
 
-def run_validate(args, val_loader, Graphormer_model, criterion, criterion_vertices, epoch, smpl, mesh_sampler):
+def make_eval_store(args, val_loader, epoch, smpl):
+    """Store of the per-sample results of a validation pass, for offline
+    analysis with src/tools/run_eval_metrics.py."""
+    eval_store = EvalStore(op.join(args.eval_store, 'epoch{:03d}'.format(epoch)))
+    if is_main_process():
+        dataset = val_loader.dataset
+        keys = [dataset.get_img_key(i) for i in range(len(dataset))]
+        num_joints = len(cfg.J24_TO_J14)
+        eval_store.create(keys, {'pred_vertices': tuple(smpl.v_template.shape),
+                                 'pred_3d_joints': (num_joints, 3),
+                                 'gt_vertices': tuple(smpl.v_template.shape),
+                                 'gt_3d_joints': (num_joints, 4),
+                                 'has_smpl': (),
+                                 'has_3d_joints': ()})
+    synchronize()
+    if not is_main_process():
+        eval_store.open(mode='r+')
+    return eval_store
+
+def run_validate(args, val_loader, Graphormer_model, criterion, criterion_vertices, epoch, smpl, mesh_sampler,
+                 feature_cache=None):
     batch_time = AverageMeter()
-    mPVE = AverageMeter()
-    mPJPE = AverageMeter()
-    PAmPJPE = AverageMeter()
+    metrics = DistributedMetrics(['mPVE', 'mPJPE', 'PAmPJPE'])
+    eval_store = make_eval_store(args, val_loader, epoch, smpl) if args.eval_store else None
+    num_samples = num_unpadded_samples(val_loader)
+    num_seen = 0
     # switch to evaluate mode
     Graphormer_model.eval()
     smpl.eval()
@@ -397,16 +490,16 @@ def run_validate(args, val_loader, Graphormer_model, criterion, criterion_vertic
         for i, (img_keys, images, annotations) in enumerate(val_loader):
             batch_size = images.size(0)
             # compute output
-            images = images.cuda(args.device)
-            gt_3d_joints = annotations['joints_3d'].cuda(args.device)
+            images = images.to(args.device)
+            gt_3d_joints = annotations['joints_3d'].to(args.device)
             gt_3d_pelvis = gt_3d_joints[:,cfg.J24_NAME.index('Pelvis'),:3]
             gt_3d_joints = gt_3d_joints[:,cfg.J24_TO_J14,:] 
             gt_3d_joints[:,:,:3] = gt_3d_joints[:,:,:3] - gt_3d_pelvis[:, None, :]
-            has_3d_joints = annotations['has_3d_joints'].cuda(args.device)
+            has_3d_joints = annotations['has_3d_joints'].to(args.device)
 
-            gt_pose = annotations['pose'].cuda(args.device)
-            gt_betas = annotations['betas'].cuda(args.device)
-            has_smpl = annotations['has_smpl'].cuda(args.device)
+            gt_pose = annotations['pose'].to(args.device)
+            gt_betas = annotations['betas'].to(args.device)
+            has_smpl = annotations['has_smpl'].to(args.device)
 
             # generate simplified mesh
             gt_vertices = smpl(gt_pose, gt_betas)
@@ -420,7 +513,10 @@ def run_validate(args, val_loader, Graphormer_model, criterion, criterion_vertic
             gt_vertices = gt_vertices - gt_smpl_3d_pelvis[:, None, :] 
 
             # forward-pass
-            pred_camera, pred_3d_joints, pred_vertices_sub2, pred_vertices_sub, pred_vertices = Graphormer_model(images, smpl, mesh_sampler)
+            with autocast(args):
+                backbone_feats = get_backbone_feats(Graphormer_model, images, annotations, feature_cache)
+                outputs = Graphormer_model(images, smpl, mesh_sampler, backbone_feats=backbone_feats)
+            pred_camera, pred_3d_joints, pred_vertices_sub2, pred_vertices_sub, pred_vertices = [o.float() for o in outputs]
 
             # obtain 3d joints from full mesh
             pred_3d_joints_from_smpl = smpl.get_h36m_joints(pred_vertices)
@@ -430,28 +526,36 @@ def run_validate(args, val_loader, Graphormer_model, criterion, criterion_vertic
             pred_3d_joints_from_smpl = pred_3d_joints_from_smpl - pred_3d_pelvis[:, None, :]
             pred_vertices = pred_vertices - pred_3d_pelvis[:, None, :]
 
+            # the padding of a distributed sampler repeats samples of other ranks
+            is_sample = (torch.arange(num_seen, num_seen + batch_size) < num_samples).to(args.device)
+            num_seen += batch_size
+            has_smpl_sample = has_smpl * is_sample.type_as(has_smpl)
+            has_3d_joints_sample = has_3d_joints * is_sample.type_as(has_3d_joints)
+
             # measure errors
-            error_vertices = mean_per_vertex_error(pred_vertices, gt_vertices, has_smpl)
-            error_joints = mean_per_joint_position_error(pred_3d_joints_from_smpl, gt_3d_joints,  has_3d_joints)
+            error_vertices = mean_per_vertex_error(pred_vertices, gt_vertices, has_smpl_sample)
+            error_joints = mean_per_joint_position_error(pred_3d_joints_from_smpl, gt_3d_joints,  has_3d_joints_sample)
             error_joints_pa = reconstruction_error(pred_3d_joints_from_smpl.cpu().numpy(), gt_3d_joints[:,:,:3].cpu().numpy(), reduction=None)
-            
-            if len(error_vertices)>0:
-                mPVE.update(np.mean(error_vertices), int(torch.sum(has_smpl)) )
-            if len(error_joints)>0:
-                mPJPE.update(np.mean(error_joints), int(torch.sum(has_3d_joints)) )
-            if len(error_joints_pa)>0:
-                PAmPJPE.update(np.mean(error_joints_pa), int(torch.sum(has_3d_joints)) )
-
-    val_mPVE = all_gather(float(mPVE.avg))
-    val_mPVE = sum(val_mPVE)/len(val_mPVE)
-    val_mPJPE = all_gather(float(mPJPE.avg))
-    val_mPJPE = sum(val_mPJPE)/len(val_mPJPE)
-
-    val_PAmPJPE = all_gather(float(PAmPJPE.avg))
-    val_PAmPJPE = sum(val_PAmPJPE)/len(val_PAmPJPE)
-
-    val_count = all_gather(float(mPVE.count))
-    val_count = sum(val_count)
+            error_joints_pa = error_joints_pa[is_sample.cpu().numpy()]
+
+            metrics.update('mPVE', error_vertices)
+            metrics.update('mPJPE', error_joints)
+            metrics.update('PAmPJPE', error_joints_pa)
+
+            if eval_store is not None:
+                eval_store.put(img_keys, pred_vertices=pred_vertices,
+                               pred_3d_joints=pred_3d_joints_from_smpl,
+                               gt_vertices=gt_vertices, gt_3d_joints=gt_3d_joints,
+                               has_smpl=has_smpl, has_3d_joints=has_3d_joints)
+
+    if eval_store is not None:
+        eval_store.flush()
+    # weighted sums and counts of all ranks, in one collective
+    metrics.sync()
+    val_mPVE = metrics['mPVE'].avg
+    val_mPJPE = metrics['mPJPE'].avg
+    val_PAmPJPE = metrics['PAmPJPE'].avg
+    val_count = metrics['mPVE'].count
 
     return val_mPVE, val_mPJPE, val_PAmPJPE, val_count
 
@@ -528,11 +632,61 @@ def parse_args():
                         help="Workers in dataloader.")
     parser.add_argument("--img_scale_factor", default=1, type=int, 
                         help="adjust image resolution.") 
+    parser.add_argument("--fast_crop", default=False, action='store_true',
+                        help="Crop, rotate and resize images with a single warpAffine.")
+    parser.add_argument("--fused_normalize", default=False, action='store_true',
+                        help="Fuse pixel noise and normalization into one lookup table pass. "
+                        "Implies the warpAffine crop of --fast_crop.")
+    parser.add_argument("--device_augment", default=False, action='store_true',
+                        help="Training workers only crop uint8 canvases; rotation, flip, "
+                        "pixel noise and normalization run batched on the training device.")
+    parser.add_argument("--reduced_decode", default=False, action='store_true',
+                        help="Decode large JPEG frames at 1/2, 1/4 or 1/8 resolution when "
+                        "the bounding box still covers the input resolution (needs the hw tsv).")
+    parser.add_argument("--freeze_backbone", default=False, action='store_true',
+                        help="Train the Graphormer encoders only, with the backbone fixed.")
+    parser.add_argument("--backbone_feature_cache", default=None, type=str, required=False,
+                        help="Directory of the on-disk cache of backbone features, used for "
+                        "evaluation with --freeze_backbone or --run_eval_only. Disabled if not given.")
+    parser.add_argument("--backbone_feature_cache_dtype", default='float16', type=str,
+                        choices=['float16', 'float32'],
+                        help="Storage type of the cached backbone features. float16 halves the "
+                        "cache size, but results differ slightly from runs without the cache; "
+                        "float32 reproduces them.")
+    parser.add_argument("--cache_train_features", default=False, action='store_true',
+                        help="With --freeze_backbone and --backbone_feature_cache, also cache the "
+                        "features of the training data. Epochs after the first skip the backbone, "
+                        "but the training data is then not augmented (no scale, rotation, flip "
+                        "or pixel noise), which can cost accuracy.")
+    parser.add_argument("--eval_crop_cache", default=None, type=str, required=False,
+                        help="Directory of the on-disk cache of processed evaluation samples. "
+                        "Disabled if not given.")
+    parser.add_argument("--eval_store", default=None, type=str, required=False,
+                        help="Directory where each validation pass stores the predicted and "
+                        "ground truth joints and vertices of every sample, for offline metrics.")
+    parser.add_argument("--locality_sampler", default=False, action='store_true',
+                        help="Shuffle training data by blocks of consecutive TSV rows and "
+                        "a shuffle buffer, for mostly sequential reads.")
+    parser.add_argument("--sampler_block_size", default=256, type=int,
+                        help="Rows per block of the locality sampler.")
+    parser.add_argument("--sampler_buffer_size", default=1024, type=int,
+                        help="Shuffle buffer size of the locality sampler.")
     #########################################################
     # Loading/saving checkpoints
     #########################################################
     parser.add_argument("--model_name_or_path", default='src/modeling/bert/bert-base-uncased/', type=str, required=False,
                         help="Path to pre-trained transformer model or model type.")
+    parser.add_argument("--resume", default=None, type=str, required=False,
+                        help="Checkpoint directory to continue training from, with its optimizer, "
+                        "loss scaler, RNG and data position; 'auto' picks the last one in output_dir.")
+    parser.add_argument("--resume_sampler", default=False, action='store_true',
+                        help="Continue the training data order from the sampler_state.bin "
+                        "saved next to --resume_checkpoint, without replaying earlier batches. "
+                        "Not needed with --resume, which restores the data position itself.")
+    parser.add_argument("--keep_last_checkpoints", default=0, type=int,
+                        help="Keep only the last N checkpoints of the run (and the best ones); 0 keeps all.")
+    parser.add_argument("--keep_best_checkpoints", default=0, type=int,
+                        help="Also keep the K checkpoints with the best validation PA-MPJPE.")
     parser.add_argument("--resume_checkpoint", default=None, type=str, required=False,
                         help="Path to specific checkpoint for resume training.")
     parser.add_argument("--output_dir", default='output/', type=str, required=False,
@@ -548,6 +702,9 @@ def parse_args():
                         help="Batch size per GPU/CPU for evaluation.")
     parser.add_argument('--lr', "--learning_rate", default=1e-4, type=float, 
                         help="The initial lr.")
+    parser.add_argument("--gradient_accumulation_steps", default=1, type=int,
+                        help="Micro-batches per optimizer step; the effective batch size is "
+                        "per_gpu_train_batch_size * world size * gradient_accumulation_steps.")
     parser.add_argument("--num_train_epochs", default=200, type=int, 
                         help="Total number of training epochs to perform.")
     parser.add_argument("--vertices_loss_weight", default=100.0, type=float)          
@@ -557,6 +714,11 @@ def parse_args():
     parser.add_argument("--vloss_w_sub2", default=0.33, type=float) 
     parser.add_argument("--drop_out", default=0.1, type=float, 
                         help="Drop out ratio in BERT.")
+    parser.add_argument("--amp", default=False, action='store_true',
+                        help="Mixed precision training with autocast and loss scaling. "
+                        "SMPL/MANO, the sparse mesh sampling and the losses stay in float32.")
+    parser.add_argument("--amp_dtype", default='float16', type=str, choices=['float16', 'bfloat16'],
+                        help="Autocast dtype on GPU; bfloat16 is always used on CPU.")
     #########################################################
     # Model architectures
     #########################################################
@@ -577,6 +739,20 @@ def parse_args():
                         help="The Image Feature Dimension.")   
     parser.add_argument("--which_gcn", default='0,0,1', type=str, 
                         help="which encoder block to have graph conv. Encoder1, Encoder2, Encoder3. Default: only Encoder3 has graph conv") 
+    parser.add_argument("--checkpoint_hrnet_stages", default=[], type=str, nargs='*',
+                        choices=['stage2', 'stage3', 'stage4'],
+                        help="HRNet stages whose activations are recomputed in the backward "
+                        "pass, to save memory at the cost of compute.")
+    parser.add_argument("--checkpoint_graphormer", default=False, action='store_true',
+                        help="Recompute the activations of each Graphormer layer in the backward pass. "
+                        "Like --checkpoint_hrnet_stages, it needs --skip_unused_modules or "
+                        "--ddp_static_graph in distributed training.")
+    parser.add_argument("--skip_unused_modules", default=False, action='store_true',
+                        help="Do not build the BERT embeddings and pooler of the encoders and the "
+                        "HRNet classifier, which forward never uses, so that DDP needs no "
+                        "search for unused parameters.")
+    parser.add_argument("--ddp_static_graph", default=False, action='store_true',
+                        help="Let DDP assume the same graph in every iteration (static_graph=True).")
     parser.add_argument("--mesh_type", default='body', type=str, help="body or hand") 
     parser.add_argument("--interm_size_scale", default=2, type=int)
     #########################################################
@@ -594,6 +770,13 @@ def parse_args():
 
 
     args = parser.parse_args()
+    # DDP does not support reentrant activation checkpointing while it searches
+    # for unused parameters
+    if (args.checkpoint_hrnet_stages or args.checkpoint_graphormer) and \
+            int(os.environ.get('WORLD_SIZE', 1)) > 1 and \
+            not (args.skip_unused_modules or args.ddp_static_graph):
+        parser.error("--checkpoint_hrnet_stages and --checkpoint_graphormer need "
+                     "--skip_unused_modules or --ddp_static_graph in distributed training")
     return args
 
 
@@ -621,9 +804,20 @@ def main(args):
     set_seed(args.seed, args.num_gpus)
     logger.info("Using {} GPUs".format(args.num_gpus))
 
+    # continue an interrupted run from its full training state
+    training_state = None
+    if args.resume:
+        checkpoint_dir = find_last_checkpoint(args.output_dir) if args.resume == 'auto' else args.resume
+        if checkpoint_dir is None:
+            logger.info("No checkpoint to resume in {}, start training".format(args.output_dir))
+        else:
+            logger.info("Resume training from {}".format(checkpoint_dir))
+            args.resume_checkpoint = op.join(checkpoint_dir, 'state_dict.bin')
+            training_state = load_training_state(checkpoint_dir)
+
     # Mesh and SMPL utils
     smpl = SMPL().to(args.device)
-    mesh_sampler = Mesh()
+    mesh_sampler = Mesh(device=args.device)
 
     # Renderer for visualization
     renderer = Renderer(faces=smpl.faces.cpu().numpy())
@@ -641,7 +835,7 @@ def main(args):
     if args.run_eval_only==True and args.resume_checkpoint!=None and args.resume_checkpoint!='None' and 'state_dict' not in args.resume_checkpoint:
         # if only run eval, load checkpoint
         logger.info("Evaluation: Loading from checkpoint {}".format(args.resume_checkpoint))
-        _model = torch.load(args.resume_checkpoint)
+        _model = load_file(args.resume_checkpoint)
     else:
         # init three transformer-encoder blocks in a loop
         for i in range(len(output_feat_dim)):
@@ -651,6 +845,8 @@ def main(args):
 
             config.output_attentions = False
             config.hidden_dropout_prob = args.drop_out
+            config.checkpoint_layers = args.checkpoint_graphormer
+            config.skip_unused_modules = args.skip_unused_modules
             config.img_feature_dim = input_feat_dim[i] 
             config.output_feature_dim = output_feat_dim[i]
             args.hidden_size = hidden_feat_dim[i]
@@ -686,13 +882,17 @@ def main(args):
             hrnet_yaml = 'models/hrnet/cls_hrnet_w40_sgd_lr5e-2_wd1e-4_bs32_x100.yaml'
             hrnet_checkpoint = 'models/hrnet/hrnetv2_w40_imagenet_pretrained.pth'
             hrnet_update_config(hrnet_config, hrnet_yaml)
-            backbone = get_cls_net_gridfeat(hrnet_config, pretrained=hrnet_checkpoint)
+            backbone = get_cls_net_gridfeat(hrnet_config, pretrained=hrnet_checkpoint,
+                                            checkpoint_stages=args.checkpoint_hrnet_stages,
+                                            with_classifier=not args.skip_unused_modules)
             logger.info('=> loading hrnet-v2-w40 model')
         elif args.arch=='hrnet-w64':
             hrnet_yaml = 'models/hrnet/cls_hrnet_w64_sgd_lr5e-2_wd1e-4_bs32_x100.yaml'
             hrnet_checkpoint = 'models/hrnet/hrnetv2_w64_imagenet_pretrained.pth'
             hrnet_update_config(hrnet_config, hrnet_yaml)
-            backbone = get_cls_net_gridfeat(hrnet_config, pretrained=hrnet_checkpoint)
+            backbone = get_cls_net_gridfeat(hrnet_config, pretrained=hrnet_checkpoint,
+                                            checkpoint_stages=args.checkpoint_hrnet_stages,
+                                            with_classifier=not args.skip_unused_modules)
             logger.info('=> loading hrnet-v2-w64 model')
         else:
             print("=> using pre-trained model '{}'".format(args.arch))
@@ -713,14 +913,8 @@ def main(args):
         if args.resume_checkpoint!=None and args.resume_checkpoint!='None':
             # for fine-tuning or resume training or inference, load weights from checkpoint
             logger.info("Loading state dict from checkpoint {}".format(args.resume_checkpoint))
-            # workaround approach to load sparse tensor in graph conv.
-            states = torch.load(args.resume_checkpoint)
-            # states = checkpoint_loaded.state_dict()
-            for k, v in states.items():
-                states[k] = v.cpu()
-            # del checkpoint_loaded
-            _model.load_state_dict(states, strict=False)
-            del states
+            # memory-mapped onto the CPU, also for the sparse tensors in graph conv.
+            load_weights(_model, args.resume_checkpoint)
             gc.collect()
             torch.cuda.empty_cache()
 
@@ -736,9 +930,21 @@ def main(args):
     else:
         train_dataloader = make_data_loader(args, args.train_yaml, 
                                             args.distributed, is_train=True, scale_factor=args.img_scale_factor)
+        # data position of the resumed run, from the training state of --resume or
+        # from the sampler_state.bin next to --resume_checkpoint with --resume_sampler
+        sampler_state = None
+        if training_state is not None:
+            if args.resume_sampler:
+                logger.warning("--resume_sampler is ignored, --resume restores the data position")
+            sampler_state = training_state['sampler']
+        elif args.resume_sampler:
+            sampler_state = torch.load(op.join(op.dirname(args.resume_checkpoint), 'sampler_state.bin'))
+        if sampler_state is not None:
+            train_dataloader.batch_sampler.load_state_dict(sampler_state)
+            logger.info("Resume training data at iteration {}".format(sampler_state['iteration']))
         val_dataloader = make_data_loader(args, args.val_yaml, 
                                         args.distributed, is_train=False, scale_factor=args.img_scale_factor)
-        run(args, train_dataloader, val_dataloader, _model, smpl, mesh_sampler, renderer)
+        run(args, train_dataloader, val_dataloader, _model, smpl, mesh_sampler, renderer, training_state)
 
 
 
@@ -11,7 +11,6 @@ import argparse
 import os
 import os.path as op
 import code
-import json
 import time
 import datetime
 import torch
@@ -27,12 +26,18 @@ from src.modeling.hrnet.hrnet_cls_net_gridfeat import get_cls_net_gridfeat
 from src.modeling.hrnet.config import config as hrnet_config
 from src.modeling.hrnet.config import update_config as hrnet_update_config
 import src.modeling.data.config as cfg
+from src.datasets.batch_augment import BatchAugmentation
 from src.datasets.build import make_hand_data_loader
 
 from src.utils.logger import setup_logger
 from src.utils.comm import synchronize, is_main_process, get_rank, get_world_size, all_gather
-from src.utils.miscellaneous import mkdir, set_seed
+from src.utils.miscellaneous import mkdir, set_seed, autocast, make_grad_scaler, grad_sync_context, \
+    make_distributed_model
+from src.utils.checkpoint import CheckpointWriter, snapshot_state_dict, write_checkpoint, \
+    make_training_state, load_training_state, restore_rng_state, find_last_checkpoint, load_file, load_weights
 from src.utils.metric_logger import AverageMeter
+from src.utils.prediction_writer import PredictionWriter, merge_prediction_files, export_pred_json
+from src.utils.feature_cache import open_feature_cache, backbone_features
 from src.utils.renderer import Renderer, visualize_reconstruction, visualize_reconstruction_test, visualize_reconstruction_no_text
 from src.utils.metric_pampjpe import reconstruction_error
 from src.utils.geometric_layers import orthographic_projection
@@ -40,24 +45,22 @@ from src.utils.geometric_layers import orthographic_projection
 from azureml.core.run import Run
 aml_run = Run.get_context()
 
-def save_checkpoint(model, args, epoch, iteration, num_trial=10):
+def save_checkpoint(model, args, epoch, iteration, sampler_state=None, checkpoint_writer=None, metric=None,
+                    training_state=None):
     checkpoint_dir = op.join(args.output_dir, 'checkpoint-{}-{}'.format(
         epoch, iteration))
     if not is_main_process():
         return checkpoint_dir
-    mkdir(checkpoint_dir)
-    model_to_save = model.module if hasattr(model, 'module') else model
-    for i in range(num_trial):
-        try:
-            torch.save(model_to_save, op.join(checkpoint_dir, 'model.bin'))
-            torch.save(model_to_save.state_dict(), op.join(checkpoint_dir, 'state_dict.bin'))
-            torch.save(args, op.join(checkpoint_dir, 'training_args.bin'))
-            logger.info("Save checkpoint to {}".format(checkpoint_dir))
-            break
-        except:
-            pass
-    else:
-        logger.info("Failed to save checkpoint after {} trails.".format(num_trial))
+    # training only waits for the copy to host memory
+    files = {'state_dict.bin': snapshot_state_dict(model), 'training_args.bin': args}
+    if sampler_state is not None:
+        files['sampler_state.bin'] = sampler_state
+    if training_state is not None:
+        files['training_state.bin'] = training_state
+    if checkpoint_writer is not None:
+        return checkpoint_writer.save(checkpoint_dir, files, metric=metric)
+    write_checkpoint(checkpoint_dir, files)
+    logger.info("Save checkpoint to {}".format(checkpoint_dir))
     return checkpoint_dir
 
 def adjust_learning_rate(optimizer, epoch, args):
@@ -94,7 +97,7 @@ def keypoint_3d_loss(criterion_keypoints, pred_keypoints_3d, gt_keypoints_3d, ha
         pred_keypoints_3d = pred_keypoints_3d - pred_root[:, None, :]
         return (conf * criterion_keypoints(pred_keypoints_3d, gt_keypoints_3d)).mean()
     else:
-        return torch.FloatTensor(1).fill_(0.).cuda()
+        return torch.FloatTensor(1).fill_(0.).to(pred_keypoints_3d.device)
 
 def vertices_loss(criterion_vertices, pred_vertices, gt_vertices, has_smpl):
     """
@@ -105,30 +108,53 @@ def vertices_loss(criterion_vertices, pred_vertices, gt_vertices, has_smpl):
     if len(gt_vertices_with_shape) > 0:
         return criterion_vertices(pred_vertices_with_shape, gt_vertices_with_shape)
     else:
-        return torch.FloatTensor(1).fill_(0.).cuda()
+        return torch.FloatTensor(1).fill_(0.).to(pred_vertices.device)
     
 
-def run(args, train_dataloader, Graphormer_model, mano_model, renderer, mesh_sampler):
-
+def make_feature_cache(args, data_loader, Graphormer_model, is_train=False):
+    """Backbone feature cache of the data of data_loader, with --backbone_feature_cache.
+    It is only used while the backbone is fixed: frozen, or in evaluation only.
+    Training data only uses it with --cache_train_features."""
+    if not args.backbone_feature_cache or not (args.freeze_backbone or args.run_eval_only):
+        return None
+    if is_train:
+        if not args.cache_train_features:
+            return None
+        logger.warning("--cache_train_features: the training data is not augmented, "
+                       "the feature cache holds a single crop of every sample")
+    model = Graphormer_model.module if hasattr(Graphormer_model, 'module') else Graphormer_model
+    return open_feature_cache(args.backbone_feature_cache, data_loader.dataset, model.backbone,
+                              dtype=args.backbone_feature_cache_dtype)
+
+def get_backbone_feats(Graphormer_model, images, annotations, feature_cache):
+    if feature_cache is None:
+        return None
+    model = Graphormer_model.module if hasattr(Graphormer_model, 'module') else Graphormer_model
+    return backbone_features(model.backbone, images, annotations['row'], feature_cache)
+
+def run(args, train_dataloader, Graphormer_model, mano_model, renderer, mesh_sampler, training_state=None):
+
+    # iterations count micro-batches, steps count optimizer steps
+    accum_steps = args.gradient_accumulation_steps
     max_iter = len(train_dataloader)
-    iters_per_epoch = max_iter // args.num_train_epochs
+    max_steps = (max_iter + accum_steps - 1) // accum_steps
+    steps_per_epoch = max_steps // args.num_train_epochs
 
     optimizer = torch.optim.Adam(params=list(Graphormer_model.parameters()),
                                            lr=args.lr,
                                            betas=(0.9, 0.999),
                                            weight_decay=0)
 
+    # features of the frozen backbone, computed once per training sample
+    train_feature_cache = make_feature_cache(args, train_dataloader, Graphormer_model, is_train=True)
+
     # define loss function (criterion) and optimizer
-    criterion_2d_keypoints = torch.nn.MSELoss(reduction='none').cuda(args.device)
-    criterion_keypoints = torch.nn.MSELoss(reduction='none').cuda(args.device)
-    criterion_vertices = torch.nn.L1Loss().cuda(args.device)
+    criterion_2d_keypoints = torch.nn.MSELoss(reduction='none').to(args.device)
+    criterion_keypoints = torch.nn.MSELoss(reduction='none').to(args.device)
+    criterion_vertices = torch.nn.L1Loss().to(args.device)
 
     if args.distributed:
-        Graphormer_model = torch.nn.parallel.DistributedDataParallel(
-            Graphormer_model, device_ids=[args.local_rank], 
-            output_device=args.local_rank,
-            find_unused_parameters=True,
-        )
+        Graphormer_model = make_distributed_model(Graphormer_model, args)
 
     start_training_time = time.time()
     end = time.time()
@@ -140,24 +166,47 @@ def run(args, train_dataloader, Graphormer_model, mano_model, renderer, mesh_sam
     log_loss_3djoints = AverageMeter()
     log_loss_vertices = AverageMeter()
 
-    for iteration, (img_keys, images, annotations) in enumerate(train_dataloader):
+    # rotation, flip, pixel noise and normalization of the training batches
+    batch_augment = BatchAugmentation() if args.device_augment else None
+    scaler = make_grad_scaler(args)
+    # checkpoints are written by a background thread of the main process
+    checkpoint_writer = CheckpointWriter(args.keep_last_checkpoints) \
+        if is_main_process() else None
+
+    if training_state is not None:
+        optimizer.load_state_dict(training_state['optimizer'])
+        # empty if the run was resumed from has no loss scaling
+        if training_state['scaler']:
+            scaler.load_state_dict(training_state['scaler'])
+        restore_rng_state(training_state)
+
+    # continue counting from the resumed iteration, if any
+    start_iter = train_dataloader.batch_sampler.start_iter
+    for iteration, (img_keys, images, annotations) in enumerate(train_dataloader, start_iter):
 
         Graphormer_model.train()
         iteration += 1
-        epoch = iteration // iters_per_epoch
+        # the optimizer steps after every accum_steps micro-batches
+        is_update = iteration % accum_steps == 0 or iteration == max_iter
+        step = (iteration + accum_steps - 1) // accum_steps
+        # the last window is shorter if max_iter is not a multiple of accum_steps
+        window_size = min(accum_steps, max_iter - (step - 1) * accum_steps)
+        epoch = step // steps_per_epoch
         batch_size = images.size(0)
         adjust_learning_rate(optimizer, epoch, args)
         data_time.update(time.time() - end)
 
-        images = images.cuda()
-        gt_2d_joints = annotations['joints_2d'].cuda()
-        gt_pose = annotations['pose'].cuda()
-        gt_betas = annotations['betas'].cuda()
-        has_mesh = annotations['has_smpl'].cuda()
+        images = images.to(args.device)
+        if batch_augment is not None:
+            images = batch_augment(images, annotations)
+        gt_2d_joints = annotations['joints_2d'].to(args.device)
+        gt_pose = annotations['pose'].to(args.device)
+        gt_betas = annotations['betas'].to(args.device)
+        has_mesh = annotations['has_smpl'].to(args.device)
         has_3d_joints = has_mesh
         has_2d_joints = has_mesh
-        mjm_mask = annotations['mjm_mask'].cuda()
-        mvm_mask = annotations['mvm_mask'].cuda()
+        mjm_mask = annotations['mjm_mask'].to(args.device)
+        mvm_mask = annotations['mvm_mask'].to(args.device)
 
         # generate mesh
         gt_vertices, gt_3d_joints = mano_model.layer(gt_pose, gt_betas)
@@ -170,7 +219,7 @@ def run(args, train_dataloader, Graphormer_model, mano_model, renderer, mesh_sam
         gt_vertices = gt_vertices - gt_3d_root[:, None, :]
         gt_vertices_sub = gt_vertices_sub - gt_3d_root[:, None, :]
         gt_3d_joints = gt_3d_joints - gt_3d_root[:, None, :]
-        gt_3d_joints_with_tag = torch.ones((batch_size,gt_3d_joints.shape[1],4)).cuda()
+        gt_3d_joints_with_tag = torch.ones((batch_size,gt_3d_joints.shape[1],4)).to(args.device)
         gt_3d_joints_with_tag[:,:,:3] = gt_3d_joints
 
         # prepare masks for mask vertex/joint modeling
@@ -178,56 +227,65 @@ def run(args, train_dataloader, Graphormer_model, mano_model, renderer, mesh_sam
         mvm_mask_ = mvm_mask.expand(-1,-1,2051)
         meta_masks = torch.cat([mjm_mask_, mvm_mask_], dim=1)
         
-        # forward-pass
-        pred_camera, pred_3d_joints, pred_vertices_sub, pred_vertices = Graphormer_model(images, mano_model, mesh_sampler, meta_masks=meta_masks, is_train=True)
-
-        # obtain 3d joints, which are regressed from the full mesh
-        pred_3d_joints_from_mesh = mano_model.get_3d_joints(pred_vertices)
+        # all-reduce the gradients only in the last micro-batch of a step
+        with grad_sync_context(Graphormer_model, is_update):
+            # forward-pass, in mixed precision with --amp
+            with autocast(args):
+                backbone_feats = get_backbone_feats(Graphormer_model, images, annotations, train_feature_cache)
+                outputs = Graphormer_model(images, mano_model, mesh_sampler, meta_masks=meta_masks, is_train=True,
+                                           backbone_feats=backbone_feats)
+            # mesh regression and losses in float32
+            pred_camera, pred_3d_joints, pred_vertices_sub, pred_vertices = [o.float() for o in outputs]
+
+            # obtain 3d joints, which are regressed from the full mesh
+            pred_3d_joints_from_mesh = mano_model.get_3d_joints(pred_vertices)
 
-        # obtain 2d joints, which are projected from 3d joints of smpl mesh
-        pred_2d_joints_from_mesh = orthographic_projection(pred_3d_joints_from_mesh.contiguous(), pred_camera.contiguous())
-        pred_2d_joints = orthographic_projection(pred_3d_joints.contiguous(), pred_camera.contiguous())
+            # obtain 2d joints, which are projected from 3d joints of smpl mesh
+            pred_2d_joints_from_mesh = orthographic_projection(pred_3d_joints_from_mesh.contiguous(), pred_camera.contiguous())
+            pred_2d_joints = orthographic_projection(pred_3d_joints.contiguous(), pred_camera.contiguous())
         
-        # compute 3d joint loss  (where the joints are directly output from transformer)
-        loss_3d_joints = keypoint_3d_loss(criterion_keypoints, pred_3d_joints, gt_3d_joints_with_tag, has_3d_joints)
-
-        # compute 3d vertex loss
-        loss_vertices = ( args.vloss_w_sub * vertices_loss(criterion_vertices, pred_vertices_sub, gt_vertices_sub, has_mesh) + \
-                            args.vloss_w_full * vertices_loss(criterion_vertices, pred_vertices, gt_vertices, has_mesh) )
-
-        # compute 3d joint loss (where the joints are regressed from full mesh)
-        loss_reg_3d_joints = keypoint_3d_loss(criterion_keypoints, pred_3d_joints_from_mesh, gt_3d_joints_with_tag, has_3d_joints)
-        # compute 2d joint loss
-        loss_2d_joints = keypoint_2d_loss(criterion_2d_keypoints, pred_2d_joints, gt_2d_joints, has_2d_joints)  + \
-                         keypoint_2d_loss(criterion_2d_keypoints, pred_2d_joints_from_mesh, gt_2d_joints, has_2d_joints)
+            # compute 3d joint loss  (where the joints are directly output from transformer)
+            loss_3d_joints = keypoint_3d_loss(criterion_keypoints, pred_3d_joints, gt_3d_joints_with_tag, has_3d_joints)
+
+            # compute 3d vertex loss
+            loss_vertices = ( args.vloss_w_sub * vertices_loss(criterion_vertices, pred_vertices_sub, gt_vertices_sub, has_mesh) + \
+                                args.vloss_w_full * vertices_loss(criterion_vertices, pred_vertices, gt_vertices, has_mesh) )
+
+            # compute 3d joint loss (where the joints are regressed from full mesh)
+            loss_reg_3d_joints = keypoint_3d_loss(criterion_keypoints, pred_3d_joints_from_mesh, gt_3d_joints_with_tag, has_3d_joints)
+            # compute 2d joint loss
+            loss_2d_joints = keypoint_2d_loss(criterion_2d_keypoints, pred_2d_joints, gt_2d_joints, has_2d_joints)  + \
+                             keypoint_2d_loss(criterion_2d_keypoints, pred_2d_joints_from_mesh, gt_2d_joints, has_2d_joints)
         
-        loss_3d_joints = loss_3d_joints + loss_reg_3d_joints
+            loss_3d_joints = loss_3d_joints + loss_reg_3d_joints
             
-        # we empirically use hyperparameters to balance difference losses
-        loss = args.joints_loss_weight*loss_3d_joints + \
-                args.vertices_loss_weight*loss_vertices  + args.vertices_loss_weight*loss_2d_joints
-
-        # update logs
-        log_loss_2djoints.update(loss_2d_joints.item(), batch_size)
-        log_loss_3djoints.update(loss_3d_joints.item(), batch_size)
-        log_loss_vertices.update(loss_vertices.item(), batch_size)
-        log_losses.update(loss.item(), batch_size)
-
-        # back prop
-        optimizer.zero_grad()
-        loss.backward() 
-        optimizer.step()
+            # we empirically use hyperparameters to balance difference losses
+            loss = args.joints_loss_weight*loss_3d_joints + \
+                    args.vertices_loss_weight*loss_vertices  + args.vertices_loss_weight*loss_2d_joints
+
+            # update logs
+            log_loss_2djoints.update(loss_2d_joints.item(), batch_size)
+            log_loss_3djoints.update(loss_3d_joints.item(), batch_size)
+            log_loss_vertices.update(loss_vertices.item(), batch_size)
+            log_losses.update(loss.item(), batch_size)
+
+            # back prop, gradients of the micro-batches are summed up
+            scaler.scale(loss / window_size).backward()
+        if is_update:
+            scaler.step(optimizer)
+            scaler.update()
+            optimizer.zero_grad()
 
         batch_time.update(time.time() - end)
         end = time.time()
 
-        if iteration % args.logging_steps == 0 or iteration == max_iter:
+        if is_update and (step % args.logging_steps == 0 or step == max_steps):
             eta_seconds = batch_time.avg * (max_iter - iteration)
             eta_string = str(datetime.timedelta(seconds=int(eta_seconds)))
             logger.info(
                 ' '.join(
                 ['eta: {eta}', 'epoch: {ep}', 'iter: {iter}', 'max mem : {memory:.0f}',]
-                ).format(eta=eta_string, ep=epoch, iter=iteration, 
+                ).format(eta=eta_string, ep=epoch, iter=step, 
                     memory=torch.cuda.max_memory_allocated() / 1024.0 / 1024.0) 
                 + '  loss: {:.4f}, 2d joint loss: {:.4f}, 3d joint loss: {:.4f}, vertex loss: {:.4f}, compute: {:.4f}, data: {:.4f}, lr: {:.6f}'.format(
                     log_losses.avg, log_loss_2djoints.avg, log_loss_3djoints.avg, log_loss_vertices.avg, batch_time.avg, data_time.avg, 
@@ -255,29 +313,36 @@ def run(args, train_dataloader, Graphormer_model, mano_model, renderer, mesh_sam
                 cv2.imwrite(temp_fname, np.asarray(visual_imgs[:,:,::-1]*255))
                 aml_run.log_image(name='visual results', path=temp_fname)
 
-        if iteration % iters_per_epoch == 0:
+        if is_update and step % steps_per_epoch == 0:
             if epoch%10==0:
-                checkpoint_dir = save_checkpoint(Graphormer_model, args, epoch, iteration)
+                sampler_state = train_dataloader.batch_sampler.state_dict(iteration)
+                checkpoint_dir = save_checkpoint(Graphormer_model, args, epoch, iteration,
+                        sampler_state=sampler_state,
+                        checkpoint_writer=checkpoint_writer,
+                        training_state=make_training_state(optimizer, scaler, sampler_state))
 
     total_training_time = time.time() - start_training_time
     total_time_str = str(datetime.timedelta(seconds=total_training_time))
     logger.info('Total training time: {} ({:.4f} s / iter)'.format(
         total_time_str, total_training_time / max_iter)
     )
-    checkpoint_dir = save_checkpoint(Graphormer_model, args, epoch, iteration)
+    sampler_state = train_dataloader.batch_sampler.state_dict(iteration)
+    checkpoint_dir = save_checkpoint(Graphormer_model, args, epoch, iteration,
+                        sampler_state=sampler_state,
+                        checkpoint_writer=checkpoint_writer,
+                        training_state=make_training_state(optimizer, scaler, sampler_state))
+    if checkpoint_writer is not None:
+        checkpoint_writer.close()
 
 def run_eval_and_save(args, split, val_dataloader, Graphormer_model, mano_model, renderer, mesh_sampler):
 
-    criterion_keypoints = torch.nn.MSELoss(reduction='none').cuda(args.device)
-    criterion_vertices = torch.nn.L1Loss().cuda(args.device)
+    criterion_keypoints = torch.nn.MSELoss(reduction='none').to(args.device)
+    criterion_vertices = torch.nn.L1Loss().to(args.device)
 
     if args.distributed:
-        Graphormer_model = torch.nn.parallel.DistributedDataParallel(
-            Graphormer_model, device_ids=[args.local_rank], 
-            output_device=args.local_rank,
-            find_unused_parameters=True,
-        )
+        Graphormer_model = make_distributed_model(Graphormer_model, args)
     Graphormer_model.eval()
+    feature_cache = make_feature_cache(args, val_dataloader, Graphormer_model)
 
     if args.aml_eval==True:
         run_aml_inference_hand_mesh(args, val_dataloader, 
@@ -286,7 +351,7 @@ def run_eval_and_save(args, split, val_dataloader, Graphormer_model, mano_model,
                                 criterion_vertices, 
                                 0, 
                                 mano_model, mesh_sampler,
-                                renderer, split)
+                                renderer, split, feature_cache)
     else:
         run_inference_hand_mesh(args, val_dataloader, 
                                 Graphormer_model, 
@@ -294,72 +359,93 @@ def run_eval_and_save(args, split, val_dataloader, Graphormer_model, mano_model,
                                 criterion_vertices, 
                                 0, 
                                 mano_model, mesh_sampler,
-                                renderer, split)
+                                renderer, split, feature_cache)
     checkpoint_dir = save_checkpoint(Graphormer_model, args, 0, 0)
     return
 
-def run_aml_inference_hand_mesh(args, val_loader, Graphormer_model, criterion, criterion_vertices, epoch, mano_model, mesh_sampler, renderer, split):
+def get_pred_file(output_prefix, rank=None):
+    if rank is None:
+        return output_prefix + '-pred.npz'
+    return output_prefix + '-pred.rank{}.npz'.format(rank)
+
+def make_pred_writer(output_prefix):
+    """Each rank writes the predictions of its part of the test set to its own file."""
+    if get_world_size() > 1:
+        return PredictionWriter(get_pred_file(output_prefix, get_rank()))
+    return PredictionWriter(get_pred_file(output_prefix))
+
+def save_pred_file(args, val_loader, pred_writer, output_prefix):
+    """Finish writing the predictions of all ranks, and merge them on the main
+    process into one file in the order of the dataset."""
+    pred_writer.close()
+    pred_file = get_pred_file(output_prefix)
+    world_size = get_world_size()
+    if world_size > 1:
+        torch.distributed.barrier()
+        if is_main_process():
+            dataset = val_loader.dataset
+            img_keys = [dataset.get_img_key(i) for i in range(len(dataset))]
+            rank_files = [get_pred_file(output_prefix, r) for r in range(world_size)]
+            merge_prediction_files(rank_files, pred_file, img_keys)
+            for rank_file in rank_files:
+                os.remove(rank_file)
+    if is_main_process():
+        print('save results to ', pred_file)
+        if args.export_pred_json:
+            output_zip_file = export_pred_json(pred_file, output_prefix + '-pred.zip')
+            print('save pred.json to ', output_zip_file)
+    if world_size > 1:
+        torch.distributed.barrier()
+    return pred_file
+
+def run_aml_inference_hand_mesh(args, val_loader, Graphormer_model, criterion, criterion_vertices, epoch, mano_model, mesh_sampler, renderer, split,
+        feature_cache=None):
     # switch to evaluate mode
     Graphormer_model.eval()
-    fname_output_save = []
-    mesh_output_save = []
-    joint_output_save = []
-    world_size = get_world_size()
+    azure_ckpt_name = '200' # args.resume_checkpoint.split('/')[-2].split('-')[1]
+    inference_setting = 'sc%02d_rot%s'%(int(args.sc*10),str(int(args.rot)))
+    output_prefix = args.output_dir + 'ckpt' + azure_ckpt_name + '-' + inference_setting
+    # predictions are written in the background while inference continues
+    pred_writer = make_pred_writer(output_prefix)
     with torch.no_grad():
         for i, (img_keys, images, annotations) in enumerate(val_loader):
             batch_size = images.size(0)
             # compute output
-            images = images.cuda()
+            images = images.to(args.device)
             
             # forward-pass
-            pred_camera, pred_3d_joints, pred_vertices_sub, pred_vertices = Graphormer_model(images, mano_model, mesh_sampler)
+            backbone_feats = get_backbone_feats(Graphormer_model, images, annotations, feature_cache)
+            pred_camera, pred_3d_joints, pred_vertices_sub, pred_vertices = Graphormer_model(images, mano_model, mesh_sampler,
+                                                                                             backbone_feats=backbone_feats)
             # obtain 3d joints from full mesh
             pred_3d_joints_from_mesh = mano_model.get_3d_joints(pred_vertices)
 
-            for j in range(batch_size):
-                fname_output_save.append(img_keys[j])
-                pred_vertices_list = pred_vertices[j].tolist()
-                mesh_output_save.append(pred_vertices_list)
-                pred_3d_joints_from_mesh_list = pred_3d_joints_from_mesh[j].tolist()
-                joint_output_save.append(pred_3d_joints_from_mesh_list)
-
-    if world_size > 1:
-        torch.distributed.barrier()
-    print('save results to pred.json')
-    output_json_file = 'pred.json'
-    print('save results to ', output_json_file)
-    with open(output_json_file, 'w') as f:
-        json.dump([joint_output_save, mesh_output_save], f)
+            pred_writer.add(img_keys, joints=pred_3d_joints_from_mesh, vertices=pred_vertices)
 
-    azure_ckpt_name = '200' # args.resume_checkpoint.split('/')[-2].split('-')[1]
-    inference_setting = 'sc%02d_rot%s'%(int(args.sc*10),str(int(args.rot)))
-    output_zip_file = args.output_dir + 'ckpt' + azure_ckpt_name + '-' + inference_setting +'-pred.zip'
-
-    resolved_submit_cmd = 'zip ' + output_zip_file + ' ' + output_json_file
-    print(resolved_submit_cmd)
-    os.system(resolved_submit_cmd)
-    resolved_submit_cmd = 'rm %s'%(output_json_file)
-    print(resolved_submit_cmd)
-    os.system(resolved_submit_cmd)
-    if world_size > 1:
-        torch.distributed.barrier()
+    save_pred_file(args, val_loader, pred_writer, output_prefix)
 
     return 
 
-def run_inference_hand_mesh(args, val_loader, Graphormer_model, criterion, criterion_vertices, epoch, mano_model, mesh_sampler, renderer, split):
+def run_inference_hand_mesh(args, val_loader, Graphormer_model, criterion, criterion_vertices, epoch, mano_model, mesh_sampler, renderer, split,
+        feature_cache=None):
     # switch to evaluate mode
     Graphormer_model.eval()
-    fname_output_save = []
-    mesh_output_save = []
-    joint_output_save = []
+    run_exp_name = args.resume_checkpoint.split('/')[-3]
+    run_ckpt_name = args.resume_checkpoint.split('/')[-2].split('-')[1]
+    inference_setting = 'sc%02d_rot%s'%(int(args.sc*10),str(int(args.rot)))
+    output_prefix = args.output_dir + run_exp_name + '-ckpt'+ run_ckpt_name + '-' + inference_setting
+    # predictions are written in the background while inference continues
+    pred_writer = make_pred_writer(output_prefix)
     with torch.no_grad():
         for i, (img_keys, images, annotations) in enumerate(val_loader):
             batch_size = images.size(0)
             # compute output
-            images = images.cuda()
+            images = images.to(args.device)
 
             # forward-pass
-            pred_camera, pred_3d_joints, pred_vertices_sub, pred_vertices = Graphormer_model(images, mano_model, mesh_sampler)
+            backbone_feats = get_backbone_feats(Graphormer_model, images, annotations, feature_cache)
+            pred_camera, pred_3d_joints, pred_vertices_sub, pred_vertices = Graphormer_model(images, mano_model, mesh_sampler,
+                                                                                             backbone_feats=backbone_feats)
 
             # obtain 3d joints from full mesh
             pred_3d_joints_from_mesh = mano_model.get_3d_joints(pred_vertices)
@@ -367,12 +453,7 @@ def run_inference_hand_mesh(args, val_loader, Graphormer_model, criterion, crite
             pred_3d_joints_from_mesh = pred_3d_joints_from_mesh - pred_3d_pelvis[:, None, :]
             pred_vertices = pred_vertices - pred_3d_pelvis[:, None, :]
 
-            for j in range(batch_size):
-                fname_output_save.append(img_keys[j])
-                pred_vertices_list = pred_vertices[j].tolist()
-                mesh_output_save.append(pred_vertices_list)
-                pred_3d_joints_from_mesh_list = pred_3d_joints_from_mesh[j].tolist()
-                joint_output_save.append(pred_3d_joints_from_mesh_list)
+            pred_writer.add(img_keys, joints=pred_3d_joints_from_mesh, vertices=pred_vertices)
 
             if i%20==0:
                 # obtain 3d joints, which are regressed from the full mesh
@@ -394,19 +475,7 @@ def run_inference_hand_mesh(args, val_loader, Graphormer_model, criterion, crite
                 temp_fname = args.output_dir + args.resume_checkpoint[0:-9] + 'freihand_results_'+inference_setting+'_batch'+str(i)+'.jpg'
                 cv2.imwrite(temp_fname, np.asarray(visual_imgs[:,:,::-1]*255))
 
-    print('save results to pred.json')
-    with open('pred.json', 'w') as f:
-        json.dump([joint_output_save, mesh_output_save], f)
-
-    run_exp_name = args.resume_checkpoint.split('/')[-3]
-    run_ckpt_name = args.resume_checkpoint.split('/')[-2].split('-')[1]
-    inference_setting = 'sc%02d_rot%s'%(int(args.sc*10),str(int(args.rot)))
-    resolved_submit_cmd = 'zip ' + args.output_dir + run_exp_name + '-ckpt'+ run_ckpt_name + '-' + inference_setting +'-pred.zip  ' +  'pred.json'
-    print(resolved_submit_cmd)
-    os.system(resolved_submit_cmd)
-    resolved_submit_cmd = 'rm pred.json'
-    print(resolved_submit_cmd)
-    os.system(resolved_submit_cmd)
+    save_pred_file(args, val_loader, pred_writer, output_prefix)
     return 
 
 def visualize_mesh( renderer,
@@ -500,11 +569,56 @@ def parse_args():
                         help="Workers in dataloader.")       
     parser.add_argument("--img_scale_factor", default=1, type=int, 
                         help="adjust image resolution.")  
+    parser.add_argument("--fast_crop", default=False, action='store_true',
+                        help="Crop, rotate and resize images with a single warpAffine.")
+    parser.add_argument("--fused_normalize", default=False, action='store_true',
+                        help="Fuse pixel noise and normalization into one lookup table pass. "
+                        "Implies the warpAffine crop of --fast_crop.")
+    parser.add_argument("--device_augment", default=False, action='store_true',
+                        help="Training workers only crop uint8 canvases; rotation, flip, "
+                        "pixel noise and normalization run batched on the training device.")
+    parser.add_argument("--reduced_decode", default=False, action='store_true',
+                        help="Decode large JPEG frames at 1/2, 1/4 or 1/8 resolution when "
+                        "the bounding box still covers the input resolution (needs the hw tsv).")
+    parser.add_argument("--freeze_backbone", default=False, action='store_true',
+                        help="Train the Graphormer encoders only, with the backbone fixed.")
+    parser.add_argument("--backbone_feature_cache", default=None, type=str, required=False,
+                        help="Directory of the on-disk cache of backbone features, used for "
+                        "evaluation with --freeze_backbone or --run_eval_only. Disabled if not given.")
+    parser.add_argument("--backbone_feature_cache_dtype", default='float16', type=str,
+                        choices=['float16', 'float32'],
+                        help="Storage type of the cached backbone features. float16 halves the "
+                        "cache size, but results differ slightly from runs without the cache; "
+                        "float32 reproduces them.")
+    parser.add_argument("--cache_train_features", default=False, action='store_true',
+                        help="With --freeze_backbone and --backbone_feature_cache, also cache the "
+                        "features of the training data. Epochs after the first skip the backbone, "
+                        "but the training data is then not augmented (no scale, rotation, flip "
+                        "or pixel noise), which can cost accuracy.")
+    parser.add_argument("--eval_crop_cache", default=None, type=str, required=False,
+                        help="Directory of the on-disk cache of processed evaluation samples. "
+                        "Disabled if not given.")
+    parser.add_argument("--locality_sampler", default=False, action='store_true',
+                        help="Shuffle training data by blocks of consecutive TSV rows and "
+                        "a shuffle buffer, for mostly sequential reads.")
+    parser.add_argument("--sampler_block_size", default=256, type=int,
+                        help="Rows per block of the locality sampler.")
+    parser.add_argument("--sampler_buffer_size", default=1024, type=int,
+                        help="Shuffle buffer size of the locality sampler.")
     #########################################################
     # Loading/saving checkpoints
     #########################################################
     parser.add_argument("--model_name_or_path", default='src/modeling/bert/bert-base-uncased/', type=str, required=False,
                         help="Path to pre-trained transformer model or model type.")
+    parser.add_argument("--resume", default=None, type=str, required=False,
+                        help="Checkpoint directory to continue training from, with its optimizer, "
+                        "loss scaler, RNG and data position; 'auto' picks the last one in output_dir.")
+    parser.add_argument("--resume_sampler", default=False, action='store_true',
+                        help="Continue the training data order from the sampler_state.bin "
+                        "saved next to --resume_checkpoint, without replaying earlier batches. "
+                        "Not needed with --resume, which restores the data position itself.")
+    parser.add_argument("--keep_last_checkpoints", default=0, type=int,
+                        help="Keep only the last N checkpoints of the run; 0 keeps all.")
     parser.add_argument("--resume_checkpoint", default=None, type=str, required=False,
                         help="Path to specific checkpoint for resume training.")
     parser.add_argument("--output_dir", default='output/', type=str, required=False,
@@ -522,6 +636,9 @@ def parse_args():
                         help="Batch size per GPU/CPU for evaluation.")
     parser.add_argument('--lr', "--learning_rate", default=1e-4, type=float, 
                         help="The initial lr.")
+    parser.add_argument("--gradient_accumulation_steps", default=1, type=int,
+                        help="Micro-batches per optimizer step; the effective batch size is "
+                        "per_gpu_train_batch_size * world size * gradient_accumulation_steps.")
     parser.add_argument("--num_train_epochs", default=200, type=int, 
                         help="Total number of training epochs to perform.")
     parser.add_argument("--vertices_loss_weight", default=1.0, type=float)          
@@ -530,6 +647,11 @@ def parse_args():
     parser.add_argument("--vloss_w_sub", default=0.5, type=float)  
     parser.add_argument("--drop_out", default=0.1, type=float, 
                         help="Drop out ratio in BERT.")
+    parser.add_argument("--amp", default=False, action='store_true',
+                        help="Mixed precision training with autocast and loss scaling. "
+                        "SMPL/MANO, the sparse mesh sampling and the losses stay in float32.")
+    parser.add_argument("--amp_dtype", default='float16', type=str, choices=['float16', 'bfloat16'],
+                        help="Autocast dtype on GPU; bfloat16 is always used on CPU.")
     #########################################################
     # Model architectures
     #########################################################
@@ -548,6 +670,20 @@ def parse_args():
                         help="The Image Feature Dimension.")  
     parser.add_argument("--which_gcn", default='0,0,1', type=str, 
                         help="which encoder block to have graph conv. Encoder1, Encoder2, Encoder3. Default: only Encoder3 has graph conv") 
+    parser.add_argument("--checkpoint_hrnet_stages", default=[], type=str, nargs='*',
+                        choices=['stage2', 'stage3', 'stage4'],
+                        help="HRNet stages whose activations are recomputed in the backward "
+                        "pass, to save memory at the cost of compute.")
+    parser.add_argument("--checkpoint_graphormer", default=False, action='store_true',
+                        help="Recompute the activations of each Graphormer layer in the backward pass. "
+                        "Like --checkpoint_hrnet_stages, it needs --skip_unused_modules or "
+                        "--ddp_static_graph in distributed training.")
+    parser.add_argument("--skip_unused_modules", default=False, action='store_true',
+                        help="Do not build the BERT embeddings and pooler of the encoders and the "
+                        "HRNet classifier, which forward never uses, so that DDP needs no "
+                        "search for unused parameters.")
+    parser.add_argument("--ddp_static_graph", default=False, action='store_true',
+                        help="Let DDP assume the same graph in every iteration (static_graph=True).")
     parser.add_argument("--mesh_type", default='hand', type=str, help="body or hand") 
 
     #########################################################
@@ -560,6 +696,8 @@ def parse_args():
     parser.add_argument("--rot", default=0, type=float) 
     parser.add_argument("--sc", default=1.0, type=float) 
     parser.add_argument("--aml_eval", default=False, action='store_true',) 
+    parser.add_argument("--export_pred_json", default=False, action='store_true',
+                        help="Also export the test predictions as a pred.json zip for submission.")
 
     parser.add_argument('--logging_steps', type=int, default=100, 
                         help="Log every X steps.")
@@ -570,6 +708,13 @@ def parse_args():
     parser.add_argument("--local_rank", type=int, default=0, 
                         help="For distributed training.")
     args = parser.parse_args()
+    # DDP does not support reentrant activation checkpointing while it searches
+    # for unused parameters
+    if (args.checkpoint_hrnet_stages or args.checkpoint_graphormer) and \
+            int(os.environ.get('WORLD_SIZE', 1)) > 1 and \
+            not (args.skip_unused_modules or args.ddp_static_graph):
+        parser.error("--checkpoint_hrnet_stages and --checkpoint_graphormer need "
+                     "--skip_unused_modules or --ddp_static_graph in distributed training")
     return args
 
 def main(args):
@@ -594,10 +739,21 @@ def main(args):
     set_seed(args.seed, args.num_gpus)
     logger.info("Using {} GPUs".format(args.num_gpus))
 
+    # continue an interrupted run from its full training state
+    training_state = None
+    if args.resume:
+        checkpoint_dir = find_last_checkpoint(args.output_dir) if args.resume == 'auto' else args.resume
+        if checkpoint_dir is None:
+            logger.info("No checkpoint to resume in {}, start training".format(args.output_dir))
+        else:
+            logger.info("Resume training from {}".format(checkpoint_dir))
+            args.resume_checkpoint = op.join(checkpoint_dir, 'state_dict.bin')
+            training_state = load_training_state(checkpoint_dir)
+
     # Mesh and SMPL utils
     mano_model = MANO().to(args.device)
-    mano_model.layer = mano_model.layer.cuda()
-    mesh_sampler = Mesh()
+    mano_model.layer = mano_model.layer.to(args.device)
+    mesh_sampler = Mesh(device=args.device)
 
     # Renderer for visualization
     renderer = Renderer(faces=mano_model.face)
@@ -615,7 +771,7 @@ def main(args):
     if args.run_eval_only==True and args.resume_checkpoint!=None and args.resume_checkpoint!='None' and 'state_dict' not in args.resume_checkpoint:
         # if only run eval, load checkpoint
         logger.info("Evaluation: Loading from checkpoint {}".format(args.resume_checkpoint))
-        _model = torch.load(args.resume_checkpoint)
+        _model = load_file(args.resume_checkpoint)
 
     else:
         # init three transformer-encoder blocks in a loop
@@ -626,6 +782,8 @@ def main(args):
 
             config.output_attentions = False
             config.hidden_dropout_prob = args.drop_out
+            config.checkpoint_layers = args.checkpoint_graphormer
+            config.skip_unused_modules = args.skip_unused_modules
             config.img_feature_dim = input_feat_dim[i] 
             config.output_feature_dim = output_feat_dim[i]
             args.hidden_size = hidden_feat_dim[i]
@@ -659,13 +817,17 @@ def main(args):
             hrnet_yaml = 'models/hrnet/cls_hrnet_w40_sgd_lr5e-2_wd1e-4_bs32_x100.yaml'
             hrnet_checkpoint = 'models/hrnet/hrnetv2_w40_imagenet_pretrained.pth'
             hrnet_update_config(hrnet_config, hrnet_yaml)
-            backbone = get_cls_net_gridfeat(hrnet_config, pretrained=hrnet_checkpoint)
+            backbone = get_cls_net_gridfeat(hrnet_config, pretrained=hrnet_checkpoint,
+                                            checkpoint_stages=args.checkpoint_hrnet_stages,
+                                            with_classifier=not args.skip_unused_modules)
             logger.info('=> loading hrnet-v2-w40 model')
         elif args.arch=='hrnet-w64':
             hrnet_yaml = 'models/hrnet/cls_hrnet_w64_sgd_lr5e-2_wd1e-4_bs32_x100.yaml'
             hrnet_checkpoint = 'models/hrnet/hrnetv2_w64_imagenet_pretrained.pth'
             hrnet_update_config(hrnet_config, hrnet_yaml)
-            backbone = get_cls_net_gridfeat(hrnet_config, pretrained=hrnet_checkpoint)
+            backbone = get_cls_net_gridfeat(hrnet_config, pretrained=hrnet_checkpoint,
+                                            checkpoint_stages=args.checkpoint_hrnet_stages,
+                                            with_classifier=not args.skip_unused_modules)
             logger.info('=> loading hrnet-v2-w64 model')
         else:
             print("=> using pre-trained model '{}'".format(args.arch))
@@ -685,10 +847,8 @@ def main(args):
         if args.resume_checkpoint!=None and args.resume_checkpoint!='None':
             # for fine-tuning or resume training or inference, load weights from checkpoint
             logger.info("Loading state dict from checkpoint {}".format(args.resume_checkpoint))
-            # workaround approach to load sparse tensor in graph conv.
-            state_dict = torch.load(args.resume_checkpoint)
-            _model.load_state_dict(state_dict, strict=False)
-            del state_dict
+            # memory-mapped onto the CPU, also for the sparse tensors in graph conv.
+            load_weights(_model, args.resume_checkpoint)
             gc.collect()
             torch.cuda.empty_cache()
     
@@ -703,7 +863,19 @@ def main(args):
     else:
         train_dataloader = make_hand_data_loader(args, args.train_yaml, 
                                             args.distributed, is_train=True, scale_factor=args.img_scale_factor)
-        run(args, train_dataloader, _model, mano_model, renderer, mesh_sampler)
+        # data position of the resumed run, from the training state of --resume or
+        # from the sampler_state.bin next to --resume_checkpoint with --resume_sampler
+        sampler_state = None
+        if training_state is not None:
+            if args.resume_sampler:
+                logger.warning("--resume_sampler is ignored, --resume restores the data position")
+            sampler_state = training_state['sampler']
+        elif args.resume_sampler:
+            sampler_state = torch.load(op.join(op.dirname(args.resume_checkpoint), 'sampler_state.bin'))
+        if sampler_state is not None:
+            train_dataloader.batch_sampler.load_state_dict(sampler_state)
+            logger.info("Resume training data at iteration {}".format(sampler_state['iteration']))
+        run(args, train_dataloader, _model, mano_model, renderer, mesh_sampler, training_state)
 
 if __name__ == "__main__":
     args = parse_args()
@@ -32,6 +32,7 @@ from src.datasets.build import make_hand_data_loader
 from src.utils.logger import setup_logger
 from src.utils.comm import synchronize, is_main_process, get_rank, get_world_size, all_gather
 from src.utils.miscellaneous import mkdir, set_seed
+from src.utils.checkpoint import load_file, load_weights
 from src.utils.metric_logger import AverageMeter
 from src.utils.renderer import Renderer, visualize_reconstruction_and_att_local, visualize_reconstruction_no_text
 from src.utils.metric_pampjpe import reconstruction_error
@@ -57,6 +58,8 @@ def run_inference(args, image_list, Graphormer_model, mano, renderer, mesh_sampl
 # switch to evaluate mode
     Graphormer_model.eval()
     mano.eval()
+    start_time = time.time()
+    num_images = 0
     with torch.no_grad():
         for image_file in image_list:
             if 'pred' not in image_file:
@@ -79,6 +82,10 @@ def run_inference(args, image_list, Graphormer_model, mano, renderer, mesh_sampl
                 # save attantion
                 att_max_value = att[-1]
                 att_cpu = np.asarray(att_max_value.cpu().detach())
+                if num_images == 0:
+                    # includes the cudnn autotuning and memory allocation of the first batch
+                    logger.info("First image in {:.2f} s".format(time.time() - start_time))
+                num_images += 1
                 att_all.append(att_cpu)
 
                 # obtain 3d joints, which are regressed from the full mesh
@@ -186,6 +193,9 @@ def parse_args():
     # Others
     #########################################################
     parser.add_argument("--run_eval_only", default=True, action='store_true',) 
+    parser.add_argument("--optimize_backbone", default=False, action='store_true',
+                        help="Fold the batch norms of the HRNet backbone into its convs and "
+                        "run it in channels-last memory format.")
     parser.add_argument("--device", type=str, default='cuda', 
                         help="cuda or cpu")
     parser.add_argument('--seed', type=int, default=88, 
@@ -204,6 +214,8 @@ def main(args):
     logger = setup_logger("Graphormer", args.output_dir, get_rank())
     set_seed(args.seed, args.num_gpus)
     logger.info("Using {} GPUs".format(args.num_gpus))
+    # cold start: time until the model is ready for the first image
+    startup_time = time.time()
 
     # Mesh and MANO utils
     mano_model = MANO().to(args.device)
@@ -226,7 +238,7 @@ def main(args):
     if args.run_eval_only==True and args.resume_checkpoint!=None and args.resume_checkpoint!='None' and 'state_dict' not in args.resume_checkpoint:
         # if only run eval, load checkpoint
         logger.info("Evaluation: Loading from checkpoint {}".format(args.resume_checkpoint))
-        _model = torch.load(args.resume_checkpoint)
+        _model = load_file(args.resume_checkpoint)
 
     else:
         # init three transformer-encoder blocks in a loop
@@ -295,10 +307,10 @@ def main(args):
         if args.resume_checkpoint!=None and args.resume_checkpoint!='None':
             # for fine-tuning or resume training or inference, load weights from checkpoint
             logger.info("Loading state dict from checkpoint {}".format(args.resume_checkpoint))
-            # workaround approach to load sparse tensor in graph conv.
-            state_dict = torch.load(args.resume_checkpoint)
-            _model.load_state_dict(state_dict, strict=False)
-            del state_dict
+            # memory-mapped onto the CPU, also for the sparse tensors in graph conv.
+            load_start = time.time()
+            load_weights(_model, args.resume_checkpoint)
+            logger.info("Loaded weights in {:.2f} s".format(time.time() - load_start))
             gc.collect()
             torch.cuda.empty_cache()
 
@@ -312,7 +324,11 @@ def main(args):
     for inter_block in range(3):
         setattr(_model.trans_encoder[-1].config,'device', args.device)
 
+    if args.optimize_backbone and hasattr(_model.backbone, 'optimize_for_inference'):
+        _model.backbone.optimize_for_inference()
+        logger.info("Folded the backbone batch norms, channels-last")
     _model.to(args.device)
+    logger.info("Model ready in {:.2f} s".format(time.time() - startup_time))
     logger.info("Run inference")
 
     image_list = []
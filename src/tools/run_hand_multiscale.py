@@ -4,26 +4,29 @@ import argparse
 import os
 import os.path as op
 import code
-import json
-import zipfile
 import torch
 import numpy as np
 from src.utils.metric_pampjpe import get_alignMesh
+from src.utils.prediction_writer import load_predictions, load_pred_json, write_pred_json_zip
 
 
-def load_pred_json(filepath):
-    archive = zipfile.ZipFile(filepath, 'r')
-    jsondata = archive.read('pred.json')
-    reference = json.loads(jsondata.decode("utf-8"))
-    return reference[0], reference[1]
+def load_pred(filepath):
+    """Load joints and vertices of a setting, from its .npz predictions
+    if they exist, otherwise from its pred.json zip."""
+    npz_file = filepath.replace('-pred.zip', '-pred.npz')
+    if op.isfile(npz_file):
+        _, arrays = load_predictions(npz_file)
+        return arrays['joints'], arrays['vertices']
+    joints, vertices = load_pred_json(filepath)
+    return joints, vertices
 
 
 def multiscale_fusion(output_dir):
     s = '10'
     filepath = output_dir+'ckpt200-sc10_rot0-pred.zip'
-    ref_joints, ref_vertices = load_pred_json(filepath)
-    ref_joints_array = np.asarray(ref_joints)
-    ref_vertices_array = np.asarray(ref_vertices)
+    ref_joints, ref_vertices = load_pred(filepath)
+    ref_joints_array = np.asarray(ref_joints, dtype=np.float64)
+    ref_vertices_array = np.asarray(ref_vertices, dtype=np.float64)
 
     rotations = [0.0]
     for i in range(1,10):
@@ -39,9 +42,9 @@ def multiscale_fusion(output_dir):
         for r in rotations:
             setting = 'sc%02d_rot%s'%(int(s*10),str(int(r)))
             filepath = output_dir+'ckpt200-'+setting+'-pred.zip'
-            joints, vertices = load_pred_json(filepath)
-            joints_array = np.asarray(joints)
-            vertices_array = np.asarray(vertices)
+            joints, vertices = load_pred(filepath)
+            joints_array = np.asarray(joints, dtype=np.float64)
+            vertices_array = np.asarray(vertices, dtype=np.float64)
 
             pa_joint_error, pa_joint_array, _ = get_alignMesh(joints_array, ref_joints_array, reduction=None)
             pa_vertices_error, pa_vertices_array, _ = get_alignMesh(vertices_array, ref_vertices_array, reduction=None)
@@ -68,21 +71,9 @@ def multiscale_fusion(output_dir):
     print('PAMPJPE:', 1000*np.mean(pa_joint_error))
     print('PAMPVPE:', 1000*np.mean(pa_vertices_error))
 
-    joint_output_save = overall_joints_array.tolist()
-    mesh_output_save = overall_vertices_array.tolist()
-
-    print('save results to pred.json')
-    with open('pred.json', 'w') as f:
-        json.dump([joint_output_save, mesh_output_save], f)
-
-
     filepath = output_dir+'ckpt200-multisc-pred.zip'
-    resolved_submit_cmd = 'zip ' + filepath + '  ' +  'pred.json'
-    print(resolved_submit_cmd)
-    os.system(resolved_submit_cmd)
-    resolved_submit_cmd = 'rm pred.json'
-    print(resolved_submit_cmd)
-    os.system(resolved_submit_cmd)
+    print('save results to', filepath)
+    write_pred_json_zip(filepath, [[overall_joints_array], [overall_vertices_array]])
 
 
 def run_multiscale_inference(model_path, mode, output_dir):
@@ -101,7 +92,7 @@ def run_multiscale_inference(model_path, mode, output_dir):
             "--val_yaml freihand_v3/test.yaml " \
             "--resume_checkpoint %s " \
             "--per_gpu_eval_batch_size 32 --run_eval_only --num_worker 2 " \
-            "--multiscale_inference " \
+            "--multiscale_inference --export_pred_json " \
             "--rot %f " \
             "--sc %s " \
             "--arch hrnet-w64 " \
@@ -0,0 +1,338 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT license.
+
+Benchmark of training and inference options of the network on random inputs.
+The checkpoint benchmark reports the time of a forward and backward pass and
+the peak GPU memory of the HRNet backbone and of the three Graphormer
+encoders for each activation checkpointing setting. The ddp benchmark trains
+the Graphormer encoders in several CPU processes with the gloo backend, with
+and without the search for unused parameters of DistributedDataParallel.
+The startup benchmark builds the network in a fresh process and loads its
+weights with torch.load or memory-mapped, and reports the time and the
+memory used on top of the model. The inference benchmark compares the HRNet
+backbone with its batch norms folded, in NCHW and channels-last memory
+format, to the original backbone: the largest difference of the outputs and
+the time of a forward pass. The features benchmark reports the parameters,
+multiply-accumulates and forward time of the backbone with the ImageNet
+classifier, as the feature extractor used by Graphormer, and with grid
+features only.
+"""
+
+from __future__ import absolute_import, division, print_function
+import argparse
+import copy
+import os.path as op
+import resource
+import tempfile
+import time
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from src.modeling.bert import BertConfig, Graphormer
+from src.modeling.hrnet.hrnet_cls_net_gridfeat import get_cls_net_gridfeat
+from src.modeling.hrnet.config import config as hrnet_config
+from src.modeling.hrnet.config import update_config as hrnet_update_config
+from src.utils.miscellaneous import get_unused_parameters, make_distributed_model
+from src.utils.checkpoint import load_weights
+
+
+# name, skip_unused_modules, ddp_static_graph
+DDP_SETTINGS = [('find_unused', False, False), ('skip_unused', True, False), ('static_graph', True, True)]
+
+STARTUP_SETTINGS = ['torch.load', 'mmap']
+
+# name, HighResolutionNet kwargs
+FEATURES_SETTINGS = [('imagenet', {}), ('features', {'with_classifier': False}),
+                     ('grid_only', {'grid_only': True})]
+
+# name, fold batch norms, channels_last
+INFERENCE_SETTINGS = [('eager', False, False), ('folded', True, False), ('folded+nhwc', True, True)]
+
+CHECKPOINT_SETTINGS = [('none', []), ('stage4', ['stage4']), ('stage3-4', ['stage3', 'stage4']),
+                       ('stage2-4', ['stage2', 'stage3', 'stage4'])]
+
+
+def build_backbone(args, checkpoint_stages=(), **kwargs):
+    hrnet_update_config(hrnet_config, args.hrnet_yaml)
+    return get_cls_net_gridfeat(hrnet_config, pretrained='', checkpoint_stages=checkpoint_stages, **kwargs)
+
+
+def build_encoders(args, checkpoint_layers=False, skip_unused_modules=False):
+    """The three Graphormer encoders, configured as in run_gphmer_bodymesh.py."""
+    input_feat_dim = [int(item) for item in args.input_feat_dim.split(',')]
+    hidden_feat_dim = [int(item) for item in args.hidden_feat_dim.split(',')]
+    output_feat_dim = input_feat_dim[1:] + [3]
+    which_blk_graph = [int(item) for item in args.which_gcn.split(',')]
+    trans_encoder = []
+    for i in range(len(output_feat_dim)):
+        config = BertConfig.from_pretrained(args.model_name_or_path)
+        config.output_attentions = False
+        config.img_feature_dim = input_feat_dim[i]
+        config.output_feature_dim = output_feat_dim[i]
+        config.hidden_size = hidden_feat_dim[i]
+        config.intermediate_size = int(hidden_feat_dim[i] * 2)
+        config.graph_conv = which_blk_graph[i] == 1
+        config.mesh_type = args.mesh_type
+        config.checkpoint_layers = checkpoint_layers
+        config.skip_unused_modules = skip_unused_modules
+        trans_encoder.append(Graphormer(config=config))
+    return torch.nn.Sequential(*trans_encoder)
+
+
+def time_train_step(model, inputs, device, num_iters):
+    """Average seconds per forward and backward pass, and peak GPU memory in MB."""
+    model.train()
+
+    def step():
+        outputs = model(inputs)
+        outputs = outputs if isinstance(outputs, (tuple, list)) else (outputs,)
+        loss = sum(o.float().mean() for o in outputs)
+        loss.backward()
+        model.zero_grad(set_to_none=True)
+
+    step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.time()
+    for _ in range(num_iters):
+        step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        memory = torch.cuda.max_memory_allocated() / 1024.0 / 1024.0
+    else:
+        memory = None
+    return (time.time() - start) / num_iters, memory
+
+
+def time_inference(model, inputs, device, num_iters):
+    """Average seconds per forward pass without gradients."""
+    with torch.no_grad():
+        outputs = model(inputs)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.time()
+        for _ in range(num_iters):
+            model(inputs)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+    return (time.time() - start) / num_iters, outputs
+
+
+def report(name, batch_size, seconds, memory, reference):
+    line = '{:>12s}: {:8.1f} ms/iter {:8.1f} img/s ({:+.0%})'.format(
+        name, 1000*seconds, batch_size/seconds, seconds/reference[0] - 1)
+    if memory is not None:
+        line += ' {:9.0f} MB max mem ({:+.0%})'.format(memory, memory/reference[1] - 1)
+    print(line)
+
+
+def bench_checkpoint(args):
+    device = torch.device(args.device)
+    images = torch.randn(args.batch_size, 3, 224, 224, device=device, requires_grad=True)
+    print('HRNet backbone, batch size {}'.format(args.batch_size))
+    reference = None
+    for name, stages in CHECKPOINT_SETTINGS:
+        backbone = build_backbone(args, stages).to(device)
+        seconds, memory = time_train_step(backbone, images, device, args.num_iters)
+        reference = reference or (seconds, memory)
+        report(name, args.batch_size, seconds, memory, reference)
+        del backbone
+
+    num_tokens = args.num_tokens
+    feature_dim = int(args.input_feat_dim.split(',')[0])
+    features = torch.randn(args.batch_size, num_tokens, feature_dim, device=device, requires_grad=True)
+    print('Graphormer encoders, batch size {}, {} tokens'.format(args.batch_size, num_tokens))
+    reference = None
+    for name, checkpoint_layers in [('none', False), ('layers', True)]:
+        encoders = build_encoders(args, checkpoint_layers).to(device)
+        seconds, memory = time_train_step(encoders, features, device, args.num_iters)
+        reference = reference or (seconds, memory)
+        report(name, args.batch_size, seconds, memory, reference)
+        del encoders
+    if device.type == 'cuda':
+        torch.cuda.empty_cache()
+
+
+def ddp_worker(rank, args, results):
+    dist.init_process_group('gloo', init_method='tcp://127.0.0.1:{}'.format(args.port),
+                            world_size=args.world_size, rank=rank)
+    torch.set_num_threads(args.threads_per_rank)
+    device = torch.device('cpu')
+    feature_dim = int(args.input_feat_dim.split(',')[0])
+    features = torch.randn(args.batch_size, args.num_tokens, feature_dim, requires_grad=True)
+    for name, skip_unused_modules, ddp_static_graph in DDP_SETTINGS:
+        torch.manual_seed(args.seed)
+        ddp_args = argparse.Namespace(device='cpu', local_rank=rank,
+                                      skip_unused_modules=skip_unused_modules,
+                                      ddp_static_graph=ddp_static_graph)
+        model = make_distributed_model(build_encoders(args, skip_unused_modules=skip_unused_modules), ddp_args)
+        results[(rank, name)] = time_train_step(model, features, device, args.num_iters)[0]
+        del model
+    dist.destroy_process_group()
+
+
+def bench_ddp(args):
+    feature_dim = int(args.input_feat_dim.split(',')[0])
+    features = torch.randn(args.batch_size, args.num_tokens, feature_dim)
+    for skip_unused_modules in [False, True]:
+        encoders = build_encoders(args, skip_unused_modules=skip_unused_modules)
+        unused = get_unused_parameters(encoders, encoders(features).mean())
+        print('skip_unused_modules={}: {} unused parameters {}'.format(
+            skip_unused_modules, len(unused), ', '.join(unused[:4]) + (' ...' if len(unused) > 4 else '')))
+
+    print('DistributedDataParallel on {} gloo CPU processes, batch size {} per process'.format(
+        args.world_size, args.batch_size))
+    results = mp.Manager().dict()
+    mp.spawn(ddp_worker, args=(args, results), nprocs=args.world_size, join=True)
+    reference = None
+    for name, _, _ in DDP_SETTINGS:
+        # a step is as slow as its slowest process
+        seconds = max(results[(rank, name)] for rank in range(args.world_size))
+        reference = reference or (seconds, None)
+        report(name, args.batch_size * args.world_size, seconds, None, reference)
+
+
+def bench_inference(args):
+    device = torch.device(args.device)
+    images = torch.randn(args.batch_size, 3, 224, 224, device=device)
+    backbone = build_backbone(args).to(device).eval()
+    print('HRNet backbone inference, batch size {}'.format(args.batch_size))
+    reference, reference_outputs = None, None
+    for name, fold, channels_last in INFERENCE_SETTINGS:
+        model = copy.deepcopy(backbone)
+        if fold:
+            model.optimize_for_inference(channels_last=channels_last)
+        seconds, outputs = time_inference(model, images, device, args.num_iters)
+        reference = reference or (seconds, None)
+        reference_outputs = reference_outputs or outputs
+        report(name, args.batch_size, seconds, None, reference)
+        # global image feature and grid feature
+        print('{:>12s}  max abs diff {:.2e} {:.2e}'.format('', *[
+            (o.float() - r.float()).abs().max().item() for o, r in zip(outputs, reference_outputs)]))
+        del model
+
+
+def count_macs(model, inputs):
+    """Multiply-accumulates of the convolutions and linear layers in a forward pass."""
+    macs = []
+
+    def hook(module, input, output):
+        if isinstance(module, torch.nn.Conv2d):
+            kernel_macs = module.in_channels // module.groups * module.kernel_size[0] * module.kernel_size[1]
+        else:
+            kernel_macs = module.in_features
+        macs.append(output.numel() * kernel_macs)
+
+    handles = [m.register_forward_hook(hook) for m in model.modules()
+               if isinstance(m, (torch.nn.Conv2d, torch.nn.Linear))]
+    with torch.no_grad():
+        model(inputs)
+    for handle in handles:
+        handle.remove()
+    return sum(macs)
+
+
+def bench_features(args):
+    device = torch.device(args.device)
+    images = torch.randn(args.batch_size, 3, 224, 224, device=device)
+    print('HRNet backbone inference, batch size {}'.format(args.batch_size))
+    reference = None
+    for name, kwargs in FEATURES_SETTINGS:
+        model = build_backbone(args, **kwargs).to(device).eval()
+        params = sum(p.numel() for p in model.parameters())
+        macs = count_macs(model, images[:1])
+        seconds, _ = time_inference(model, images, device, args.num_iters)
+        reference = reference or (seconds, None, params, macs)
+        report(name, args.batch_size, seconds, None, reference)
+        print('{:>12s}  {:6.2f} M params ({:+.1%}) {:6.2f} GMACs/img ({:+.1%})'.format(
+            '', params / 1e6, params / reference[2] - 1, macs / 1e9, macs / reference[3] - 1))
+        del model
+
+
+def build_network(args):
+    # same parameter names as the backbone and encoders of Graphormer_Network
+    return torch.nn.ModuleDict({'backbone': build_backbone(args), 'trans_encoder': build_encoders(args)})
+
+
+def max_rss():
+    """Peak resident memory of this process in MB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def startup_worker(args, checkpoint_file, name, results):
+    start = time.time()
+    model = build_network(args)
+    build_time = time.time() - start
+    rss = max_rss()
+    start = time.time()
+    if name == 'mmap':
+        load_weights(model, checkpoint_file)
+    else:
+        # what the scripts did before: load the whole file, then copy it in
+        states = torch.load(checkpoint_file, map_location='cpu')
+        for k, v in states.items():
+            states[k] = v.cpu()
+        model.load_state_dict(states, strict=False)
+        del states
+    results[name] = (build_time, time.time() - start, max_rss() - rss)
+
+
+def bench_startup(args):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        checkpoint_file = args.checkpoint_file
+        if not checkpoint_file:
+            checkpoint_file = op.join(tmp_dir, 'state_dict.bin')
+            torch.save(build_network(args).state_dict(), checkpoint_file)
+        # read the file once, so that every setting finds it in the page cache
+        with open(checkpoint_file, 'rb') as fp:
+            while fp.read(1 << 24):
+                pass
+        print('Build and load {} in a fresh process'.format(checkpoint_file))
+        ctx = mp.get_context('spawn')
+        results = ctx.Manager().dict()
+        for name in STARTUP_SETTINGS:
+            p = ctx.Process(target=startup_worker, args=(args, checkpoint_file, name, results))
+            p.start()
+            p.join()
+        reference = None
+        for name in STARTUP_SETTINGS:
+            build_time, load_time, memory = results[name]
+            reference = reference or load_time
+            print('{:>12s}: build {:6.2f} s, load {:6.2f} s ({:+.0%}), {:7.0f} MB more peak memory'.format(
+                name, build_time, load_time, load_time/reference - 1, memory))
+
+
+def main(args):
+    benches = {'checkpoint': bench_checkpoint, 'ddp': bench_ddp, 'startup': bench_startup,
+               'inference': bench_inference, 'features': bench_features}
+    for name in args.bench.split(','):
+        print('==> {}'.format(name))
+        benches[name](args)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark training and inference options of the network")
+    parser.add_argument("--bench", default='checkpoint', type=str,
+                        help="Comma separated list of benchmarks: checkpoint, ddp, startup, inference, features")
+    parser.add_argument("--device", default='cuda', type=str)
+    parser.add_argument("--batch_size", default=30, type=int)
+    parser.add_argument("--num_iters", default=10, type=int)
+    parser.add_argument("--hrnet_yaml", default='models/hrnet/cls_hrnet_w64_sgd_lr5e-2_wd1e-4_bs32_x100.yaml', type=str)
+    parser.add_argument("--model_name_or_path", default='src/modeling/bert/bert-base-uncased/', type=str)
+    parser.add_argument("--input_feat_dim", default='2051,512,128', type=str)
+    parser.add_argument("--hidden_feat_dim", default='1024,256,64', type=str)
+    parser.add_argument("--which_gcn", default='0,0,1', type=str)
+    parser.add_argument("--mesh_type", default='body', type=str)
+    parser.add_argument("--num_tokens", default=14+431+49, type=int,
+                        help="Joint, vertex and grid feature tokens; 21+195+49 for the hand.")
+    parser.add_argument("--world_size", default=2, type=int,
+                        help="Processes of the ddp benchmark.")
+    parser.add_argument("--threads_per_rank", default=4, type=int)
+    parser.add_argument("--port", default=29535, type=int)
+    parser.add_argument("--seed", default=88, type=int)
+    parser.add_argument("--checkpoint_file", default='', type=str,
+                        help="state_dict.bin of the startup benchmark; by default a random one is saved.")
+    args = parser.parse_args()
+    main(args)
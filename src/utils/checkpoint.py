@@ -0,0 +1,251 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT license.
+
+Asynchronous, atomic checkpoint writer. The training loop only pays for
+copying the state_dict to host memory; a background thread writes the files
+of a checkpoint into a temporary directory, fsyncs them and renames the
+directory into place, so that a checkpoint-<epoch>-<iteration> directory is
+always complete. Old checkpoints beyond the last N and the best K are removed.
+Besides the weights, a checkpoint holds the training state (optimizer, loss
+scaler, RNGs and data position) needed to resume training where it stopped.
+Checkpoints are loaded memory-mapped, so weights are copied from the page
+cache into the parameters without a full copy of the file in memory.
+"""
+
+
+import os
+import os.path as op
+import queue
+import random
+import shutil
+import logging
+import threading
+import numpy as np
+import torch
+from src.utils.comm import all_gather, get_rank
+
+
+logger = logging.getLogger(__name__)
+
+
+def snapshot_state_dict(model):
+    """Copy of the state_dict of model (or of model.module) in host memory."""
+    model = model.module if hasattr(model, 'module') else model
+    return {k: v.detach().to('cpu', copy=True) for k, v in model.state_dict().items()}
+
+
+def fsync_dir(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_checkpoint(checkpoint_dir, files):
+    """Write {file name: object} as the directory checkpoint_dir, atomically."""
+    tmp_dir = '{}.tmp.{}'.format(checkpoint_dir, os.getpid())
+    if op.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    for name, obj in files.items():
+        path = op.join(tmp_dir, name)
+        with open(path, 'wb') as fp:
+            torch.save(obj, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+    fsync_dir(tmp_dir)
+    old_dir = None
+    if op.isdir(checkpoint_dir):
+        # the old copy is only deleted once the new one is in place
+        old_dir = '{}.old.{}'.format(checkpoint_dir, os.getpid())
+        if op.isdir(old_dir):
+            shutil.rmtree(old_dir)
+        os.rename(checkpoint_dir, old_dir)
+    os.rename(tmp_dir, checkpoint_dir)
+    fsync_dir(op.dirname(op.abspath(checkpoint_dir)))
+    if old_dir is not None:
+        shutil.rmtree(old_dir)
+    return checkpoint_dir
+
+
+class CheckpointWriter(object):
+    """Write checkpoints from a background thread.
+
+        writer = CheckpointWriter(keep_last=2, keep_best=1)
+        writer.save(checkpoint_dir, {'state_dict.bin': snapshot_state_dict(model)}, metric=val_PAmPJPE)
+        writer.close()
+
+    Only the checkpoints saved by the writer are removed: all but the last
+    keep_last ones and the keep_best ones with the lowest metric. A value of
+    0 keeps all of them.
+    """
+    def __init__(self, keep_last=0, keep_best=0, num_trial=3, max_queue=2):
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.num_trial = num_trial
+        self.saved = []
+        self._error = None
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def save(self, checkpoint_dir, files, metric=None):
+        """Queue a checkpoint; files maps file names to objects in host memory.
+        Blocks only when max_queue checkpoints are still being written."""
+        if self._error is not None:
+            raise self._error
+        self._queue.put((checkpoint_dir, files, metric))
+        return checkpoint_dir
+
+    def _write(self, checkpoint_dir, files):
+        for trial in range(self.num_trial):
+            try:
+                return write_checkpoint(checkpoint_dir, files)
+            except OSError as e:
+                logger.warning("Failed to save checkpoint {} (trial {}): {}".format(
+                    checkpoint_dir, trial + 1, e))
+        raise RuntimeError("Failed to save checkpoint {} after {} trials.".format(
+            checkpoint_dir, self.num_trial))
+
+    def _remove_old(self):
+        keep = set()
+        if self.keep_last > 0:
+            keep.update(d for d, _ in self.saved[-self.keep_last:])
+        else:
+            keep.update(d for d, _ in self.saved)
+        if self.keep_best > 0:
+            scored = sorted((m, i) for i, (_, m) in enumerate(self.saved) if m is not None)
+            keep.update(self.saved[i][0] for _, i in scored[:self.keep_best])
+        for checkpoint_dir, _ in self.saved:
+            if checkpoint_dir not in keep and op.isdir(checkpoint_dir):
+                shutil.rmtree(checkpoint_dir, ignore_errors=True)
+                logger.info("Removed old checkpoint {}".format(checkpoint_dir))
+        self.saved = [(d, m) for d, m in self.saved if d in keep]
+
+    def _run(self):
+        item = None
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+                checkpoint_dir, files, metric = item
+                self._write(checkpoint_dir, files)
+                logger.info("Save checkpoint to {}".format(checkpoint_dir))
+                self.saved = [(d, m) for d, m in self.saved if d != checkpoint_dir]
+                self.saved.append((checkpoint_dir, metric))
+                self._remove_old()
+        except Exception as e:
+            self._error = e
+            # keep consuming, so that save() never blocks on a full queue
+            while item is not None:
+                item = self._queue.get()
+
+    def close(self):
+        """Wait until all queued checkpoints are written."""
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+
+TRAINING_STATE_FILE = 'training_state.bin'
+
+
+def to_cpu(obj):
+    """Copy of the tensors in a nested dict/list/tuple, in host memory."""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def get_rng_state():
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(),
+             'torch': torch.get_rng_state()}
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        state['cuda'] = torch.cuda.get_rng_state()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state(state['cuda'])
+
+
+def make_training_state(optimizer, scaler, sampler_state=None, **extra):
+    """Everything besides the model weights that is needed to continue training:
+    optimizer and loss scaler states, the training data position and the RNG
+    states of all ranks. It gathers from all ranks, so call it on every rank."""
+    state = {'optimizer': to_cpu(optimizer.state_dict()),
+             'scaler': scaler.state_dict(),
+             'sampler': sampler_state,
+             'rng': all_gather(get_rng_state())}
+    state.update(extra)
+    return state
+
+
+def load_training_state(checkpoint_dir):
+    return load_file(op.join(checkpoint_dir, TRAINING_STATE_FILE))
+
+
+def restore_rng_state(training_state):
+    """Set the RNG states of this rank, or of rank 0 if the world size changed."""
+    rng = training_state['rng']
+    set_rng_state(rng[get_rank()] if get_rank() < len(rng) else rng[0])
+
+
+def find_last_checkpoint(output_dir):
+    """The checkpoint-<epoch>-<iteration> directory of output_dir with the
+    largest iteration and a training state, or None."""
+    last, last_iteration = None, -1
+    if not op.isdir(output_dir):
+        return None
+    for name in os.listdir(output_dir):
+        parts = name.split('-')
+        if len(parts) != 3 or parts[0] != 'checkpoint' or not parts[2].isdigit():
+            continue
+        if not op.isfile(op.join(output_dir, name, TRAINING_STATE_FILE)):
+            continue
+        if int(parts[2]) > last_iteration:
+            last, last_iteration = op.join(output_dir, name), int(parts[2])
+    return last
+
+
+def load_file(filename):
+    """torch.load a file onto the CPU. Files in the zip format of torch.save are
+    memory-mapped: tensors are read from the page cache when they are used.
+    Full unpickling is allowed, since training states hold RNG states and
+    checkpoints may hold whole models."""
+    try:
+        return torch.load(filename, map_location='cpu', mmap=True, weights_only=False)
+    except (TypeError, ValueError, RuntimeError):
+        # torch<2.1 has no mmap, and files in the legacy format cannot be mapped
+        pass
+    try:
+        return torch.load(filename, map_location='cpu', weights_only=False)
+    except TypeError:
+        # torch<1.13 has no weights_only and always unpickles everything
+        return torch.load(filename, map_location='cpu')
+
+
+def load_weights(model, filename, strict=False):
+    """Copy the weights of a state_dict file into the parameters and buffers of
+    model. Entries of the file that model does not have are ignored."""
+    states = load_file(filename)
+    model_keys = set(model.state_dict().keys())
+    states = {k: v for k, v in states.items() if k in model_keys}
+    result = model.load_state_dict(states, strict=strict)
+    del states
+    return result
@@ -48,6 +48,31 @@ def synchronize():
     dist.barrier()
 
 
+def get_collective_device():
+    """Device of the tensors exchanged by collectives: the current CUDA device
+    with the NCCL backend, the CPU otherwise (e.g. gloo)."""
+    if dist.is_available() and dist.is_initialized() and dist.get_backend() == 'nccl':
+        return torch.device('cuda', torch.cuda.current_device())
+    return torch.device('cpu')
+
+
+def all_reduce_sum(values):
+    """
+    Sum a list of numbers over all processes with a single all_reduce of
+    one packed float64 tensor. Nothing is pickled.
+    Args:
+        values: list of python or 0-dim tensor numbers
+    Returns:
+        list[float]: element-wise sums over all ranks
+    """
+    values = [float(v) for v in values]
+    if get_world_size() == 1:
+        return values
+    tensor = torch.tensor(values, dtype=torch.float64, device=get_collective_device())
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor.tolist()
+
+
 def gather_on_master(data):
     """Same as all_gather, but gathers data on master process only, using CPU.
     Thus, this does not work with NCCL backend unless they add CPU support.
@@ -0,0 +1,162 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT license.
+
+Memory-mapped cache of processed evaluation samples. In evaluation the
+augmentation parameters are fixed, so the normalized crop and the processed
+labels of a row are the same on every validation pass. They are written to
+one .npy file per field (indexed by dataset row) the first time a row is
+read, and memory-mapped afterwards.
+"""
+
+
+import os
+import os.path as op
+import json
+import shutil
+import hashlib
+import logging
+import numpy as np
+import torch
+
+
+META_FILE = 'meta.json'
+FILLED_FILE = 'filled.npy'
+IMAGE_FILE = 'image.npy'
+
+
+def tsv_source_files(tsv):
+    """Files a TSVFile or CompositeTSVFile reads from."""
+    if tsv is None:
+        return []
+    if hasattr(tsv, 'tsv_file'):
+        return [tsv.tsv_file, tsv.lineidx]
+    return [tsv.seq_file] + [op.join(tsv.root, f) for f in tsv.file_list]
+
+
+def source_signature(files):
+    """Path, size and modification time of each source file."""
+    signature = []
+    for f in files:
+        st = os.stat(f)
+        signature.append([op.abspath(f), st.st_size, int(st.st_mtime)])
+    return signature
+
+
+def cache_key(params):
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def _field_kind(value):
+    if isinstance(value, torch.Tensor):
+        return 'tensor', value.numpy()
+    if isinstance(value, np.ndarray):
+        return 'ndarray', value
+    if isinstance(value, str):
+        return 'str', np.asarray(value.encode(), dtype='S32')
+    if isinstance(value, (bool, int, np.integer)):
+        return 'int', np.asarray(value, dtype=np.int64)
+    return 'float', np.asarray(value, dtype=np.float64)
+
+
+class CropCache(object):
+    """Cache of (image, meta_data) per dataset row under cache_dir.
+
+    The cache is created with the layout of a prototype sample and rebuilt
+    when the signature of its source files changes. Rows are filled by
+    whichever process reads them first; the filled flags tell which rows
+    are available.
+    """
+    def __init__(self, cache_dir, num_rows, signature):
+        self.cache_dir = cache_dir
+        self.num_rows = num_rows
+        self.signature = signature
+        self.meta = None
+        self._arrays = None
+
+    def is_valid(self):
+        meta_file = op.join(self.cache_dir, META_FILE)
+        if not op.isfile(meta_file):
+            return False
+        with open(meta_file, 'r') as fp:
+            meta = json.load(fp)
+        return meta['num_rows'] == self.num_rows and meta['signature'] == self.signature
+
+    def open(self, prototype):
+        """Load the cache, (re)creating it from a prototype (image, meta_data) if needed."""
+        if not self.is_valid():
+            if op.isdir(self.cache_dir):
+                logging.info('source files changed, rebuild {}'.format(self.cache_dir))
+                stale_dir = '{}.stale.{}'.format(self.cache_dir, os.getpid())
+                try:
+                    os.rename(self.cache_dir, stale_dir)
+                    shutil.rmtree(stale_dir)
+                except OSError:
+                    # another process is rebuilding it
+                    pass
+            self.create(*prototype)
+        with open(op.join(self.cache_dir, META_FILE), 'r') as fp:
+            self.meta = json.load(fp)
+        return self
+
+    def create(self, image, meta_data):
+        tmp_dir = '{}.tmp.{}'.format(self.cache_dir, os.getpid())
+        os.makedirs(tmp_dir)
+        fields = {}
+        np.lib.format.open_memmap(op.join(tmp_dir, IMAGE_FILE), mode='w+',
+                dtype=np.float32, shape=(self.num_rows,) + tuple(image.shape))
+        for name, value in meta_data.items():
+            kind, array = _field_kind(value)
+            np.lib.format.open_memmap(op.join(tmp_dir, name + '.npy'), mode='w+',
+                    dtype=array.dtype, shape=(self.num_rows,) + array.shape)
+            fields[name] = kind
+        np.lib.format.open_memmap(op.join(tmp_dir, FILLED_FILE), mode='w+',
+                dtype=np.uint8, shape=(self.num_rows,))
+        meta = {'num_rows': self.num_rows, 'signature': self.signature, 'fields': fields}
+        with open(op.join(tmp_dir, META_FILE), 'w') as fp:
+            json.dump(meta, fp)
+        try:
+            os.rename(tmp_dir, self.cache_dir)
+            logging.info('created crop cache {}'.format(self.cache_dir))
+        except OSError:
+            # created by another process in the meantime
+            shutil.rmtree(tmp_dir)
+
+    def _ensure_loaded(self):
+        # map lazily, so that each dataloader worker maps the files itself
+        if self._arrays is None:
+            names = [IMAGE_FILE, FILLED_FILE] + [name + '.npy' for name in self.meta['fields']]
+            self._arrays = {name: np.load(op.join(self.cache_dir, name), mmap_mode='r+')
+                            for name in names}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+    def get(self, row):
+        """Return (image, meta_data) of a row, or None if it is not cached yet."""
+        self._ensure_loaded()
+        a = self._arrays
+        if not a[FILLED_FILE][row]:
+            return None
+        meta_data = {}
+        for name, kind in self.meta['fields'].items():
+            value = np.array(a[name + '.npy'][row])
+            if kind == 'tensor':
+                value = torch.from_numpy(value)
+            elif kind == 'str':
+                value = value.item().decode()
+            elif kind in ('int', 'float'):
+                value = value.item()
+            meta_data[name] = value
+        return torch.from_numpy(np.array(a[IMAGE_FILE][row])), meta_data
+
+    def put(self, row, image, meta_data):
+        self._ensure_loaded()
+        a = self._arrays
+        a[IMAGE_FILE][row] = image.numpy()
+        for name in self.meta['fields']:
+            a[name + '.npy'][row] = _field_kind(meta_data[name])[1]
+        # mark the row only once its data is written
+        a[FILLED_FILE][row] = 1
@@ -0,0 +1,105 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT license.
+
+Memory-mapped store of per-sample evaluation results. run_validate writes the
+predicted and ground truth joints and vertices of every sample, one row per
+img_key, so that metrics, per-joint breakdowns and Procrustes variants can be
+recomputed offline (see src/tools/run_eval_metrics.py) without running the
+network again.
+"""
+
+
+import os
+import os.path as op
+import json
+import shutil
+import logging
+import numpy as np
+import torch
+
+
+META_FILE = 'meta.json'
+KEYS_FILE = 'keys.npy'
+FILLED_FILE = 'filled.npy'
+
+
+class EvalStore(object):
+    """Per-sample arrays under store_dir, one .npy file per field.
+
+    The main process creates the store with the keys of the dataset and the
+    per-sample shape of each field; the other ranks open it after a barrier.
+    Every rank then writes the rows of its own samples:
+        store = EvalStore(store_dir).create(keys, {'pred_vertices': (6890, 3)})
+        store.put(img_keys, pred_vertices=pred_vertices)
+        store.flush()
+    Repeated keys in the dataset share one row.
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.meta = None
+        self.keys = None
+        self._rows = None
+        self._arrays = None
+
+    def create(self, keys, fields, dtype=np.float32):
+        """(Re)create the store for the given keys and {field: per-sample shape}."""
+        tmp_dir = '{}.tmp.{}'.format(self.store_dir, os.getpid())
+        os.makedirs(tmp_dir)
+        keys = list(keys)
+        np.save(op.join(tmp_dir, KEYS_FILE), np.asarray(keys, dtype=np.str_))
+        for name, shape in fields.items():
+            np.lib.format.open_memmap(op.join(tmp_dir, name + '.npy'), mode='w+',
+                    dtype=dtype, shape=(len(keys),) + tuple(shape))
+        np.lib.format.open_memmap(op.join(tmp_dir, FILLED_FILE), mode='w+',
+                dtype=np.uint8, shape=(len(keys),))
+        meta = {'num_rows': len(keys), 'fields': {name: list(shape) for name, shape in fields.items()}}
+        with open(op.join(tmp_dir, META_FILE), 'w') as fp:
+            json.dump(meta, fp)
+        if op.isdir(self.store_dir):
+            shutil.rmtree(self.store_dir)
+        os.rename(tmp_dir, self.store_dir)
+        logging.info('created evaluation store {} with {} rows'.format(self.store_dir, len(keys)))
+        return self.open(mode='r+')
+
+    def open(self, mode='r'):
+        """Map an existing store; mode='r+' to write into it."""
+        with open(op.join(self.store_dir, META_FILE), 'r') as fp:
+            self.meta = json.load(fp)
+        self.keys = np.load(op.join(self.store_dir, KEYS_FILE)).tolist()
+        names = [FILLED_FILE] + [name + '.npy' for name in self.meta['fields']]
+        self._arrays = {name: np.load(op.join(self.store_dir, name), mmap_mode=mode)
+                        for name in names}
+        return self
+
+    @property
+    def fields(self):
+        return list(self.meta['fields'])
+
+    def rows(self, keys):
+        if self._rows is None:
+            self._rows = {}
+            for i, key in enumerate(self.keys):
+                self._rows.setdefault(key, i)
+        return np.asarray([self._rows[key] for key in keys], dtype=np.int64)
+
+    def put(self, keys, **arrays):
+        """Write the results of a batch; arrays are tensors or arrays of shape (B,...)."""
+        rows = self.rows(keys)
+        for name, value in arrays.items():
+            if torch.is_tensor(value):
+                value = value.detach().float().cpu().numpy()
+            self._arrays[name + '.npy'][rows] = value
+        # mark the rows only once their data is written
+        self._arrays[FILLED_FILE][rows] = 1
+
+    def flush(self):
+        for array in self._arrays.values():
+            array.flush()
+
+    def filled(self):
+        return np.asarray(self._arrays[FILLED_FILE]).astype(bool)
+
+    def __getitem__(self, name):
+        """Memory-mapped array of a field, of shape (num_rows,...)."""
+        return self._arrays[name + '.npy']
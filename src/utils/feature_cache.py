@@ -0,0 +1,146 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT license.
+
+Memory-mapped cache of backbone features. With a frozen backbone and fixed
+augmentation, the global image feature (2048) and the grid feature
+(1024x7x7) of a dataset row are the same on every pass, so they are
+computed once and read from one .npy file per feature afterwards. The cache
+directory is keyed by the dataset and augmentation settings and by the
+weights of the backbone; rows are keyed by their dataset index.
+"""
+
+
+import os
+import os.path as op
+import json
+import shutil
+import hashlib
+import logging
+import numpy as np
+import torch
+from src.utils.crop_cache import cache_key, source_signature
+
+
+META_FILE = 'meta.json'
+FILLED_FILE = 'filled.npy'
+FEATURE_FILES = ['image_feat.npy', 'grid_feat.npy']
+
+
+def weights_fingerprint(module):
+    """Hash of the parameters and buffers of module."""
+    h = hashlib.sha1()
+    for name, value in sorted(module.state_dict().items()):
+        h.update(name.encode())
+        h.update(value.detach().float().cpu().numpy().tobytes())
+    return h.hexdigest()[:16]
+
+
+class FeatureCache(object):
+    """Cache of (image_feat, grid_feat) per dataset row under cache_dir.
+
+    Features are stored in float16 by default. Rows are filled by whichever process
+    computes them first; the filled flags tell which rows are available.
+    """
+    def __init__(self, cache_dir, num_rows, signature, dtype=np.float16):
+        self.cache_dir = cache_dir
+        self.num_rows = num_rows
+        self.signature = signature
+        self.dtype = np.dtype(dtype)
+        self._arrays = None
+
+    def is_valid(self):
+        meta_file = op.join(self.cache_dir, META_FILE)
+        if not op.isfile(meta_file):
+            return False
+        with open(meta_file, 'r') as fp:
+            meta = json.load(fp)
+        return meta['num_rows'] == self.num_rows and meta['signature'] == self.signature
+
+    def open(self, shapes):
+        """Load the cache, (re)creating it for features of the given shapes if needed."""
+        if not self.is_valid():
+            if op.isdir(self.cache_dir):
+                logging.info('source files changed, rebuild {}'.format(self.cache_dir))
+                stale_dir = '{}.stale.{}'.format(self.cache_dir, os.getpid())
+                try:
+                    os.rename(self.cache_dir, stale_dir)
+                    shutil.rmtree(stale_dir)
+                except OSError:
+                    # another process is rebuilding it
+                    pass
+            self.create(shapes)
+        return self
+
+    def create(self, shapes):
+        tmp_dir = '{}.tmp.{}'.format(self.cache_dir, os.getpid())
+        os.makedirs(tmp_dir)
+        for name, shape in zip(FEATURE_FILES, shapes):
+            np.lib.format.open_memmap(op.join(tmp_dir, name), mode='w+',
+                    dtype=self.dtype, shape=(self.num_rows,) + tuple(shape))
+        np.lib.format.open_memmap(op.join(tmp_dir, FILLED_FILE), mode='w+',
+                dtype=np.uint8, shape=(self.num_rows,))
+        meta = {'num_rows': self.num_rows, 'signature': self.signature,
+                'shapes': [list(shape) for shape in shapes], 'dtype': self.dtype.name}
+        with open(op.join(tmp_dir, META_FILE), 'w') as fp:
+            json.dump(meta, fp)
+        try:
+            os.rename(tmp_dir, self.cache_dir)
+            logging.info('created feature cache {}'.format(self.cache_dir))
+        except OSError:
+            # created by another process in the meantime
+            shutil.rmtree(tmp_dir)
+
+    def _ensure_loaded(self):
+        if self._arrays is None:
+            self._arrays = {name: np.load(op.join(self.cache_dir, name), mmap_mode='r+')
+                            for name in FEATURE_FILES + [FILLED_FILE]}
+
+    def filled(self, rows):
+        """Boolean array telling which of rows are cached."""
+        self._ensure_loaded()
+        return self._arrays[FILLED_FILE][rows] > 0
+
+    def get(self, rows):
+        """(image_feat, grid_feat) tensors of rows, which must be cached."""
+        self._ensure_loaded()
+        return [torch.from_numpy(np.array(self._arrays[name][rows])) for name in FEATURE_FILES]
+
+    def put(self, rows, image_feat, grid_feat):
+        self._ensure_loaded()
+        for name, value in zip(FEATURE_FILES, [image_feat, grid_feat]):
+            self._arrays[name][rows] = value.detach().float().cpu().numpy().astype(self.dtype)
+        # mark the rows only once their data is written
+        self._arrays[FILLED_FILE][rows] = 1
+
+
+def open_feature_cache(cache_root, dataset, backbone, dtype=np.float16):
+    """Open the feature cache of dataset for the current weights of backbone,
+    with features stored in dtype. The augmentation of the dataset has to be fixed."""
+    dtype = np.dtype(dtype)
+    params = dict(dataset.cache_params(), device_augment=dataset.device_augment,
+                  backbone=weights_fingerprint(backbone), dtype=dtype.name)
+    cache = FeatureCache(op.join(cache_root, cache_key(params)), len(dataset),
+                         source_signature(dataset.cache_source_files()), dtype=dtype)
+    # feature shapes of a crop of the dataset resolution
+    device = next(backbone.parameters()).device
+    was_training = backbone.training
+    backbone.eval()
+    with torch.no_grad():
+        image_feat, grid_feat = backbone(torch.zeros(1, 3, dataset.img_res, dataset.img_res, device=device))
+    backbone.train(was_training)
+    return cache.open([image_feat.shape[1:], grid_feat.shape[1:]])
+
+
+def backbone_features(backbone, images, rows, cache):
+    """Features of the frozen backbone for a batch, from the cache where
+    available; the missing rows are computed and added to the cache. All
+    features go through the cache, so that they are rounded the same way
+    whether they were cached or not."""
+    rows = np.asarray(rows)
+    missing = np.flatnonzero(~cache.filled(rows))
+    if len(missing) > 0:
+        with torch.no_grad():
+            image_feat, grid_feat = backbone(images[torch.from_numpy(missing).to(images.device)])
+        cache.put(rows[missing], image_feat, grid_feat)
+    return [feat.to(images.device, non_blocking=True).float() for feat in cache.get(rows)]
@@ -10,18 +10,33 @@ Modified from open source projects:
 import numpy as np
 import base64
 import cv2
-import torch
 import scipy.misc
 
-def img_from_base64(imagestring):
+# decode flags for a reduction of the image resolution by 1, 2, 4 or 8
+REDUCED_DECODE_FLAGS = {1: cv2.IMREAD_COLOR,
+                        2: cv2.IMREAD_REDUCED_COLOR_2,
+                        4: cv2.IMREAD_REDUCED_COLOR_4,
+                        8: cv2.IMREAD_REDUCED_COLOR_8}
+
+def img_from_base64(imagestring, reduce=1):
+    """Decode a base64 encoded image. With reduce > 1, JPEG images are decoded
+    directly at 1/reduce of their resolution, which is much cheaper."""
     try:
         jpgbytestring = base64.b64decode(imagestring)
         nparr = np.frombuffer(jpgbytestring, np.uint8)
-        r = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        r = cv2.imdecode(nparr, REDUCED_DECODE_FLAGS[reduce])
         return r
     except ValueError:
         return None
 
+def reduced_box(center, scale, reduce):
+    """Bounding box in the pixels of an image decoded at 1/reduce resolution.
+    A reduced pixel covers a reduce x reduce block of the original image."""
+    if reduce == 1:
+        return center, scale
+    center = [(float(c) - (reduce - 1) / 2.0) / reduce for c in center]
+    return center, scale / reduce
+
 def myimrotate(img, angle, center=None, scale=1.0, border_value=0, auto_bound=False):
     if center is not None and auto_bound:
         raise ValueError('`auto_bound` conflicts with `center`')
@@ -86,21 +101,35 @@ def transform(pt, center, scale, res, invert=0, rot=0):
     """Transform pixel location to different reference."""
     t = get_transform(center, scale, res, rot=rot)
     if invert:
-        # t = np.linalg.inv(t)
-        t_torch = torch.from_numpy(t)
-        t_torch = torch.inverse(t_torch)
-        t = t_torch.numpy()
+        t = invert_transform(t)
     new_pt = np.array([pt[0]-1, pt[1]-1, 1.]).T
     new_pt = np.dot(t, new_pt)
     return new_pt[:2].astype(int)+1
 
+def invert_transform(t):
+    """Invert a 3x3 affine transformation matrix from get_transform."""
+    t_inv = np.eye(3)
+    t_inv[:2, :2] = np.linalg.inv(t[:2, :2])
+    t_inv[:2, 2] = -np.dot(t_inv[:2, :2], t[:2, 2])
+    return t_inv
+
+def transform_pts(pts, center, scale, res, invert=0, rot=0):
+    """Transform an array of pixel locations (N,2) to different reference.
+    Same as calling transform() on each point, but the matrix is built
+    (and inverted) only once and applied to all points with one matmul.
+    """
+    t = get_transform(center, scale, res, rot=rot)
+    if invert:
+        t = invert_transform(t)
+    pts = np.asarray(pts, dtype=np.float64)
+    new_pts = np.dot(pts - 1, t[:2, :2].T) + t[:2, 2]
+    return new_pts.astype(int)+1
+
 def crop(img, center, scale, res, rot=0):
     """Crop image according to the supplied bounding box."""
-    # Upper left point
-    ul = np.array(transform([1, 1], center, scale, res, invert=1))-1
-    # Bottom right point
-    br = np.array(transform([res[0]+1, 
-                             res[1]+1], center, scale, res, invert=1))-1
+    # Upper left and bottom right points
+    ul, br = transform_pts([[1, 1], [res[0]+1, res[1]+1]],
+                           center, scale, res, invert=1)-1
     # Padding so that when rotated proper amount of context is included
     pad = int(np.linalg.norm(br - ul) / 2 - float(br[1] - ul[1]) / 2)
     if not rot == 0:
@@ -130,15 +159,45 @@ def crop(img, center, scale, res, rot=0):
     new_img = myimresize(new_img, [res[0], res[1]])
     return new_img
 
+def crop_warp(img, center, scale, res, rot=0):
+    """Crop image according to the supplied bounding box with a single affine warp.
+    Same geometry as crop(), but it does not allocate the padded float64 canvas
+    and does the rotation and the resizing in one cv2.warpAffine.
+    The output keeps the dtype of img, e.g. uint8.
+    """
+    t = get_transform(center, scale, res, rot=rot)
+    new_img = cv2.warpAffine(img, t[:2], (res[1], res[0]), flags=cv2.INTER_LINEAR,
+                             borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+    return new_img
+
+def rgb_normalize(img, pn, mean, std):
+    """Add channel-wise pixel noise, scale to [0,1] and normalize a uint8 image.
+    Everything is folded into one lookup table per channel, so the image is
+    read once and written directly in CHW layout.
+    Returns the (3,H,W) float32 image in [0,1] and its normalized version.
+    """
+    values = np.arange(256, dtype=np.float64)[None, :]
+    pn = np.asarray(pn, dtype=np.float64)[:, None]
+    lut = np.minimum(255.0, np.maximum(0.0, values*pn)) / 255.0
+    lut_norm = (lut - np.asarray(mean)[:, None]) / np.asarray(std)[:, None]
+    lut = lut.astype(np.float32)
+    lut_norm = lut_norm.astype(np.float32)
+    img_chw = img.transpose(2, 0, 1)
+    rgb_img = np.empty(img_chw.shape, dtype=np.float32)
+    norm_img = np.empty(img_chw.shape, dtype=np.float32)
+    for c in range(img_chw.shape[0]):
+        np.take(lut[c], img_chw[c], out=rgb_img[c])
+        np.take(lut_norm[c], img_chw[c], out=norm_img[c])
+    return rgb_img, norm_img
+
 def uncrop(img, center, scale, orig_shape, rot=0, is_rgb=True):
     """'Undo' the image cropping/resizing.
     This function is used when evaluating mask/part segmentation.
     """
     res = img.shape[:2]
-    # Upper left point
-    ul = np.array(transform([1, 1], center, scale, res, invert=1))-1
-    # Bottom right point
-    br = np.array(transform([res[0]+1,res[1]+1], center, scale, res, invert=1))-1
+    # Upper left and bottom right points
+    ul, br = transform_pts([[1, 1], [res[0]+1, res[1]+1]],
+                           center, scale, res, invert=1)-1
     # size of cropped image
     crop_shape = [br[1] - ul[1], br[0] - ul[0]]
 
@@ -177,10 +236,12 @@ def flip_img(img):
     img = np.fliplr(img)
     return img
 
+# left/right order of the 24 body joints after a horizontal flip
+FLIPPED_KP_PARTS = [5, 4, 3, 2, 1, 0, 11, 10, 9, 8, 7, 6, 12, 13, 14, 15, 16, 17, 18, 19, 21, 20, 23, 22]
+
 def flip_kp(kp):
     """Flip keypoints."""
-    flipped_parts = [5, 4, 3, 2, 1, 0, 11, 10, 9, 8, 7, 6, 12, 13, 14, 15, 16, 17, 18, 19, 21, 20, 23, 22]
-    kp = kp[flipped_parts]
+    kp = kp[FLIPPED_KP_PARTS]
     kp[:,0] = - kp[:,0]
     return kp
 
@@ -0,0 +1,177 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT license.
+
+Pre-parsed label store. The json labels of a label TSV are compiled once into
+fixed-shape numpy arrays (one .npy file per field, indexed by TSV row), which
+the datasets memory-map and read without any parsing. The store records the
+size and modification time of the label TSV it was compiled from, so that
+a store of edited labels is detected as out of date.
+"""
+
+
+import os
+import os.path as op
+import json
+import shutil
+import logging
+import numpy as np
+from tqdm import tqdm
+from src.utils.miscellaneous import mkdir
+from src.utils.crop_cache import source_signature, tsv_source_files
+
+
+META_FILE = 'meta.json'
+
+# array fields: name in the json label -> file name in the store
+ARRAY_FIELDS = [('center', 'center'),
+                ('2d_joints', 'joints_2d'),
+                ('3d_joints', 'joints_3d'),
+                ('pose', 'pose'),
+                ('betas', 'betas')]
+
+# scalar fields, stored as one value per row
+SCALAR_FIELDS = [('scale', 'scale', np.float32),
+                 ('has_2d_joints', 'has_2d_joints', np.int8),
+                 ('has_3d_joints', 'has_3d_joints', np.int8),
+                 ('has_smpl', 'has_smpl', np.int8)]
+
+
+def _to_array(value):
+    value = np.asarray(value, dtype=np.float32)
+    # some labels keep the joints of a single person as [1, J, C]
+    if value.ndim == 3:
+        value = value[0]
+    return value
+
+
+def _infer_shapes(label_tsv):
+    shapes = {}
+    for i in range(label_tsv.num_rows()):
+        annotations = json.loads(label_tsv[i][1])[0]
+        for field, name in ARRAY_FIELDS:
+            if name not in shapes and field in annotations:
+                value = _to_array(annotations[field])
+                if value.size > 0:
+                    shapes[name] = value.shape
+        if len(shapes) == len(ARRAY_FIELDS):
+            break
+    for field, name in ARRAY_FIELDS:
+        if name not in shapes:
+            raise ValueError('Cannot infer the shape of "{}" from {}'.format(field, label_tsv))
+    return shapes
+
+
+def compile_label_store(label_tsv, out_dir):
+    """Parse every row of label_tsv once and write the fields to out_dir.
+    label_tsv can be a TSVFile or a CompositeTSVFile; rows are indexed the
+    same way as the TSV, so the store can be used with any linelist.
+    """
+    num_rows = label_tsv.num_rows()
+    signature = source_signature(tsv_source_files(label_tsv))
+    shapes = _infer_shapes(label_tsv)
+    out_tmp = out_dir + '.tmp'
+    if op.isdir(out_tmp):
+        # left over by an interrupted run
+        shutil.rmtree(out_tmp)
+    mkdir(out_tmp)
+
+    arrays = {}
+    for field, name in ARRAY_FIELDS:
+        arrays[name] = np.lib.format.open_memmap(op.join(out_tmp, name + '.npy'),
+                mode='w+', dtype=np.float32, shape=(num_rows,) + tuple(shapes[name]))
+    for field, name, dtype in SCALAR_FIELDS:
+        arrays[name] = np.lib.format.open_memmap(op.join(out_tmp, name + '.npy'),
+                mode='w+', dtype=dtype, shape=(num_rows,))
+    genders = ['none']
+    gender = np.lib.format.open_memmap(op.join(out_tmp, 'gender.npy'),
+                mode='w+', dtype=np.int8, shape=(num_rows,))
+
+    for i in tqdm(range(num_rows)):
+        annotations = json.loads(label_tsv[i][1])[0]
+        for field, name in ARRAY_FIELDS:
+            value = _to_array(annotations.get(field, []))
+            if value.shape == arrays[name].shape[1:]:
+                arrays[name][i] = value
+            else:
+                # missing or malformed field, the has_* flags tell it apart
+                arrays[name][i] = 0
+        for field, name, dtype in SCALAR_FIELDS:
+            arrays[name][i] = annotations.get(field, 0)
+        g = annotations.get('gender', 'none')
+        if g not in genders:
+            genders.append(g)
+        gender[i] = genders.index(g)
+
+    for a in list(arrays.values()) + [gender]:
+        a.flush()
+    del arrays, gender
+
+    meta = {'num_rows': num_rows,
+            'signature': signature,
+            'shapes': {k: list(v) for k, v in shapes.items()},
+            'genders': genders}
+    with open(op.join(out_tmp, META_FILE), 'w') as fp:
+        json.dump(meta, fp)
+    if op.isdir(out_dir):
+        # replace an out of date store, moving it aside first
+        old_dir = '{}.old.{}'.format(out_dir, os.getpid())
+        os.rename(out_dir, old_dir)
+        os.rename(out_tmp, out_dir)
+        shutil.rmtree(old_dir)
+    else:
+        os.rename(out_tmp, out_dir)
+    logging.info('compiled {} labels to {}'.format(num_rows, out_dir))
+    return out_dir
+
+
+class LabelStore(object):
+    """Read-only view of a compiled label store."""
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(op.join(store_dir, META_FILE), 'r') as fp:
+            self.meta = json.load(fp)
+        self.genders = self.meta['genders']
+        self._arrays = None
+
+    def __len__(self):
+        return self.meta['num_rows']
+
+    def is_up_to_date(self, label_tsv):
+        """Whether the store was compiled from the current label_tsv."""
+        return self.meta['num_rows'] == label_tsv.num_rows() and \
+            self.meta.get('signature') == source_signature(tsv_source_files(label_tsv))
+
+    def source_files(self):
+        """Files of the store, for the signature of caches built from its labels."""
+        return [op.join(self.store_dir, f) for f in sorted(os.listdir(self.store_dir))]
+
+    def _ensure_loaded(self):
+        # open lazily, so that each dataloader worker maps the files itself
+        if self._arrays is None:
+            names = [name for _, name in ARRAY_FIELDS] + \
+                    [name for _, name, _ in SCALAR_FIELDS] + ['gender']
+            self._arrays = {name: np.load(op.join(self.store_dir, name + '.npy'),
+                                          mmap_mode='r') for name in names}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+    def get_annotations(self, row):
+        """Return the labels of a row in the same layout as the json labels."""
+        self._ensure_loaded()
+        a = self._arrays
+        return [{
+            'center': np.array(a['center'][row]),
+            'scale': float(a['scale'][row]),
+            '2d_joints': np.array(a['joints_2d'][row]),
+            '3d_joints': np.array(a['joints_3d'][row]),
+            'pose': np.array(a['pose'][row]),
+            'betas': np.array(a['betas'][row]),
+            'has_2d_joints': int(a['has_2d_joints'][row]),
+            'has_3d_joints': int(a['has_3d_joints'][row]),
+            'has_smpl': int(a['has_smpl'][row]),
+            'gender': self.genders[int(a['gender'][row])],
+        }]
@@ -5,6 +5,11 @@ Licensed under the MIT license.
 Basic logger. It Computes and stores the average and current value
 """
 
+from collections import OrderedDict
+import numpy as np
+from src.utils.comm import all_reduce_sum
+
+
 class AverageMeter(object):
     
     def __init__(self):
@@ -22,6 +27,41 @@ class AverageMeter(object):
         self.count += n
         self.avg = self.sum / self.count
 
+    def sync(self):
+        """Sum sum and count over all processes, so that avg becomes the average
+        over the samples of every rank. Call it once, after the last update."""
+        self.sum, self.count = all_reduce_sum([self.sum, self.count])
+        self.avg = self.sum / self.count if self.count > 0 else 0
+        return self
+
+
+class DistributedMetrics(object):
+    """
+    Per-sample metrics (e.g. mPVE, mPJPE, PA-MPJPE) accumulated in AverageMeters
+    and synchronized across processes with a single collective, weighted by
+    the number of samples of each rank.
+    """
+    def __init__(self, names):
+        self.meters = OrderedDict((name, AverageMeter()) for name in names)
+
+    def __getitem__(self, name):
+        return self.meters[name]
+
+    def update(self, name, errors):
+        """Add the per-sample errors of a batch, e.g. a numpy array of shape (N,)."""
+        if len(errors) > 0:
+            self.meters[name].update(float(np.mean(errors)), len(errors))
+
+    def sync(self):
+        values = []
+        for meter in self.meters.values():
+            values.extend([meter.sum, meter.count])
+        values = all_reduce_sum(values)
+        for i, meter in enumerate(self.meters.values()):
+            meter.sum, meter.count = values[2*i], values[2*i+1]
+            meter.avg = meter.sum / meter.count if meter.count > 0 else 0
+        return self
+
 
 
 class EvalMetricsLogger(object):
@@ -43,3 +83,9 @@ class EvalMetricsLogger(object):
         self.mPJPE = mPJPE
         self.mPVE = mPVE
         self.epoch = epoch
+
+    def state_dict(self):
+        return dict(self.__dict__)
+
+    def load_state_dict(self, state):
+        self.__dict__.update(state)
@@ -65,6 +65,46 @@ def compute_similarity_transform_batch(S1, S2):
         S1_hat[i] = compute_similarity_transform(S1[i], S2[i])
     return S1_hat
 
+def compute_similarity_transform_vectorized(S1, S2):
+    """Same as compute_similarity_transform_batch for S1, S2 of shape (B, N, 3),
+    with batched matrix products and SVD instead of a loop over samples."""
+    # 1. Remove mean.
+    mu1 = S1.mean(axis=1, keepdims=True)
+    mu2 = S2.mean(axis=1, keepdims=True)
+    X1 = S1 - mu1
+    X2 = S2 - mu2
+
+    # 2. Compute variance of X1 used for scale.
+    var1 = np.sum(X1**2, axis=(1, 2))
+
+    # 3. The outer product of X1 and X2.
+    K = np.matmul(X1.transpose(0, 2, 1), X2)
+
+    # 4. Solution that Maximizes trace(R'K) is R=U*V', where U, V are
+    # singular vectors of K.
+    U, s, Vh = np.linalg.svd(K)
+    V = Vh.transpose(0, 2, 1)
+    # Construct Z that fixes the orientation of R to get det(R)=1.
+    Z = np.tile(np.eye(U.shape[1]), (U.shape[0], 1, 1))
+    Z[:, -1, -1] *= np.sign(np.linalg.det(np.matmul(U, Vh)))
+    # Construct R.
+    R = np.matmul(V, np.matmul(Z, U.transpose(0, 2, 1)))
+
+    # 5. Recover scale.
+    scale = np.trace(np.matmul(R, K), axis1=1, axis2=2) / var1
+
+    # 6. Recover translation.
+    t = mu2.transpose(0, 2, 1) - scale[:, None, None] * np.matmul(R, mu1.transpose(0, 2, 1))
+
+    # 7. Error:
+    S1_hat = scale[:, None, None] * np.matmul(R, S1.transpose(0, 2, 1)) + t
+    return S1_hat.transpose(0, 2, 1)
+
+def reconstruction_error_per_joint(S1, S2):
+    """Per-joint error after Procrustes alignment, of shape (B, N)."""
+    S1_hat = compute_similarity_transform_vectorized(S1, S2)
+    return np.sqrt(((S1_hat - S2)** 2).sum(axis=-1))
+
 def reconstruction_error(S1, S2, reduction='mean'):
     """Do Procrustes alignment and compute reconstruction error."""
     S1_hat = compute_similarity_transform_batch(S1, S2)
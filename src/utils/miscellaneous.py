@@ -1,5 +1,7 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
 import errno
+import contextlib
+import inspect
 import os
 import os.path as op
 import re
@@ -8,6 +10,7 @@ import numpy as np
 import torch
 import random
 import shutil
+from torch.utils.checkpoint import checkpoint
 from .comm import is_main_process
 import yaml
 
@@ -24,6 +27,110 @@ def mkdir(path):
             raise
 
 
+def get_amp_dtype(device, amp_dtype='float16'):
+    """Autocast dtype on device; bfloat16 on CPU, which has no float16 autocast."""
+    if torch.device(device).type == 'cpu':
+        return torch.bfloat16
+    return getattr(torch, amp_dtype)
+
+
+def autocast(args):
+    """Mixed precision context for the forward pass, a no-op unless args.amp,
+    so that torch versions without autocast run in float32."""
+    if not args.amp:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=torch.device(args.device).type,
+                          dtype=get_amp_dtype(args.device, args.amp_dtype))
+
+
+def autocast_disabled(tensor):
+    """Context that runs the ops on tensor in full precision if autocast is
+    enabled for its device, a no-op otherwise."""
+    if tensor.device.type == 'cpu':
+        is_enabled = getattr(torch, 'is_autocast_cpu_enabled', None)
+    else:
+        is_enabled = getattr(torch, 'is_autocast_enabled', None)
+    if is_enabled is None or not is_enabled():
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=tensor.device.type, enabled=False)
+
+
+# torch>=1.11 takes use_reentrant, and recent versions warn if it is not given
+_CHECKPOINT_KWARGS = {'use_reentrant': True} \
+    if 'use_reentrant' in inspect.signature(checkpoint).parameters else {}
+
+
+def reentrant_checkpoint(function, *args):
+    """Activation checkpointing of function(*args) in the reentrant form, which
+    runs function completely again in the backward pass. With DDP it needs
+    find_unused_parameters=False or a static graph."""
+    return checkpoint(function, *args, **_CHECKPOINT_KWARGS)
+
+
+class NoGradScaler(object):
+    """Same interface as torch.cuda.amp.GradScaler, without loss scaling."""
+
+    def scale(self, loss):
+        return loss
+
+    def unscale_(self, optimizer):
+        pass
+
+    def step(self, optimizer):
+        optimizer.step()
+
+    def update(self):
+        pass
+
+    def is_enabled(self):
+        return False
+
+    def state_dict(self):
+        return {}
+
+    def load_state_dict(self, state_dict):
+        pass
+
+
+def make_grad_scaler(args):
+    """Loss scaling, only needed for float16 autocast."""
+    if args.amp and get_amp_dtype(args.device, args.amp_dtype) == torch.float16:
+        return torch.cuda.amp.GradScaler()
+    return NoGradScaler()
+
+
+def grad_sync_context(model, sync):
+    """Context for the forward and backward pass of a micro-batch. Unless sync,
+    gradients are accumulated locally with DistributedDataParallel.no_sync()."""
+    if not sync and hasattr(model, 'no_sync'):
+        return model.no_sync()
+    return contextlib.nullcontext()
+
+
+def get_unused_parameters(model, loss):
+    """Names of the trainable parameters of model that get no gradient from loss."""
+    model.zero_grad(set_to_none=True)
+    loss.backward()
+    unused = [name for name, param in model.named_parameters()
+              if param.requires_grad and param.grad is None]
+    model.zero_grad(set_to_none=True)
+    return unused
+
+
+def make_distributed_model(model, args):
+    """Wrap model in DistributedDataParallel. Unless the modules that forward
+    never uses are skipped, DDP has to search the autograd graph for unused
+    parameters in every iteration."""
+    device = torch.device(args.device)
+    kwargs = {'static_graph': True} if args.ddp_static_graph else {}
+    return torch.nn.parallel.DistributedDataParallel(
+        model, device_ids=[args.local_rank] if device.type == 'cuda' else None,
+        output_device=args.local_rank if device.type == 'cuda' else None,
+        find_unused_parameters=not args.skip_unused_modules,
+        **kwargs
+    )
+
+
 def save_config(cfg, path):
     if is_main_process():
         with open(path, 'w') as f:
@@ -0,0 +1,179 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT license.
+
+Streaming writer for test set predictions. Predictions are handed over per
+batch and written by a background thread as chunks of float32 arrays into a
+.npz file (a zip of .npy entries named <field>/<chunk>.npy), so inference
+neither keeps all predictions in memory nor stalls at the end of the run.
+A competition pred.json zip can be exported from the .npz on request.
+"""
+
+
+import io
+import os
+import json
+import queue
+import zipfile
+import threading
+import numpy as np
+import torch
+
+
+KEYS_FIELD = 'keys'
+
+
+class PredictionWriter(object):
+    """Write predictions to filename from a background thread.
+
+        writer = PredictionWriter('pred.npz')
+        for ...:
+            writer.add(img_keys, joints=pred_joints, vertices=pred_vertices)
+        writer.close()
+    """
+    def __init__(self, filename, chunk_size=1024, max_queue=16):
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.num_written = 0
+        self._error = None
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._zip = zipfile.ZipFile(filename + '.tmp', 'w', zipfile.ZIP_STORED, allowZip64=True)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def add(self, keys, **arrays):
+        """Queue the predictions of a batch; arrays are tensors or arrays of shape (B,...)."""
+        if self._error is not None:
+            raise self._error
+        batch = {}
+        for name, value in arrays.items():
+            if torch.is_tensor(value):
+                value = value.detach().float().cpu().numpy()
+            batch[name] = np.asarray(value, dtype=np.float32)
+        self._queue.put((list(keys), batch))
+
+    def _write_chunk(self, chunk, keys, arrays):
+        entries = [(KEYS_FIELD, np.asarray(keys, dtype=np.str_))] + \
+                  [(name, np.concatenate(values)) for name, values in arrays.items()]
+        for name, value in entries:
+            with self._zip.open('{}/{:06d}.npy'.format(name, chunk), 'w', force_zip64=True) as fp:
+                np.lib.format.write_array(fp, value, allow_pickle=False)
+        self.num_written += len(keys)
+
+    def _run(self):
+        chunk, keys, arrays = 0, [], {}
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+                batch_keys, batch = item
+                keys.extend(batch_keys)
+                for name, value in batch.items():
+                    arrays.setdefault(name, []).append(value)
+                if len(keys) >= self.chunk_size:
+                    self._write_chunk(chunk, keys, arrays)
+                    chunk, keys, arrays = chunk + 1, [], {}
+            if len(keys) > 0:
+                self._write_chunk(chunk, keys, arrays)
+        except Exception as e:
+            self._error = e
+            # keep consuming, so that add() never blocks on a full queue
+            while item is not None:
+                item = self._queue.get()
+
+    def close(self):
+        """Wait for all queued predictions to be written and finalize the file."""
+        self._queue.put(None)
+        self._thread.join()
+        self._zip.close()
+        if self._error is not None:
+            raise self._error
+        os.rename(self.filename + '.tmp', self.filename)
+        return self.filename
+
+
+def iter_prediction_chunks(filename, name):
+    """Yield the chunks of one field of a prediction file, in order."""
+    prefix = name + '/'
+    with zipfile.ZipFile(filename, 'r') as archive:
+        entries = sorted(n for n in archive.namelist() if n.startswith(prefix))
+        for entry in entries:
+            yield np.load(io.BytesIO(archive.read(entry)), allow_pickle=False)
+
+
+def load_predictions(filename):
+    """Load a prediction file as (keys, {field: array})."""
+    with zipfile.ZipFile(filename, 'r') as archive:
+        names = sorted(set(n.split('/')[0] for n in archive.namelist()))
+    arrays = {name: np.concatenate(list(iter_prediction_chunks(filename, name)))
+              for name in names}
+    keys = arrays.pop(KEYS_FIELD).tolist()
+    return keys, arrays
+
+
+def merge_prediction_files(pred_files, filename, keys, chunk_size=1024):
+    """Merge the prediction files of several ranks into one, in the order of keys.
+    Samples predicted more than once, e.g. the padding of a distributed
+    sampler, are written once."""
+    locations = {}
+    preds = []
+    for p, pred_file in enumerate(pred_files):
+        pred_keys, arrays = load_predictions(pred_file)
+        preds.append(arrays)
+        for i, key in enumerate(pred_keys):
+            locations.setdefault(key, []).append((p, i))
+    missing = [key for key in keys if key not in locations]
+    if len(missing) > 0:
+        raise ValueError('{} of {} samples have no prediction, e.g. {}'.format(
+                         len(missing), len(keys), missing[0]))
+    names = list(preds[0].keys())
+    writer = PredictionWriter(filename, chunk_size)
+    for start in range(0, len(keys), chunk_size):
+        chunk_keys = keys[start:start+chunk_size]
+        # repeated keys in the dataset take successive predictions
+        chunk_locations = [locations[key].pop(0) if len(locations[key]) > 1 else locations[key][0]
+                           for key in chunk_keys]
+        writer.add(chunk_keys, **{name: np.stack([preds[p][name][i] for p, i in chunk_locations])
+                                  for name in names})
+    return writer.close()
+
+
+def _write_json_lists(fp, fields):
+    # same output as json.dump([field.tolist() for field in fields], fp),
+    # written one sample at a time
+    fp.write(b'[')
+    for i, chunks in enumerate(fields):
+        fp.write(b', [' if i > 0 else b'[')
+        first = True
+        for chunk in chunks:
+            for sample in chunk:
+                if not first:
+                    fp.write(b', ')
+                fp.write(json.dumps(sample.tolist()).encode())
+                first = False
+        fp.write(b']')
+    fp.write(b']')
+
+
+def write_pred_json_zip(zip_file, fields):
+    """Write pred.json, a list with one list per field, into zip_file.
+    Each field is an iterable of array chunks of shape (N,...)."""
+    zip_tmp = zip_file + '.tmp'
+    with zipfile.ZipFile(zip_tmp, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+        with archive.open('pred.json', 'w', force_zip64=True) as fp:
+            _write_json_lists(fp, fields)
+    os.rename(zip_tmp, zip_file)
+    return zip_file
+
+
+def export_pred_json(pred_file, zip_file, names=('joints', 'vertices')):
+    """Convert a prediction file into the pred.json zip of the competition."""
+    return write_pred_json_zip(zip_file, [iter_prediction_chunks(pred_file, name) for name in names])
+
+
+def load_pred_json(zip_file):
+    """Load the fields of a pred.json zip as arrays."""
+    with zipfile.ZipFile(zip_file, 'r') as archive:
+        reference = json.loads(archive.read('pred.json').decode("utf-8"))
+    return [np.asarray(field) for field in reference]
@@ -9,6 +9,8 @@ Definition of TSV class
 import logging
 import os
 import os.path as op
+from collections import OrderedDict
+import numpy as np
 
 
 def generate_lineidx(filein, idxout):
@@ -53,6 +55,11 @@ class TSVFile(object):
         if self._fp:
             self._fp.close()
 
+    def close(self):
+        if self._fp:
+            self._fp.close()
+            self._fp = None
+
     def __str__(self):
         return "TSVFile(tsv_file='{}')".format(self.tsv_file)
 
@@ -84,6 +91,11 @@ class TSVFile(object):
     def get_key(self, idx):
         return self.seek_first_column(idx)
 
+    def get_keys_bulk(self, indices=None):
+        if indices is None:
+            indices = range(self.num_rows())
+        return [self.get_key(i) for i in indices]
+
     def __getitem__(self, index):
         return self.seek(index)
 
@@ -94,7 +106,8 @@ class TSVFile(object):
         if self._lineidx is None:
             logging.info('loading lineidx: {}'.format(self.lineidx))
             with open(self.lineidx, 'r') as fp:
-                self._lineidx = [int(i.strip()) for i in fp.readlines()]
+                self._lineidx = np.array([int(i.strip()) for i in fp.readlines()],
+                                         dtype=np.int64)
 
     def _ensure_tsv_opened(self):
         if self._fp is None:
@@ -108,7 +121,7 @@ class TSVFile(object):
 
 
 class CompositeTSVFile():
-    def __init__(self, file_list, seq_file, root='.'):
+    def __init__(self, file_list, seq_file, root='.', max_open=64):
         if isinstance(file_list, str):
             self.file_list = load_list_file(file_list)
         else:
@@ -117,24 +130,67 @@ class CompositeTSVFile():
 
         self.seq_file = seq_file
         self.root = root
+        # at most max_open shards keep their file open
+        self.max_open = max_open
         self.initialized = False
         self.initialize()
 
     def get_key(self, index):
         idx_source, idx_row = self.seq[index]
-        k = self.tsvs[idx_source].get_key(idx_row)
+        k = self.get_tsv(idx_source).get_key(idx_row)
         return '_'.join([self.file_list[idx_source], k])
 
+    def get_keys_bulk(self, indices=None):
+        """Keys of many rows, read shard by shard and in file order."""
+        if indices is None:
+            indices = np.arange(self.num_rows())
+        seq = self.seq[np.asarray(indices, dtype=np.int64)]
+        keys = [None] * len(seq)
+        for i in np.lexsort((seq[:, 1], seq[:, 0])):
+            idx_source, idx_row = seq[i]
+            k = self.get_tsv(idx_source).get_key(idx_row)
+            keys[i] = '_'.join([self.file_list[idx_source], k])
+        return keys
+
     def num_rows(self):
         return len(self.seq)
 
     def __getitem__(self, index):
         idx_source, idx_row = self.seq[index]
-        return self.tsvs[idx_source].seek(idx_row)
+        return self.get_tsv(idx_source).seek(idx_row)
 
     def __len__(self):
         return len(self.seq)
 
+    def __getstate__(self):
+        # do not pickle the mapped seq or open files into dataloader workers
+        state = self.__dict__.copy()
+        state['_seq'] = None
+        state['tsvs'] = {}
+        state['_opened'] = OrderedDict()
+        return state
+
+    @property
+    def seq(self):
+        if self._seq is None:
+            self._seq = load_seq_file(self.seq_file)
+        return self._seq
+
+    def get_tsv(self, idx_source):
+        """TSVFile of a shard, created on first use. Files of the least
+        recently used shards are closed beyond max_open."""
+        idx_source = int(idx_source)
+        tsv = self.tsvs.get(idx_source)
+        if tsv is None:
+            tsv = TSVFile(op.join(self.root, self.file_list[idx_source]))
+            self.tsvs[idx_source] = tsv
+        self._opened[idx_source] = True
+        self._opened.move_to_end(idx_source)
+        if len(self._opened) > self.max_open:
+            idx_closed, _ = self._opened.popitem(last=False)
+            self.tsvs[idx_closed].close()
+        return tsv
+
     def initialize(self):
         '''
         this function has to be called in init function if cache_policy is
@@ -142,15 +198,36 @@ class CompositeTSVFile():
         '''
         if self.initialized:
             return
-        self.seq = []
-        with open(self.seq_file, 'r') as fp:
-            for line in fp:
-                parts = line.strip().split('\t')
-                self.seq.append([int(parts[0]), int(parts[1])])
-        self.tsvs = [TSVFile(op.join(self.root, f)) for f in self.file_list]
+        self._seq = load_seq_file(self.seq_file)
+        self.tsvs = {}
+        self._opened = OrderedDict()
         self.initialized = True
 
 
+def load_seq_file(seq_file):
+    """Load the (source, row) pairs of a composite seq file as an int32 (N,2) array.
+    The array is saved as .npy next to the seq file once, then memory-mapped.
+    """
+    npy_file = op.splitext(seq_file)[0] + '.seq.npy'
+    if op.isfile(npy_file) and op.getmtime(npy_file) >= op.getmtime(seq_file):
+        return np.load(npy_file, mmap_mode='r')
+    seq = []
+    with open(seq_file, 'r') as fp:
+        for line in fp:
+            parts = line.strip().split('\t')
+            seq.append((int(parts[0]), int(parts[1])))
+    seq = np.array(seq, dtype=np.int32).reshape(-1, 2)
+    npy_tmp = '{}.tmp.{}'.format(npy_file, os.getpid())
+    try:
+        with open(npy_tmp, 'wb') as fp:
+            np.save(fp, seq)
+        os.rename(npy_tmp, npy_file)
+    except OSError:
+        logging.info('cannot save {}, keep the seq in memory'.format(npy_file))
+        return seq
+    return np.load(npy_file, mmap_mode='r')
+
+
 def load_list_file(fname):
     with open(fname, 'r') as fp:
         lines = fp.readlines()